@@ -2,7 +2,8 @@
 
 import click
 
-from modules.commands.commands import analyze, annotate, api
+from modules.commands.commands import analyze, batch, annotate, merge, export, stats, api, \
+    load_test, uci_benchmark, engine_service
 
 
 @click.group()
@@ -14,8 +15,15 @@ def main():
 
 
 main.add_command(analyze)
+main.add_command(batch)
 main.add_command(annotate)
+main.add_command(merge)
+main.add_command(export)
+main.add_command(stats)
 main.add_command(api)
+main.add_command(load_test)
+main.add_command(uci_benchmark)
+main.add_command(engine_service)
 
 if __name__ == '__main__':
     main()
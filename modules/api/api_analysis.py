@@ -0,0 +1,205 @@
+import collections
+import threading
+
+import chess
+import chess.engine
+
+from modules.api.bundle_index import BundleIndex, normalize_fen
+from modules.core.evaluation.evaluation import evaluate_move_sync
+from modules.core.notation.notation import get_san, get_variation_san
+from modules.core.score.score import get_signed_cp_score, get_expectation, get_current_score_for_grandmaster, \
+    get_principle_variation, get_cp_score_string
+
+API_MULTIPV = 2
+API_DEPTH = 18
+
+# Maximum number of engine analyses kept in memory (see api --analysis-cache-size). Prefetching fills the cache with
+# positions no client asked for yet, so the least recently used analyses are evicted.
+MAX_CACHED_ANALYSES = 100000
+
+# Results and engine analyses shared by all API routes. Analyses are stored together with the depth they were
+# searched to, results only once both of their analyses reached full depth. The analysis cache is shared by the
+# threads of the Flask API.
+result_cache = {}
+analysis_cache = collections.OrderedDict()
+analysis_cache_lock = threading.Lock()
+
+# Results of already analyzed games loaded from bundles at startup
+bundle_index = BundleIndex()
+
+
+class AnalyseRequest:
+    def __init__(self, grandmaster_side, board_before_move_fen, board_after_move_fen,
+                 last_opponent_move_was_blunder, move_played_san, max_depth=API_DEPTH, deadline=None):
+        self.grandmaster_side = grandmaster_side
+        self.board_before_move_fen = board_before_move_fen
+        self.board_after_move_fen = board_after_move_fen
+        self.last_opponent_move_was_blunder = last_opponent_move_was_blunder
+        self.move_played_san = move_played_san
+        # Depth the client is content with and seconds it is willing to wait for the engine (None: no limit)
+        self.max_depth = max_depth
+        self.deadline = deadline
+
+    # Full depth requests without deadline are answered by the shared full depth searches
+    def is_bounded(self):
+        return self.max_depth < API_DEPTH or self.deadline is not None
+
+    def get_limit(self, deadline=None):
+        return chess.engine.Limit(depth=self.max_depth, time=deadline)
+
+    def get_result_cache_key(self):
+        return self.board_before_move_fen, self.board_after_move_fen
+
+    def get_board_before_move(self):
+        board_before_move = chess.Board()
+        board_before_move.set_fen(self.board_before_move_fen)
+        return board_before_move
+
+    def get_board_after_move(self):
+        board_after_move = chess.Board()
+        board_after_move.set_fen(self.board_after_move_fen)
+        return board_after_move
+
+
+# Parse the url parameters of an analyse request. Returns the parsed request or a cached result and an error message
+def parse_analyse_request(args):
+    grandmaster_side_str = args.get('grandmasterSide')
+    board_before_move_fen = args.get('boardBeforeMoveFen')
+    board_after_move_fen = args.get('boardAfterMoveFen')
+    last_opponent_move_was_blunder_str = args.get('lastOpponentMoveWasBlunder')
+    move_played_san = args.get('movePlayedSan')
+
+    if not grandmaster_side_str or not board_before_move_fen or not board_after_move_fen:
+        return None, None, 'Missing url parameters'
+
+    if (board_before_move_fen, board_after_move_fen) in result_cache:
+        return None, result_cache[(board_before_move_fen, board_after_move_fen)], None
+
+    if not move_played_san or not last_opponent_move_was_blunder_str:
+        return None, None, 'Missing url parameters'
+
+    grandmaster_side = chess.WHITE if grandmaster_side_str.lower() == 'white' else chess.BLACK
+    last_opponent_move_was_blunder = True if last_opponent_move_was_blunder_str.lower() == 'true' else False
+
+    # Optional maximum depth and deadline (in milliseconds) of the engine searches
+    try:
+        max_depth = min(int(args.get('maxDepth', API_DEPTH)), API_DEPTH)
+        deadline = int(args['deadline']) / 1000 if args.get('deadline') else None
+    except ValueError:
+        return None, None, 'Invalid url parameters'
+
+    if max_depth < 1 or (deadline is not None and deadline <= 0):
+        return None, None, 'Invalid url parameters'
+
+    analyse_request = AnalyseRequest(grandmaster_side, board_before_move_fen, board_after_move_fen,
+                                     last_opponent_move_was_blunder, move_played_san, max_depth, deadline)
+
+    # Moves of analyzed games are answered without engine
+    bundle_result = bundle_index.get_result(analyse_request)
+    if bundle_result is not None:
+        return None, bundle_result, None
+
+    return analyse_request, None, None
+
+
+# Analyses are stored by normalized fen, so that positions prefetched by the API match the fens sent by clients.
+# Returns the cached analysis and its depth if it was searched at least to the given depth.
+def get_cached_analysis(fen, min_depth=API_DEPTH):
+    key = normalize_fen(fen)
+    with analysis_cache_lock:
+        cached = analysis_cache.get(key)
+        if cached is not None:
+            analysis_cache.move_to_end(key)
+
+    if cached is None or cached[0] < min_depth:
+        return None, None
+    return cached[1], cached[0]
+
+
+# A deeper analysis replaces a shallower one, never the other way around
+def store_analysis(fen, analysis, depth=API_DEPTH):
+    key = normalize_fen(fen)
+    with analysis_cache_lock:
+        cached = analysis_cache.get(key)
+        if cached is None or cached[0] <= depth:
+            analysis_cache[key] = (depth, analysis)
+        analysis_cache.move_to_end(key)
+
+        while len(analysis_cache) > MAX_CACHED_ANALYSES:
+            analysis_cache.popitem(last=False)
+
+
+# Depth a (possibly time limited) search completed for all principal variations
+def get_analysis_depth(board, analysis, limit_depth):
+    if board.is_game_over():
+        return API_DEPTH
+    return min([info.get("depth", limit_depth) for info in analysis] + [limit_depth])
+
+
+def store_result(analyse_request, result):
+    result_cache[analyse_request.get_result_cache_key()] = result
+
+
+# Evaluate the move played using the engine analyses of the boards before and after the move
+def evaluate_analyse_request(analyse_request, analysis_before_move, analysis_after_move):
+    grandmaster_side = analyse_request.grandmaster_side
+    board_before_move = analyse_request.get_board_before_move()
+    board_after_move = analyse_request.get_board_after_move()
+
+    # Parse turn and move played
+    turn = 'white' if board_before_move.turn == chess.WHITE else 'black'
+    move_played = board_before_move.parse_san(analyse_request.move_played_san)
+
+    # Analyse score and expectation before move played
+    score_before_move = get_signed_cp_score(analysis_before_move)
+    gm_pov_score_before_move = get_current_score_for_grandmaster(score_before_move, grandmaster_side)
+    expectation_before_move = get_expectation(gm_pov_score_before_move, board_before_move.ply())
+
+    # Analyse score and expectation after move played
+    score_after_move = get_signed_cp_score(analysis_after_move)
+    white_pov_score_after_move = get_current_score_for_grandmaster(score_after_move, chess.WHITE)
+    gm_pov_score_after_move = get_current_score_for_grandmaster(score_after_move, grandmaster_side)
+    expectation_after_move = get_expectation(gm_pov_score_after_move, board_after_move.ply())
+    pv = [move_played] + get_principle_variation(analysis_after_move)
+
+    # Analyse type of move played
+    san_cache = {}
+    move_played_type, alternative_moves = \
+         evaluate_move_sync(grandmaster_side, analyse_request.last_opponent_move_was_blunder, analysis_before_move,
+                            board_before_move.ply(), move_played, expectation_before_move, expectation_after_move,
+                            board_before_move, san_cache)
+
+    result = {
+        "turn": turn,
+        "evaluatedMove": {
+            "move": {"uci": move_played.uci(), "san": get_san(board_before_move, move_played, san_cache)},
+            "moveType": move_played_type.value,
+            "signedCPScore": get_cp_score_string(white_pov_score_after_move),
+            "gmExpectation": expectation_after_move,
+            "pv": get_variation_san(board_before_move, pv, san_cache)
+        },
+        "alternativeMoves": alternative_moves
+    }
+
+    return result
+
+
+# Positions the next request of a client walking through a game most likely asks for: the position after the
+# engine's expected reply (the game line) and the positions after the alternative moves returned for the move played
+def get_prefetch_boards(analyse_request, analysis_after_move, result):
+    prefetch_boards = []
+
+    board_after_move = analyse_request.get_board_after_move()
+    for info in analysis_after_move:
+        if info.get("pv"):
+            prefetch_board = board_after_move.copy(stack=False)
+            prefetch_board.push(info["pv"][0])
+            prefetch_boards.append(prefetch_board)
+
+    board_before_move = analyse_request.get_board_before_move()
+    for alternative_move in result["alternativeMoves"]:
+        prefetch_board = board_before_move.copy(stack=False)
+        prefetch_board.push_uci(alternative_move["move"]["uci"])
+        prefetch_boards.append(prefetch_board)
+
+    return prefetch_boards
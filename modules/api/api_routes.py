@@ -1,101 +1,148 @@
+import queue
+import threading
+
 import chess
-import asyncio
+import chess.engine
 from flask import Blueprint, request
 
+from modules.api.api_analysis import API_DEPTH, API_MULTIPV, parse_analyse_request, get_cached_analysis, \
+    store_analysis, store_result, evaluate_analyse_request, get_analysis_depth
+from modules.api.game_index import game_index, parse_game_query
 from modules.core.engine.engine import initialize_uci_engine_sync, analyse_board_sync
-from modules.core.evaluation.evaluation import evaluate_move_sync
-from modules.core.score.score import get_signed_cp_score, get_expectation, get_current_score_for_grandmaster, \
-    get_principle_variation, get_cp_score_string
+from modules.core.engine.service_client import PRIORITY_BATCH
+
+# Maximum number of positions waiting to be deepened in the background
+DEEPENING_QUEUE_SIZE = 256
 
 api_routes = Blueprint('api routes', __name__, template_folder='templates')
 
+# Fens of positions answered below full depth, deepened by a background thread with its own engine. With an engine
+# service, deepening searches give way to the searches of requests.
+deepening_queue = queue.Queue(maxsize=DEEPENING_QUEUE_SIZE)
+deepening_thread = None
+deepening_lock = threading.Lock()
 
-result_cache = {}
-analysis_cache = {}
 
+# Stop an engine that failed, it may already be gone
+def quit_engine(engine):
+    try:
+        engine.quit()
+    except Exception:
+        pass
 
-@api_routes.route('/analyse')
-def analyse():
-    grandmaster_side_str = request.args.get('grandmasterSide')
-    board_before_move_fen = request.args.get('boardBeforeMoveFen')
-    board_after_move_fen = request.args.get('boardAfterMoveFen')
-    last_opponent_move_was_blunder_str = request.args.get('lastOpponentMoveWasBlunder')
-    move_played_san = request.args.get('movePlayedSan')
 
-    if not grandmaster_side_str or not board_before_move_fen or not board_after_move_fen:
-            return 'Missing url parameters', 400
+# The thread keeps running whatever goes wrong with a single position, a failed engine is replaced before the next one
+def deepen_analyses():
+    engine = None
+
+    while True:
+        fen = deepening_queue.get()
+        try:
+            if get_cached_analysis(fen)[0] is not None:
+                continue
+
+            if engine is None:
+                engine = initialize_uci_engine_sync(PRIORITY_BATCH)
+
+            board = chess.Board(fen)
+            analysis = analyse_board_sync(engine, board, multipv=API_MULTIPV, limit=chess.engine.Limit(depth=API_DEPTH))
+            store_analysis(fen, analysis)
+        except (chess.engine.EngineError, OSError) as e:
+            print("Background deepening of", fen, "failed:", type(e).__name__, e)
+            if engine is not None:
+                quit_engine(engine)
+                engine = None
+        except Exception as e:
+            print("Background deepening of", fen, "failed unexpectedly:", type(e).__name__, e)
+
 
-    if (board_before_move_fen, board_after_move_fen) in result_cache:
-        return result_cache[(board_before_move_fen, board_after_move_fen)]
+def enqueue_deepening(fen):
+    global deepening_thread
 
-    if not move_played_san or not last_opponent_move_was_blunder_str:
-        return 'Missing url parameters', 400
+    with deepening_lock:
+        if deepening_thread is None:
+            deepening_thread = threading.Thread(target=deepen_analyses, daemon=True)
+            deepening_thread.start()
 
-    grandmaster_side = chess.WHITE if grandmaster_side_str.lower() == 'white' else chess.BLACK
-    last_opponent_move_was_blunder = True if last_opponent_move_was_blunder_str.lower() == 'true' else False
+    try:
+        deepening_queue.put_nowait(fen)
+    except queue.Full:
+        pass
+
+
+# Analyse the board as deep as the request asks for within its deadline, unless the cache has a deep enough analysis
+def get_analysis(engine, analyse_request, fen, board, deadline):
+    analysis, depth = get_cached_analysis(fen, analyse_request.max_depth)
+    if analysis is not None:
+        return analysis, depth
+
+    cached_analysis, cached_depth = get_cached_analysis(fen, 0)
+
+    analysis = analyse_board_sync(engine, board, multipv=API_MULTIPV, limit=analyse_request.get_limit(deadline))
+    depth = get_analysis_depth(board, analysis, analyse_request.max_depth)
+    store_analysis(fen, analysis, depth)
+
+    if cached_analysis is not None and cached_depth > depth:
+        return cached_analysis, cached_depth
+    return analysis, depth
+
+
+@api_routes.route('/analyse')
+def analyse():
+    analyse_request, cached_result, error = parse_analyse_request(request.args)
+
+    if error is not None:
+        return error, 400
+
+    # The X-Cache header tells clients (e.g. the load test) whether the result was answered without engine
+    if cached_result is not None:
+        return cached_result, 200, {'X-Cache': 'HIT', 'X-Analysis-Depth': str(API_DEPTH)}
 
     # Initialize UCI engine
     engine = initialize_uci_engine_sync()
 
-    # Setup board before move
-    board_before_move = chess.Board()
-    board_before_move.set_fen(board_before_move_fen)
+    # Both boards are searched one after the other, so each of them gets half of the deadline
+    deadline = analyse_request.deadline / 2 if analyse_request.deadline is not None else None
+
+    # Analyse boards before and after move played
+    analysis_before_move, depth_before_move = get_analysis(engine, analyse_request,
+                                                           analyse_request.board_before_move_fen,
+                                                           analyse_request.get_board_before_move(), deadline)
+    analysis_after_move, depth_after_move = get_analysis(engine, analyse_request, analyse_request.board_after_move_fen,
+                                                         analyse_request.get_board_after_move(), deadline)
+
+    engine.quit()
 
-    # Parse turn and move played
-    turn = 'white' if board_before_move.turn == chess.WHITE else 'black'
-    move_played = board_before_move.parse_san(move_played_san)
+    result = evaluate_analyse_request(analyse_request, analysis_before_move, analysis_after_move)
+    depth = min(depth_before_move, depth_after_move)
 
-    # Analyse board before move played
-    if board_before_move_fen in analysis_cache:
-        analysis_before_move = analysis_cache[board_before_move_fen]
+    # Only full depth results are cached, shallower ones are deepened in the background
+    if depth >= API_DEPTH:
+        store_result(analyse_request, result)
     else:
-        analysis_before_move = analyse_board_sync(engine, board_before_move, multipv=2, limit=chess.engine.Limit(depth=18))
-        analysis_cache[board_before_move_fen] = analysis_before_move
+        for fen, board_depth in [(analyse_request.board_before_move_fen, depth_before_move),
+                                 (analyse_request.board_after_move_fen, depth_after_move)]:
+            if board_depth < API_DEPTH:
+                enqueue_deepening(fen)
 
-    # Analyse score and expectation before move played
-    score_before_move = get_signed_cp_score(analysis_before_move)
-    gm_pov_score_before_move = get_current_score_for_grandmaster(score_before_move, grandmaster_side)
-    expectation_before_move = get_expectation(gm_pov_score_before_move, board_before_move.ply())
+    return result, 200, {'X-Cache': 'MISS', 'X-Analysis-Depth': str(depth)}
 
-    # Setup board after move
-    board_after_move = chess.Board()
-    board_after_move.set_fen(board_after_move_fen)
 
-    # Analyse board after move played
-    if board_after_move_fen in analysis_cache:
-        analysis_after_move = analysis_cache[board_after_move_fen]
-    else:
-        analysis_after_move = analyse_board_sync(engine, board_after_move, multipv=2, limit=chess.engine.Limit(depth=18))
-        analysis_cache[board_after_move_fen] = analysis_after_move
-
-    # Analyse score and expectation after move played
-    score_after_move = get_signed_cp_score(analysis_after_move)
-    white_pov_score_after_move = get_current_score_for_grandmaster(score_after_move, chess.WHITE)
-    gm_pov_score_after_move = get_current_score_for_grandmaster(score_after_move, grandmaster_side)
-    expectation_after_move = get_expectation(gm_pov_score_after_move, board_after_move.ply())
-    pv = [move_played] + get_principle_variation(analysis_after_move)
-
-    # Analyse type of move played
-    move_played_type, alternative_moves = \
-         evaluate_move_sync(grandmaster_side, last_opponent_move_was_blunder, analysis_before_move,
-                            board_before_move.ply(), move_played, expectation_before_move, expectation_after_move,
-                            board_before_move, board_after_move)
-    
-    engine.quit()
+@api_routes.route('/games')
+def games():
+    game_query, error = parse_game_query(request.args)
+
+    if error is not None:
+        return error, 400
+
+    return game_index.get_page(game_query)
+
+
+@api_routes.route('/games/<game_id>')
+def game(game_id):
+    analyzed_game = game_index.get_game(game_id)
+
+    if analyzed_game is None:
+        return 'Game not found', 404
 
-    result = {
-        "turn": turn,
-        "evaluatedMove": {
-            "move": {"uci": move_played.uci(), "san": board_before_move.san(move_played)},
-            "moveType": move_played_type.value,
-            "signedCPScore": get_cp_score_string(white_pov_score_after_move),
-            "gmExpectation": expectation_after_move,
-            "pv": board_before_move.variation_san(pv)
-        },
-        "alternativeMoves": alternative_moves
-    }
-
-    # Store result in cache
-    result_cache[(board_before_move_fen, board_after_move_fen)] = result
-
-    return result
+    return analyzed_game
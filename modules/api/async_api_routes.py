@@ -0,0 +1,366 @@
+import asyncio
+import collections
+import functools
+import json
+
+import chess
+import chess.engine
+from aiohttp import web
+
+from modules.api.api_analysis import API_DEPTH, API_MULTIPV, parse_analyse_request, get_cached_analysis, \
+    store_analysis, store_result, evaluate_analyse_request, get_prefetch_boards, get_analysis_depth
+from modules.api.bundle_index import normalize_fen
+from modules.api.game_index import game_index, parse_game_query
+from modules.core.engine.engine import EnginePool, analyse_board, is_engine_service_used
+from modules.core.engine.service_client import PRIORITY_INTERACTIVE
+
+# Seconds after which an analyse request is aborted and its engine searches are stopped
+REQUEST_TIMEOUT = 30
+
+# Seconds an engine search with a client deadline may take beyond it before its cached analysis is answered instead
+DEADLINE_GRACE = 0.2
+
+# Minimum depth both boards have to be analysed with before the first provisional result is streamed
+STREAM_FIRST_DEPTH = 4
+
+# Maximum number of positions waiting to be analysed in the background
+BACKGROUND_QUEUE_SIZE = 256
+
+async_api_routes = web.RouteTableDef()
+
+# Engine searches currently running, shared by all requests waiting for the same board
+pending_analyses = {}
+
+# Positions to analyse to full depth with idle engines: deepening of shallow answers first, then prefetches
+background_boards = collections.deque(maxlen=BACKGROUND_QUEUE_SIZE)
+
+
+class PendingAnalysis:
+    def __init__(self, task, is_prefetch=False):
+        self.task = task
+        self.waiters = 0
+        self.is_prefetch = is_prefetch
+
+
+# Prefetches only use idle engines. A request that finds no idle engine takes over the engine of a prefetch nobody
+# is waiting for.
+def cancel_prefetch():
+    for pending_analysis in pending_analyses.values():
+        if pending_analysis.is_prefetch and pending_analysis.waiters == 0 and not pending_analysis.task.done():
+            pending_analysis.task.cancel()
+            return
+
+
+# Store the prefetched analysis and continue with the remaining positions on the engine that became idle
+def finish_prefetch(engine_pool, fen, pending_analysis, task):
+    if pending_analysis.waiters == 0 and pending_analyses.get(fen) is pending_analysis:
+        del pending_analyses[fen]
+
+    if task.cancelled() or task.exception() is not None:
+        return
+
+    store_analysis(fen, task.result())
+    start_prefetches(engine_pool)
+
+
+# Analyse queued positions to full depth in the background, so that the next request for them is a cache hit.
+# Positions that find no idle engine are analysed once a prefetch finishes.
+def start_prefetches(engine_pool):
+    idle_engines = engine_pool.idle_engines.qsize()
+
+    while background_boards and idle_engines > 0:
+        board = background_boards.popleft()
+        fen = normalize_fen(board.fen())
+        if get_cached_analysis(fen)[0] is not None or fen in pending_analyses:
+            continue
+
+        task = asyncio.ensure_future(analyse_board(engine_pool, board, multipv=API_MULTIPV,
+                                                   limit=chess.engine.Limit(depth=API_DEPTH)))
+        pending_analysis = PendingAnalysis(task, is_prefetch=True)
+        pending_analyses[fen] = pending_analysis
+        task.add_done_callback(functools.partial(finish_prefetch, engine_pool, fen, pending_analysis))
+        idle_engines -= 1
+
+
+# Deepening the answer of the client replaces shallow cache entries before speculative prefetches are analysed
+def enqueue_background_analyses(engine_pool, boards, is_deepening=False):
+    if is_deepening:
+        background_boards.extendleft(reversed(boards))
+    else:
+        background_boards.extend(boards)
+
+    start_prefetches(engine_pool)
+
+
+# Analyse the board with the given fen once, even if several requests ask for it at the same time.
+# The search is only stopped if every request waiting for it was cancelled. Returns the analysis and its depth.
+async def get_analysis(engine_pool, fen, board, analyse_request=None):
+    min_depth = analyse_request.max_depth if analyse_request is not None else API_DEPTH
+    analysis, depth = get_cached_analysis(fen, min_depth)
+    if analysis is not None:
+        return analysis, depth
+
+    if analyse_request is not None and analyse_request.is_bounded():
+        return await get_bounded_analysis(engine_pool, fen, board, analyse_request)
+
+    fen = normalize_fen(fen)
+    pending_analysis = pending_analyses.get(fen)
+    if pending_analysis is None:
+        if engine_pool.idle_engines.empty():
+            cancel_prefetch()
+
+        task = asyncio.ensure_future(analyse_board(engine_pool, board, multipv=API_MULTIPV,
+                                                   limit=chess.engine.Limit(depth=API_DEPTH)))
+        pending_analysis = PendingAnalysis(task)
+        pending_analyses[fen] = pending_analysis
+
+    # A prefetch a request waits for is no longer speculative
+    pending_analysis.is_prefetch = False
+    pending_analysis.waiters += 1
+    try:
+        analysis = await asyncio.shield(pending_analysis.task)
+    finally:
+        pending_analysis.waiters -= 1
+        if pending_analysis.waiters == 0 and not pending_analysis.task.done():
+            # No request is interested in the result anymore
+            pending_analysis.task.cancel()
+        if (pending_analysis.waiters == 0 or pending_analysis.task.done()) \
+                and pending_analyses.get(fen) is pending_analysis:
+            del pending_analyses[fen]
+
+    store_analysis(fen, analysis)
+    return analysis, API_DEPTH
+
+
+# Search the board only as deep as the client asked for and as long as its deadline allows. The deadline covers the
+# wait for an idle engine as well as the search, which gets the time left once it has an engine. A shallower search
+# than an already cached analysis, or a deadline that expired, is answered with the cached analysis.
+async def get_bounded_analysis(engine_pool, fen, board, analyse_request):
+    cached_analysis, cached_depth = get_cached_analysis(fen, 0)
+
+    if engine_pool.idle_engines.empty():
+        cancel_prefetch()
+
+    if analyse_request.deadline is None:
+        analysis = await analyse_board(engine_pool, board, multipv=API_MULTIPV, limit=analyse_request.get_limit())
+    else:
+        loop = asyncio.get_running_loop()
+        expires = loop.time() + analyse_request.deadline
+
+        async def search_until_deadline():
+            async with engine_pool.acquire() as engine:
+                return await analyse_board(engine, board, multipv=API_MULTIPV,
+                                           limit=analyse_request.get_limit(max(expires - loop.time(), 0.001)))
+
+        # The engine needs a moment to send its best move after its time limit
+        try:
+            analysis = await asyncio.wait_for(search_until_deadline(),
+                                              timeout=analyse_request.deadline + DEADLINE_GRACE)
+        except asyncio.TimeoutError:
+            if cached_analysis is None:
+                raise
+            return cached_analysis, cached_depth
+
+    depth = get_analysis_depth(board, analysis, analyse_request.max_depth)
+    store_analysis(fen, analysis, depth)
+
+    if cached_analysis is not None and cached_depth > depth:
+        return cached_analysis, cached_depth
+    return analysis, depth
+
+
+@async_api_routes.get('/analyse')
+async def analyse(request):
+    analyse_request, cached_result, error = parse_analyse_request(request.query)
+
+    if error is not None:
+        return web.Response(text=error, status=400)
+
+    # The X-Cache header tells clients (e.g. the load test) whether the result was answered without engine
+    if cached_result is not None:
+        return web.json_response(cached_result, headers={'X-Cache': 'HIT', 'X-Analysis-Depth': str(API_DEPTH)})
+
+    engine_pool = request.app['engine_pool']
+    board_before_move = analyse_request.get_board_before_move()
+    board_after_move = analyse_request.get_board_after_move()
+
+    # Analyse boards before and after move played on separate engines if available.
+    # If the client disconnects, aiohttp cancels this handler which also stops the engine searches.
+    try:
+        (analysis_before_move, depth_before_move), (analysis_after_move, depth_after_move) = \
+            await asyncio.wait_for(asyncio.gather(
+                get_analysis(engine_pool, analyse_request.board_before_move_fen, board_before_move, analyse_request),
+                get_analysis(engine_pool, analyse_request.board_after_move_fen, board_after_move, analyse_request)
+            ), timeout=REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        return web.Response(text='Analysis timed out', status=504)
+    except chess.engine.EngineError:
+        # No engine of the pool is left, the search failed on every restarted engine or the engine of a search with
+        # deadline died
+        return web.Response(text='Engine unavailable', status=503)
+
+    result = evaluate_analyse_request(analyse_request, analysis_before_move, analysis_after_move)
+    depth = min(depth_before_move, depth_after_move)
+
+    # Only full depth results are cached, shallower ones are deepened in the background
+    if depth >= API_DEPTH:
+        store_result(analyse_request, result)
+    else:
+        enqueue_background_analyses(engine_pool, [board for board, board_depth in [
+            (board_before_move, depth_before_move), (board_after_move, depth_after_move)] if board_depth < API_DEPTH],
+                                    is_deepening=True)
+
+    if request.app['prefetch']:
+        enqueue_background_analyses(engine_pool, get_prefetch_boards(analyse_request, analysis_after_move, result))
+
+    return web.json_response(result, headers={'X-Cache': 'MISS', 'X-Analysis-Depth': str(depth)})
+
+
+# Put a snapshot of the analysis of the board into the queue every time the engine completes a depth
+async def stream_board_analysis(engine_pool, fen, board, board_index, snapshots):
+    analysis, _ = get_cached_analysis(fen)
+
+    # Positions already being searched (e.g. prefetched) are not searched a second time, only their final
+    # analysis is streamed. The engine service does not support iterative analyses, so it only streams final ones too.
+    if analysis is None and (normalize_fen(fen) in pending_analyses or is_engine_service_used()):
+        try:
+            analysis, _ = await get_analysis(engine_pool, fen, board)
+        except chess.engine.EngineError:
+            await snapshots.put((board_index, None, None, True))
+            return
+
+    if analysis is None:
+        if engine_pool.idle_engines.empty():
+            cancel_prefetch()
+
+        try:
+            async with engine_pool.acquire() as engine:
+                with await engine.analysis(board, limit=chess.engine.Limit(depth=API_DEPTH),
+                                           multipv=API_MULTIPV) as analysis_result:
+                    multipv_lines = min(API_MULTIPV, board.legal_moves.count())
+
+                    # The engine sends the multipv lines of a depth in order, so a depth is completed by its last line
+                    async for info in analysis_result:
+                        if info.get("multipv", 1) == multipv_lines and "pv" in info and "score" in info:
+                            snapshot = [dict(line) for line in analysis_result.multipv]
+                            await snapshots.put((board_index, info["depth"], snapshot, False))
+
+                    analysis = [dict(line) for line in analysis_result.multipv]
+        except chess.engine.EngineError:
+            # Let the stream know that no final analysis will follow
+            await snapshots.put((board_index, None, None, True))
+            return
+
+        store_analysis(fen, analysis)
+
+    await snapshots.put((board_index, API_DEPTH, analysis, True))
+
+
+def get_server_sent_event(depth, is_final, result):
+    return ('event: analysis\ndata: ' + json.dumps({"depth": depth, "final": is_final, "result": result}) + '\n\n') \
+        .encode('utf-8')
+
+
+# Stream provisional results as server-sent events while the engine deepens its search, followed by the final result
+@async_api_routes.get('/analyse/stream')
+async def analyse_stream(request):
+    analyse_request, cached_result, error = parse_analyse_request(request.query)
+
+    if error is not None:
+        return web.Response(text=error, status=400)
+
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    await response.prepare(request)
+
+    if cached_result is not None:
+        await response.write(get_server_sent_event(API_DEPTH, True, cached_result))
+        await response.write_eof()
+        return response
+
+    engine_pool = request.app['engine_pool']
+    snapshots = asyncio.Queue()
+    producers = [
+        asyncio.ensure_future(stream_board_analysis(engine_pool, analyse_request.board_before_move_fen,
+                                                    analyse_request.get_board_before_move(), 0, snapshots)),
+        asyncio.ensure_future(stream_board_analysis(engine_pool, analyse_request.board_after_move_fen,
+                                                    analyse_request.get_board_after_move(), 1, snapshots))
+    ]
+
+    async def stream_results():
+        latest_snapshots = [None, None]
+        last_streamed_depth = 0
+
+        while True:
+            board_index, depth, analysis, is_final = await snapshots.get()
+            if analysis is None:
+                await response.write(b'event: error\ndata: Engine analysis failed\n\n')
+                return
+
+            latest_snapshots[board_index] = (depth, analysis, is_final)
+
+            if None in latest_snapshots:
+                continue
+
+            depth = min(snapshot[0] for snapshot in latest_snapshots)
+            is_final = all(snapshot[2] for snapshot in latest_snapshots)
+
+            if is_final or (depth > last_streamed_depth and depth >= STREAM_FIRST_DEPTH):
+                result = evaluate_analyse_request(analyse_request, latest_snapshots[0][1], latest_snapshots[1][1])
+                await response.write(get_server_sent_event(depth, is_final, result))
+                last_streamed_depth = depth
+
+            if is_final:
+                store_result(analyse_request, result)
+
+                if request.app['prefetch']:
+                    enqueue_background_analyses(engine_pool, get_prefetch_boards(analyse_request,
+                                                                                 latest_snapshots[1][1], result))
+                return
+
+    # Cancelling the producers (client disconnected, timeout or failed search) stops their engine searches
+    try:
+        await asyncio.wait_for(stream_results(), timeout=REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        for producer in producers:
+            producer.cancel()
+
+    await response.write_eof()
+    return response
+
+
+@async_api_routes.get('/games')
+async def games(request):
+    game_query, error = parse_game_query(request.query)
+
+    if error is not None:
+        return web.Response(text=error, status=400)
+
+    return web.json_response(game_index.get_page(game_query))
+
+
+@async_api_routes.get('/games/{game_id}')
+async def game(request):
+    analyzed_game = game_index.get_game(request.match_info['game_id'])
+
+    if analyzed_game is None:
+        return web.Response(text='Game not found', status=404)
+
+    return web.json_response(analyzed_game)
+
+
+def create_async_api_app(engines=1, prefetch=True):
+    app = web.Application()
+    app.add_routes(async_api_routes)
+    app['prefetch'] = prefetch
+
+    async def engine_pool_context(app):
+        engine_pool = EnginePool(engines, priority=PRIORITY_INTERACTIVE)
+        await engine_pool.initialize()
+        app['engine_pool'] = engine_pool
+        yield
+        await engine_pool.quit()
+
+    app.cleanup_ctx.append(engine_pool_context)
+    return app
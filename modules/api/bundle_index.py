@@ -0,0 +1,132 @@
+import copy
+import glob
+import gzip
+import io
+import json
+import os
+
+import chess
+import chess.pgn
+
+from modules.core.bundle.bundle import is_sharded_bundle, read_manifest
+
+GZIP_MAGIC_NUMBER = b'\x1f\x8b'
+
+
+# Normalize a fen so that equal positions sent by different clients (e.g. with an en passant square that can
+# not be captured) map to the same key
+def normalize_fen(fen):
+    return chess.Board(fen).fen()
+
+
+def read_bundle(bundle_path):
+    with open(bundle_path, 'rb') as bundle_file:
+        is_gzipped = bundle_file.read(2) == GZIP_MAGIC_NUMBER
+
+    if is_gzipped:
+        with gzip.open(bundle_path, 'rt') as bundle_file:
+            return json.load(bundle_file)
+
+    with open(bundle_path, 'r') as bundle_file:
+        return json.load(bundle_file)
+
+
+# Get the bundle files of a bundle, a sharded bundle (following its manifest) or a directory of bundles and sharded
+# bundles
+def get_bundle_files(bundle_path):
+    if is_sharded_bundle(bundle_path):
+        return [os.path.join(bundle_path, shard['jsonFile']) for shard in read_manifest(bundle_path)['shards']]
+
+    if os.path.isdir(bundle_path):
+        bundle_files = []
+        for path in sorted(glob.glob(os.path.join(bundle_path, '*'))):
+            if path.endswith('.json') or is_sharded_bundle(path):
+                bundle_files += get_bundle_files(path)
+        return bundle_files
+
+    return [bundle_path]
+
+
+class BundleIndexEntry:
+    __slots__ = ['result', 'grandmaster_side', 'last_opponent_move_was_blunder']
+
+    def __init__(self, result, grandmaster_side, last_opponent_move_was_blunder):
+        self.result = result
+        self.grandmaster_side = grandmaster_side
+        self.last_opponent_move_was_blunder = last_opponent_move_was_blunder
+
+
+# Read-only lookup of the analyse results already contained in analyzed games bundles keyed by the
+# (normalized) fens of the boards before and after the move
+class BundleIndex:
+    def __init__(self):
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self, bundle_path):
+        for bundle_file_path in get_bundle_files(bundle_path):
+            analyzed_games = read_bundle(bundle_file_path)
+            for analyzed_game in analyzed_games:
+                self.add_analyzed_game(analyzed_game)
+
+            print('Loaded analyzed games bundle', bundle_file_path,
+                  '(' + str(len(self.entries)) + ' positions indexed)')
+
+    def add_analyzed_game(self, analyzed_game):
+        game_analysis = analyzed_game['gameAnalysis']
+        grandmaster_side = chess.BLACK if game_analysis['grandmasterSide'] == 'black' else chess.WHITE
+
+        board = chess.pgn.read_game(io.StringIO(analyzed_game['pgn'])).board()
+        last_opponent_move_was_blunder = False
+
+        for analyzed_move in game_analysis['analyzedMoves']:
+            actual_move = analyzed_move['actualMove']
+            move = chess.Move.from_uci(actual_move['move']['uci'])
+
+            board_before_move_fen = board.fen()
+            board.push(move)
+
+            # Book moves are not evaluated, so the API has to analyse them itself
+            if analyzed_move['gamePhase'] != 'opening':
+                key = (board_before_move_fen, board.fen())
+                if key not in self.entries:
+                    self.entries[key] = BundleIndexEntry({
+                        "turn": analyzed_move['turn'],
+                        "evaluatedMove": actual_move,
+                        "alternativeMoves": analyzed_move['alternativeMoves']
+                    }, grandmaster_side, last_opponent_move_was_blunder)
+
+                last_opponent_move_was_blunder = actual_move['moveType'] == 'blunder'
+
+    # Get the result for an analyse request from the point of view of the requested grandmaster side
+    def get_result(self, analyse_request):
+        try:
+            key = (normalize_fen(analyse_request.board_before_move_fen),
+                   normalize_fen(analyse_request.board_after_move_fen))
+        except ValueError:
+            return None
+
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        flip_expectations = entry.grandmaster_side != analyse_request.grandmaster_side
+        swap_best_move_types = entry.last_opponent_move_was_blunder != analyse_request.last_opponent_move_was_blunder
+
+        if not flip_expectations and not swap_best_move_types:
+            return entry.result
+
+        result = copy.deepcopy(entry.result)
+        for evaluated_move in [result['evaluatedMove']] + result['alternativeMoves']:
+            if flip_expectations:
+                evaluated_move['gmExpectation'] = 1 - evaluated_move['gmExpectation']
+
+            # A best move is a game changer if the last opponent move was a blunder (see evaluate_move_type)
+            if swap_best_move_types and evaluated_move['moveType'] == 'best':
+                evaluated_move['moveType'] = 'gameChanger'
+            elif swap_best_move_types and evaluated_move['moveType'] == 'gameChanger':
+                evaluated_move['moveType'] = 'best'
+
+        return result
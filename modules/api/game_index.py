@@ -0,0 +1,171 @@
+import bisect
+import re
+
+from modules.api.bundle_index import get_bundle_files, read_bundle
+from modules.core.bundle.bundle import get_manifest_game_entry
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Move types whose games can be looked up, e.g. to find games with brilliant moves
+SEARCHABLE_MOVE_TYPES = ['critical', 'brilliant', 'gameChanger']
+
+
+# Key of a player name that matches the names of the pgn ("Carlsen,Magnus") as well as the annotated full names
+# ("Carlsen, Magnus" or "Magnus Carlsen")
+def get_player_key(name):
+    return ' '.join(sorted(re.findall(r'\w+', name.casefold())))
+
+
+# Sortable key of a pgn date (unknown parts like in "1992.??.??" count as 00) or of a date given by clients
+# ("2019", "2019-07" or "2019.07.12"), whose missing parts are filled with the given value
+def get_date_key(date, fill='00'):
+    parts = [part if part.isdigit() else '00' for part in re.split(r'[.\-]', date)]
+    return '.'.join(parts + [fill] * (3 - len(parts)))
+
+
+def contains_position(sorted_positions, position):
+    i = bisect.bisect_left(sorted_positions, position)
+    return i < len(sorted_positions) and sorted_positions[i] == position
+
+
+class GameQuery:
+    def __init__(self, player=None, eco=None, date_from=None, date_to=None, move_type=None, offset=0,
+                 limit=DEFAULT_PAGE_SIZE):
+        self.player = player
+        self.eco = eco
+        self.date_from = date_from
+        self.date_to = date_to
+        self.move_type = move_type
+        self.offset = offset
+        self.limit = limit
+
+
+# Parse the url parameters of a games request. Returns the parsed query and an error message.
+def parse_game_query(args):
+    try:
+        offset = int(args.get('offset', 0))
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return None, 'Invalid url parameters'
+
+    if offset < 0 or limit < 1 or limit > MAX_PAGE_SIZE:
+        return None, 'Invalid url parameters'
+
+    date_from = args.get('from')
+    date_to = args.get('to')
+    for date in [date_from, date_to]:
+        if date and not re.fullmatch(r'\d{4}([.\-]\d{2}){0,2}', date):
+            return None, 'Invalid url parameters'
+
+    move_type = args.get('moveType')
+    if move_type and move_type not in SEARCHABLE_MOVE_TYPES:
+        return None, 'Invalid url parameters'
+
+    return GameQuery(args.get('player'), args.get('eco'), get_date_key(date_from) if date_from else None,
+                     get_date_key(date_to, '99') if date_to else None, move_type, offset, limit), None
+
+
+# Analyzed games loaded from bundles at startup, looked up by id or through secondary indexes by player, opening,
+# date and the special move types they contain. Every index maps to the positions of the games in load order, so
+# results of all lookups are ordered the same way.
+class GameIndex:
+    def __init__(self):
+        self.games = []
+        self.summaries = []
+        self.positions = {}
+        self.players = {}
+        self.ecos = {}
+        self.move_types = {}
+        self.date_keys = []
+        # Date keys and positions of all games sorted by date
+        self.dates = []
+
+    def __len__(self):
+        return len(self.games)
+
+    def load(self, bundle_path):
+        for bundle_file_path in get_bundle_files(bundle_path):
+            for analyzed_game in read_bundle(bundle_file_path):
+                self.add_analyzed_game(analyzed_game)
+
+            print('Loaded analyzed games', bundle_file_path, '(' + str(len(self.games)) + ' games indexed)')
+
+        self.dates.sort()
+
+    def add_analyzed_game(self, analyzed_game):
+        # The same game contained in several bundles is only served once
+        if analyzed_game['id'] in self.positions:
+            return
+
+        position = len(self.games)
+        self.games.append(analyzed_game)
+        self.summaries.append(get_manifest_game_entry(analyzed_game))
+        self.positions[analyzed_game['id']] = position
+
+        for player_key in {get_player_key(analyzed_game['whitePlayer']), get_player_key(analyzed_game['blackPlayer'])}:
+            self.players.setdefault(player_key, []).append(position)
+
+        opening = analyzed_game['gameAnalysis']['opening']
+        if opening is not None:
+            self.ecos.setdefault(opening['eco'].upper(), []).append(position)
+
+        move_types = {analyzed_move['actualMove']['moveType']
+                      for analyzed_move in analyzed_game['gameAnalysis']['analyzedMoves']}
+        for move_type in move_types.intersection(SEARCHABLE_MOVE_TYPES):
+            self.move_types.setdefault(move_type, []).append(position)
+
+        date_key = get_date_key(analyzed_game['gameInfo']['date'])
+        self.date_keys.append(date_key)
+        self.dates.append((date_key, position))
+
+    def get_game(self, game_id):
+        position = self.positions.get(game_id)
+        return self.games[position] if position is not None else None
+
+    def get_date_range_positions(self, date_from, date_to):
+        start = bisect.bisect_left(self.dates, (date_from,)) if date_from is not None else 0
+        end = bisect.bisect_right(self.dates, (date_to, len(self.games))) if date_to is not None else len(self.dates)
+        return sorted(position for _, position in self.dates[start:end])
+
+    def is_in_date_range(self, position, date_from, date_to):
+        date_key = self.date_keys[position]
+        return (date_from is None or date_key >= date_from) and (date_to is None or date_key <= date_to)
+
+    # Get the positions of the games matching all filters of the query. Only the smallest index result is iterated,
+    # the other filters are checked per game (the index results are sorted), so selective filters keep lookups fast.
+    def find_positions(self, game_query):
+        candidates = []
+        if game_query.player:
+            candidates.append(self.players.get(get_player_key(game_query.player), []))
+        if game_query.eco:
+            candidates.append(self.ecos.get(game_query.eco.upper(), []))
+        if game_query.move_type:
+            candidates.append(self.move_types.get(game_query.move_type, []))
+
+        has_date_range = game_query.date_from is not None or game_query.date_to is not None
+        if not candidates:
+            if has_date_range:
+                return self.get_date_range_positions(game_query.date_from, game_query.date_to)
+            return range(len(self.games))
+
+        candidates.sort(key=len)
+        return [position for position in candidates[0]
+                if all(contains_position(positions, position) for positions in candidates[1:])
+                and (not has_date_range or self.is_in_date_range(position, game_query.date_from, game_query.date_to))]
+
+    # Get one page of the summaries of the games matching the query
+    def get_page(self, game_query):
+        positions = self.find_positions(game_query)
+        page_positions = positions[game_query.offset:game_query.offset + game_query.limit]
+
+        return {
+            "total": len(positions),
+            "offset": game_query.offset,
+            "limit": game_query.limit,
+            "games": [self.summaries[position] for position in page_positions],
+        }
+
+
+# Analyzed games served by the games routes
+game_index = GameIndex()
@@ -0,0 +1,187 @@
+import io
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import chess
+import chess.pgn
+
+from modules.api.bundle_index import get_bundle_files, read_bundle
+
+LOAD_TEST_REQUEST_TIMEOUT = 120
+API_STARTUP_TIMEOUT = 60
+LATENCY_PERCENTILES = [50, 90, 95, 99]
+
+# Hosts of load test urls a started API can be reached at, it listens on all IPv4 addresses of this machine
+LOCAL_HOSTS = ['localhost', '127.0.0.1']
+
+
+# Get the parameters of an analyse request for every evaluated (non-opening) move of the analyzed games
+def get_analyse_requests(analyzed_games):
+    analyse_requests = []
+
+    for analyzed_game in analyzed_games:
+        game_analysis = analyzed_game['gameAnalysis']
+        board = chess.pgn.read_game(io.StringIO(analyzed_game['pgn'])).board()
+        last_opponent_move_was_blunder = False
+
+        for analyzed_move in game_analysis['analyzedMoves']:
+            actual_move = analyzed_move['actualMove']
+            board_before_move_fen = board.fen()
+            board.push_uci(actual_move['move']['uci'])
+
+            if analyzed_move['gamePhase'] != 'opening':
+                analyse_requests.append({
+                    'grandmasterSide': game_analysis['grandmasterSide'],
+                    'boardBeforeMoveFen': board_before_move_fen,
+                    'boardAfterMoveFen': board.fen(),
+                    'lastOpponentMoveWasBlunder': 'true' if last_opponent_move_was_blunder else 'false',
+                    'movePlayedSan': actual_move['move']['san'],
+                })
+
+                last_opponent_move_was_blunder = actual_move['moveType'] == 'blunder'
+
+    return analyse_requests
+
+
+def read_analyse_requests(bundle_paths):
+    analyse_requests = []
+    for bundle_path in bundle_paths:
+        for bundle_file_path in get_bundle_files(bundle_path):
+            analyse_requests += get_analyse_requests(read_bundle(bundle_file_path))
+    return analyse_requests
+
+
+# Build the request mix: with the given share, a request repeats a request sent before (like clients stepping back
+# through a game or several clients looking at the same game), otherwise it is the next new position in game order
+def get_request_mix(analyse_requests, request_count, repeat_share, seed=0):
+    rng = random.Random(seed)
+    request_mix = []
+    next_new_request = 0
+
+    for _ in range(request_count):
+        is_repeat = len(request_mix) > 0 \
+            and (rng.random() < repeat_share or next_new_request == len(analyse_requests))
+        if is_repeat:
+            request_mix.append((rng.choice(request_mix)[0], True))
+        else:
+            request_mix.append((analyse_requests[next_new_request], False))
+            next_new_request += 1
+
+    return request_mix
+
+
+class LoadTestResult:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.status_codes = {}
+        self.errors = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def add(self, latency, status_code, cache_status=None, error=None):
+        with self.lock:
+            self.latencies.append(latency)
+            self.status_codes[str(status_code)] = self.status_codes.get(str(status_code), 0) + 1
+
+            if error is not None:
+                self.errors[error] = self.errors.get(error, 0) + 1
+            elif cache_status == 'HIT':
+                self.cache_hits += 1
+            elif cache_status == 'MISS':
+                self.cache_misses += 1
+
+
+def send_analyse_request(url, analyse_request, result):
+    request_url = url.rstrip('/') + '/analyse?' + urllib.parse.urlencode(analyse_request)
+    start = time.perf_counter()
+
+    try:
+        with urllib.request.urlopen(request_url, timeout=LOAD_TEST_REQUEST_TIMEOUT) as response:
+            response.read()
+            result.add(time.perf_counter() - start, response.status, response.headers.get('X-Cache'))
+    except urllib.error.HTTPError as e:
+        result.add(time.perf_counter() - start, e.code, error='HTTP ' + str(e.code))
+    except (urllib.error.URLError, OSError) as e:
+        result.add(time.perf_counter() - start, 'failed', error=type(e).__name__)
+
+
+# Nearest-rank percentile of the sorted latencies
+def get_percentile(sorted_latencies, percentile):
+    if not sorted_latencies:
+        return None
+    rank = max(1, int(round(percentile / 100 * len(sorted_latencies))))
+    return sorted_latencies[rank - 1]
+
+
+def get_load_test_report(result, request_mix, concurrency, duration):
+    sorted_latencies = sorted(result.latencies)
+    request_count = len(request_mix)
+    error_count = sum(result.errors.values())
+    answered_count = result.cache_hits + result.cache_misses
+
+    latency_ms = {"p" + str(percentile): round(get_percentile(sorted_latencies, percentile) * 1000, 2)
+                  for percentile in LATENCY_PERCENTILES} if sorted_latencies else {}
+    if sorted_latencies:
+        latency_ms["mean"] = round(sum(sorted_latencies) / len(sorted_latencies) * 1000, 2)
+        latency_ms["max"] = round(sorted_latencies[-1] * 1000, 2)
+
+    return {
+        "requests": request_count,
+        "concurrency": concurrency,
+        "durationSeconds": round(duration, 3),
+        "throughputPerSecond": round(request_count / duration, 2) if duration > 0 else None,
+        "repeatedShare": round(sum(1 for _, is_repeat in request_mix if is_repeat) / request_count, 3)
+        if request_count else None,
+        "cacheHits": result.cache_hits,
+        "cacheMisses": result.cache_misses,
+        "hitRatio": round(result.cache_hits / answered_count, 3) if answered_count else None,
+        "errorRate": round(error_count / request_count, 3) if request_count else None,
+        "errors": result.errors,
+        "statusCodes": result.status_codes,
+        "latencyMs": latency_ms,
+    }
+
+
+def run_load_test(url, request_mix, concurrency):
+    result = LoadTestResult()
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for analyse_request, _ in request_mix:
+            executor.submit(send_analyse_request, url, analyse_request, result)
+
+    duration = time.perf_counter() - start
+    return get_load_test_report(result, request_mix, concurrency, duration)
+
+
+# Stops waiting early if the given process exits
+def wait_for_port(host, port, timeout=API_STARTUP_TIMEOUT, process=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and (process is None or process.poll() is None):
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+# Start the api command of this program in a subprocess, e.g. with the scripted engine (ENGINE_PATH=scripted). The
+# port of the load test url overrides a port of the api arguments.
+def start_api(main_path, api_args, env, host, port):
+    api_process = subprocess.Popen([sys.executable, main_path, 'api'] + api_args + ['--port', str(port)], env=env)
+
+    if not wait_for_port(host, port, process=api_process):
+        api_process.terminate()
+        raise RuntimeError('API did not start listening on ' + host + ':' + str(port))
+
+    return api_process
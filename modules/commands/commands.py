@@ -1,201 +1,505 @@
 import os
 import asyncio
-import chess.pgn
-import chess.engine
 import click
+import concurrent.futures
+import functools
 import json
 import pathlib
 import gzip
-
-from flask import Flask
-from waitress import serve
-
-from modules.api.api_routes import api_routes
-from modules.core.endgame.endgame import is_in_endgame
-from modules.core.engine.engine import initialize_uci_engine, analyse_board
-from modules.core.opening.opening import OpeningECOReader
-from modules.core.output.output import AnalyzedGame, save_merged_analyzed_games_results
-from modules.core.pgn.pgn import is_game_valid, preprocess_game
-from modules.core.sides.sides import get_grandmaster_side, is_grandmasters_turn, normalize_player_name
-from modules.core.score.score import get_signed_cp_score, get_current_score_for_grandmaster, \
-    get_expectation, get_cp_score_string, get_principle_variation
-from modules.core.evaluation.evaluation import evaluate_move, MoveType
-from modules.core.statistics.statistics import plot_cp_scores, plot_expectations
-from modules.core.info.info import print_game_info
-from modules.core.player.player import get_full_player_name, get_player_elo_ratings_for_game
+import shlex
+import sys
+import time
+import urllib.parse
+
+from modules.core.bundle.bundle import SHARD_BY_OPTIONS, DEFAULT_MAX_SHARD_BYTES
+from modules.core.engine.engine import SEARCH_TIMEOUT, DEFAULT_ENGINE_SERVICE_SOCKET, SERVICE_CACHE_SIZE
+
+# Heavy dependencies (pandas, matplotlib, flask, mechanize, aiohttp, ...) are imported inside the commands that need
+# them, so that every invocation only pays for the imports of its own subcommand.
+
+
+# Select the games to read by their headers in the index of the pgn file, then parse only those games
+def read_selected_games(grandmaster, games, opening_reader, workers=1, years=None, event=None):
+    from modules.core.analysis.analysis import read_indexed_games
+    from modules.core.pgn_index.pgn_index import load_pgn_index, filter_pgn_index
+
+    index_entries = load_pgn_index(games)
+    selected_entries = filter_pgn_index(index_entries, grandmaster, years, event)
+    print("Selected", len(selected_entries), "of", len(index_entries), "games of", games)
+    return read_indexed_games(grandmaster, games, selected_entries, opening_reader, workers)
+
+
+# Analyze all games of a pgn file and save the merged analysis output file once they are done. Returns the run report
+# of the file.
+#
+# With a deadline, the games are analyzed one after the other and the search settings of every game are chosen by the
+# cost model, so that the remaining games are predicted to finish in time.
+#
+# With triage, the games are screened at shallow depth first and only the top games or the games whose puzzle value
+# reaches the threshold are analyzed.
+async def analyze_games_file(engine_pool, output_writer, opening_reader, endgame_tablebase, grandmaster, games,
+                             statistics, pv_plies, workers=1, years=None, event=None, annotation_executor=None,
+                             deadline=None, cost_model=None, triage_top=None, triage_threshold=None):
+    from datetime import datetime
+    from modules.core.analysis.analysis import plan_positions, schedule_positions, analyze_game, \
+        FULL_SEARCH_SETTINGS
+    from modules.core.cost.cost import choose_search_settings, get_settings_description
+    from modules.core.engine.engine import EngineSearchError
+    from modules.core.info.info import Progress, format_duration
+    from modules.core.output.output import save_merged_analyzed_games_results, save_quarantined_games, \
+        save_annotated_analyzed_games_results
+    from modules.core.sides.sides import normalize_player_name, get_grandmaster_side
+
+    if statistics:
+        from modules.core.statistics.statistics import plot_cp_scores, plot_expectations
+
+    if annotation_executor is not None:
+        from modules.core.player.player import get_game_player_annotation
+
+    normalized_player_name = normalize_player_name(grandmaster)
+    analyzed_games = []
+    quarantined_games = []
+    run_report = RunReport()
+
+    games_to_analyze = read_selected_games(grandmaster, games, opening_reader, workers, years, event)
+    if triage_top is not None or triage_threshold is not None:
+        from modules.core.triage.triage import triage_games
+        games_to_analyze, run_report.screening_requests, run_report.screening_searches = await triage_games(
+            engine_pool, grandmaster, games_to_analyze, triage_top, triage_threshold, endgame_tablebase)
+
+    # Look up the full player names and elo ratings of all games in the background while the engines analyze them
+    annotation_futures = []
+    if annotation_executor is not None:
+        loop = asyncio.get_running_loop()
+        annotation_futures = [loop.run_in_executor(annotation_executor, get_game_player_annotation,
+                                                   game_to_analyze.game,
+                                                   get_grandmaster_side(grandmaster, game_to_analyze.game))
+                              for game_to_analyze in games_to_analyze]
+    annotated_games_futures = []
+
+    # Search every unique position of all games once before classifying the moves of the single games
+    planned_positions, run_report.position_count = plan_positions(games_to_analyze)
+    run_report.unique_position_count = len(planned_positions)
+    print()
+    print("Planned", len(planned_positions), "unique positions for", run_report.position_count, "positions in",
+          len(games_to_analyze), "games")
+    if deadline is None:
+        run_report.planning_requests = await schedule_positions(engine_pool, planned_positions, endgame_tablebase)
+    else:
+        print("Analyzing the games one after the other to finish by", deadline.isoformat(sep=" ", timespec="minutes"))
+
+    game_plies = [game_to_analyze.count_plies() for game_to_analyze in games_to_analyze]
+    progress = Progress(sum(plies for plies, _ in game_plies))
+    reduced_games = []
+
+    for i, game_to_analyze in enumerate(games_to_analyze):
+        headers = game_to_analyze.game.headers
+        game_name = str(headers.get("White")) + " vs " + str(headers.get("Black")) + " (round " \
+            + str(headers.get("Round")) + ")"
+
+        settings = FULL_SEARCH_SETTINGS
+        if deadline is not None:
+            settings = choose_search_settings(cost_model, sum(plies for plies, _ in game_plies[i:]),
+                                              sum(evaluated_plies for _, evaluated_plies in game_plies[i:]),
+                                              (deadline - datetime.now()).total_seconds())
+            if settings is not FULL_SEARCH_SETTINGS:
+                print()
+                print("Reduced search settings of game", game_name + ":", get_settings_description(settings))
+                reduced_games.append((game_name, settings))
+
+        # A game whose engine searches keep failing is put into quarantine instead of aborting the whole run
+        start = time.monotonic()
+        try:
+            analyzed_game, game_statistics = await analyze_game(engine_pool, normalized_player_name, grandmaster,
+                                                                game_to_analyze, endgame_tablebase, pv_plies,
+                                                                settings)
+        except EngineSearchError as e:
+            print()
+            print("Quarantined game", game_name + ":", e)
+            quarantined_games.append(game_to_analyze.game)
+            continue
+        finally:
+            if deadline is not None:
+                cost_model.observe(game_plies[i][1], settings, time.monotonic() - start)
+            progress.advance(game_plies[i][0])
+            print("Analyzed game", i + 1, "of", str(len(games_to_analyze)) + ",", progress.get_eta())
+
+        # Add analyzed game to total results list that will be saved as a json later. The output files are
+        # encoded and written by the output writer while the next games are analyzed.
+        await output_writer.submit(analyzed_game.save_as_json)
+        analyzed_games.append(analyzed_game)
+        if annotation_futures:
+            annotated_games_futures.append(annotation_futures[i])
+
+        # Save statistics if flag is set
+        if statistics:
+            await output_writer.submit(functools.partial(
+                plot_cp_scores, game_statistics.half_moves, game_statistics.cp_scores, normalized_player_name,
+                analyzed_game.gm_side, game_to_analyze.game))
+            await output_writer.submit(functools.partial(
+                plot_expectations, game_statistics.half_moves, game_statistics.expectations, normalized_player_name,
+                analyzed_game.gm_side, game_to_analyze.game))
+
+    if deadline is not None:
+        print()
+        print(len(reduced_games), "of", len(games_to_analyze), "games were analyzed with reduced search settings",
+              "to finish by", deadline.isoformat(sep=" ", timespec="minutes"))
+        for game_name, settings in reduced_games:
+            print(" ", game_name + ":", get_settings_description(settings))
+        if datetime.now() > deadline:
+            print("Finished", format_duration((datetime.now() - deadline).total_seconds()), "after the deadline")
+
+    input_file_name = click.format_filename(games).replace('\\', '/').split('/')[-1]
+    merge_file_name = input_file_name.split('.')[0]
+    await output_writer.submit(functools.partial(save_merged_analyzed_games_results, normalized_player_name,
+                                                 merge_file_name, analyzed_games))
+
+    if quarantined_games:
+        await output_writer.submit(functools.partial(save_quarantined_games, normalized_player_name, merge_file_name,
+                                                     quarantined_games))
+
+    if annotation_executor is not None:
+        pending_annotations = sum(1 for future in annotated_games_futures if not future.done())
+        if pending_annotations > 0:
+            print("Waiting for", pending_annotations, "player annotations..")
+
+        player_annotations = [await get_player_annotation_result(future) for future in annotated_games_futures]
+        await output_writer.submit(functools.partial(save_annotated_analyzed_games_results, merge_file_name,
+                                                     analyzed_games, player_annotations))
+
+    return run_report
+
+
+# Analyze sample games of a pgn file to measure the cost of its searches and predict the runtime of analyzing all of
+# its games. Returns the number of unique positions and evaluated plies of the games.
+async def estimate_games_file(engine_pool, cost_model, opening_reader, endgame_tablebase, grandmaster, games,
+                              sample_games, workers=1, years=None, event=None):
+    from modules.core.analysis.analysis import plan_positions, analyze_game, FULL_SEARCH_SETTINGS
+    from modules.core.cost.cost import select_sample_games, get_finish_description
+    from modules.core.engine.engine import EngineSearchError
+    from modules.core.sides.sides import normalize_player_name
+
+    normalized_player_name = normalize_player_name(grandmaster)
+    games_to_analyze = read_selected_games(grandmaster, games, opening_reader, workers, years, event)
+    planned_positions, position_count = plan_positions(games_to_analyze)
+    game_plies = [game_to_analyze.count_plies() for game_to_analyze in games_to_analyze]
+    evaluated_plies = sum(evaluated_game_plies for _, evaluated_game_plies in game_plies)
+
+    for game_to_analyze in select_sample_games(games_to_analyze, sample_games):
+        start = time.monotonic()
+        try:
+            await analyze_game(engine_pool, normalized_player_name, grandmaster, game_to_analyze, endgame_tablebase)
+        except EngineSearchError as e:
+            print("Could not analyze sample game:", e)
+            continue
+        cost_model.observe(game_to_analyze.count_plies()[1], FULL_SEARCH_SETTINGS, time.monotonic() - start)
+
+    print()
+    print("Estimate for", games + ":", len(games_to_analyze), "games,", len(planned_positions), "unique positions,",
+          evaluated_plies, "evaluated plies")
+    if cost_model.is_calibrated():
+        cost_model.print_report()
+        predicted_seconds = cost_model.predict_seconds(len(planned_positions), evaluated_plies, FULL_SEARCH_SETTINGS)
+        print("Predicted runtime with", engine_pool.size, "engines:", get_finish_description(predicted_seconds))
+
+    return len(planned_positions), evaluated_plies
+
+
+# A failed lookup (e.g. while the player database is not reachable) leaves the game with its pgn player names instead
+# of losing the annotated bundle of the whole run
+async def get_player_annotation_result(annotation_future):
+    try:
+        return await annotation_future
+    except Exception as e:
+        print("Could not annotate game:", type(e).__name__, e)
+        return {'whitePlayerRating': '-', 'blackPlayerRating': '-'}
+
+
+# Report how many engine searches were saved by deduplicating positions. Without planning, every search requested
+# while classifying the games would have been run. Runs with deadline classify the games without planning. The
+# shallow searches of the triage are reported on their own.
+class RunReport:
+    def __init__(self):
+        self.position_count = 0
+        self.unique_position_count = 0
+        self.planning_requests = 0
+        self.screening_requests = 0
+        self.screening_searches = 0
+
+    def add(self, file_report):
+        self.position_count += file_report.position_count
+        self.unique_position_count += file_report.unique_position_count
+        self.planning_requests += file_report.planning_requests
+        self.screening_requests += file_report.screening_requests
+        self.screening_searches += file_report.screening_searches
+
+    def print(self, engine_pool, endgame_tablebase):
+        engine_searches = engine_pool.engine_searches - self.screening_searches
+        requested_searches = engine_pool.search_requests - self.planning_requests - self.screening_requests
+        print()
+        print("Run report:")
+        print("Game positions:", self.position_count, "(unique:", str(self.unique_position_count) + ")")
+        print("Engine searches:", engine_searches, "of", requested_searches, "requested (saved:",
+              str(requested_searches - engine_searches) + ")")
+        print("Answered from the cache:", engine_pool.cache_hits, "(joined running searches:",
+              str(engine_pool.joined_searches) + ")")
+
+        if self.screening_requests > 0:
+            print("Triage screening searches:", self.screening_searches, "of", self.screening_requests, "requested")
+
+        if engine_pool.restarts > 0:
+            print("Engine restarts:", engine_pool.restarts)
+
+        if engine_pool.lost_engines > 0:
+            print("Engines lost:", engine_pool.lost_engines, "of", engine_pool.size)
+
+        if endgame_tablebase is not None:
+            print("Tablebase probes:", endgame_tablebase.misses, "(cache hits:", endgame_tablebase.hits, ")")
 
 
 @click.command()
 @click.argument('grandmaster')
 @click.argument('games', type=click.Path(exists=True))
 @click.option('--statistics', is_flag=True)
-def analyze(grandmaster, games, statistics):
+@click.option('--tablebase', is_flag=True, help='Score positions covered by the Gaviota tablebases without engine')
+@click.option('--pv-plies', type=int, help='Maximum number of half moves of each principal variation in the output')
+@click.option('--engines', default=1, help='Number of engines the unique positions of all games are searched with')
+@click.option('--search-timeout', default=SEARCH_TIMEOUT,
+              help='Seconds after which a search counts as hung and is retried on a restarted engine')
+@click.option('--workers', default=1, help='Number of processes the selected games are parsed with')
+@click.option('--year', 'years', type=int, multiple=True, help='Only analyze games played in this year (repeatable)')
+@click.option('--event', help='Only analyze games of events whose name contains this text')
+@click.option('--lean-uci', is_flag=True,
+              help='Drive the engines with a minimal UCI driver that only decodes the final search output')
+@click.option('--annotate', 'annotate_games', is_flag=True,
+              help='Look up full player names and elo ratings during the analysis and save an annotated bundle')
+@click.option('--engine-service', type=click.Path(exists=True),
+              help='Socket of an engine service to send the searches to instead of starting engines')
+@click.option('--estimate', is_flag=True,
+              help='Analyze sample games to predict the runtime of the analysis instead of running it')
+@click.option('--sample-games', type=int, help='Number of sample games per pgn file of --estimate (default: 3)')
+@click.option('--deadline',
+              help='Reduce the search settings of games as needed to finish by this time (06:00 or 2021-07-13T06:00)')
+@click.option('--triage-top', type=int,
+              help='Screen the games at shallow depth and only analyze this many games with the highest puzzle value')
+@click.option('--triage-threshold', type=float,
+              help='Screen the games at shallow depth and only analyze games with at least this puzzle value')
+def analyze(grandmaster, games, statistics, tablebase, pv_plies, engines, search_timeout, workers, years, event,
+            lean_uci, annotate_games, engine_service, estimate, sample_games, deadline, triage_top, triage_threshold):
+    import chess.engine
+    from datetime import datetime
+    from modules.core.analysis.analysis import FULL_SEARCH_SETTINGS
+    from modules.core.cost.cost import CostModel, ESTIMATE_SAMPLE_GAMES, parse_deadline, choose_search_settings, \
+        get_settings_description, get_finish_description
+    from modules.core.endgame.endgame import open_endgame_tablebase
+    from modules.core.engine import engine
+    from modules.core.engine.engine import EnginePool, AnalysisCache
+    from modules.core.opening.opening import OpeningECOReader
+    from modules.core.pgn_index.pgn_index import get_pgn_files, load_pgn_index, filter_pgn_index
+    from modules.core.writer.writer import OutputWriter
+
+    if annotate_games:
+        from modules.core.player.player import ANNOTATION_THREADS
+
+    # The searches of the run are queued behind the interactive searches of the service
+    if engine_service:
+        engine.ENGINE_SERVICE_PATH = engine_service
+
+    if deadline is not None:
+        try:
+            deadline = parse_deadline(deadline)
+        except ValueError:
+            raise click.BadParameter('expected a time like 06:00 or 2021-07-13T06:00', param_hint='--deadline')
+
+    async def run_estimate(engine_pool, endgame_tablebase, opening_reader):
+        cost_model = CostModel(engine_pool)
+        unique_positions = 0
+        evaluated_plies = 0
+
+        for games_file in get_pgn_files(games):
+            file_unique_positions, file_evaluated_plies = await estimate_games_file(
+                engine_pool, cost_model, opening_reader, endgame_tablebase, grandmaster, games_file,
+                sample_games or ESTIMATE_SAMPLE_GAMES, workers, set(years), event)
+            unique_positions += file_unique_positions
+            evaluated_plies += file_evaluated_plies
+
+        print()
+        if not cost_model.is_calibrated():
+            print("No sample game could be analyzed, the runtime can not be predicted")
+            return
+
+        # The prediction for all files uses the searches of the sample games of all files
+        predicted_seconds = cost_model.predict_seconds(unique_positions, evaluated_plies, FULL_SEARCH_SETTINGS)
+        print("Predicted runtime of the analysis with", engine_pool.size, "engines:",
+              get_finish_description(predicted_seconds))
+
+        if deadline is not None:
+            settings = choose_search_settings(cost_model, unique_positions, evaluated_plies,
+                                              (deadline - datetime.now()).total_seconds())
+            print("Search settings to finish by", deadline.isoformat(sep=" ", timespec="minutes") + ":",
+                  get_settings_description(settings))
+
     async def run_analysis():
-        # Initialize UCI engine
-        engine = await initialize_uci_engine()
+        # Initialize UCI engines (or connections to the engine service) sharing one analysis cache
+        engine_pool = EnginePool(engines, cache=AnalysisCache(), search_timeout=search_timeout,
+                                 lean_uci=lean_uci)
+        await engine_pool.initialize()
 
-        # Read game from pgn file
-        pgn = open(games, "r")
+        # Initialize long-lived endgame tablebase handle
+        endgame_tablebase = open_endgame_tablebase() if tablebase else None
 
         # Initialize opening reader
         opening_reader = OpeningECOReader()
         opening_reader.initialize()
-        
-        normalized_player_name = normalize_player_name(grandmaster)
-        analyzed_games_results = []
-
-        # Parse chess games from PGN file and process them to create game situations
-        while True:
-            # Check if game is valid for our purpose
-            game = chess.pgn.read_game(pgn)
-            if game is None:
-                break
-            if not is_game_valid(grandmaster, game):
-                print("Game " + (str(game.headers) if game is not None else 'None') + " is invalid\n")
-                continue
-
-            # Game preprocessing
-            preprocess_game(game)
-            print_game_info(game, grandmaster)
-
-            grandmaster_side = get_grandmaster_side(grandmaster, game)
-            game_pgn = str(game)
-
-            # Detect common opening played
-            opening = opening_reader.identify_opening(game_pgn)
-            if opening is None:
-                print("Game opening could not be identified!\n")
-                continue
-            opening_ply_length = len(opening["moves"].split(" "))
-
-            # Initialize analyzed game
-            analyzed_game = AnalyzedGame(normalized_player_name, game_pgn, game, grandmaster_side)
-            analyzed_game.set_opening(opening)
-
-            # Initialize board
-            node = game
-            board = game.board()
-
-            # Intiialize Game Phase data
-            is_opening = True
-            is_midgame = False
-            is_endgame = False
-
-            # Intiialize Analysis data
-            score = None
-            last_analysis = None
-            last_expectation = 0.5
-            last_opponent_move_was_blunder = False
-
-            # Initialize Statistics data
-            half_moves = [0]
-            cp_scores = [0]
-            expectations = [0.5]
-
-            # Evaluate moves played by both players
-            while not node.is_end():
-                # Move data
-                half_move = board.ply()
-                # full_move = board.fullmove_number
-                turn = board.turn
-                move = node.variations[0].move
-                # gm_turn = is_grandmasters_turn(grandmaster, game, turn)
-
-                board_before_move = board.copy()
-
-                # Play move of grandmaster
-                board.push(move)
-
-                # Update game phase
-                if not is_midgame and half_move == opening_ply_length:
-                    is_opening = False
-                    is_midgame = True
-                    print()
-                    print("Begin of midgame!")
-
-                # Analyse board after played Move
-                analysis = await analyse_board(engine, board, multipv=3)
-                score = get_signed_cp_score(analysis)
-                white_pov_score = get_current_score_for_grandmaster(score, chess.WHITE)
-                # white_expectation = get_expectation(white_pov_score, board.ply())
-                gm_pov_score = get_current_score_for_grandmaster(score, grandmaster_side)
-                expectation = get_expectation(gm_pov_score, board.ply())
-                pv = [move] + get_principle_variation(analysis)
-
-                # Update game phase
-                if not is_endgame and is_in_endgame(board, score, expectation):
-                    is_midgame = False
-                    is_endgame = True
-                    print()
-                    print("Begin of endgame!")
-
-                # Update statistics data
-                half_moves += [half_move]
-                cp_scores += [gm_pov_score.score()]
-                expectations += [expectation]
-
-                # print_move_info(full_move, half_move, turn, gm_turn, move, expectation, white_pov_score)
-                # print(board_before_move.variation_san(pv))
-
-                if is_opening:
-                    # Add opening move played to analyzed game
-                    analyzed_game.add_opening_move(ply=half_move, turn=turn, evaluated_move={
-                                                       "move": {"uci": move.uci(), "san": board_before_move.san(move)},
-                                                       "moveType": MoveType.BOOK.value,
-                                                       "signedCPScore": get_cp_score_string(white_pov_score),
-                                                       "gmExpectation": expectation,
-                                                       "pv": board_before_move.variation_san(pv)
-                                                   })
-                else:
-                    # Evaluate move played
-                    move_type, alternative_moves = \
-                        await evaluate_move(engine, grandmaster_side, last_opponent_move_was_blunder, last_analysis,
-                                      half_move, move, last_expectation, expectation, board_before_move, board)
-
-                    last_opponent_move_was_blunder = move_type == MoveType.BLUNDER
-                    game_phase = "endgame" if is_endgame else "midgame"
-
-                    # Add evaluated midgame/ endgame move to analyzed game
-                    analyzed_game.add_move(ply=half_move, game_phase=game_phase, turn=board_before_move.turn, move_type=move_type.value,
-                                           evaluated_move={
-                                               "move": {"uci": move.uci(), "san": board_before_move.san(move)},
-                                               "moveType": move_type.value,
-                                               "signedCPScore": get_cp_score_string(white_pov_score),
-                                               "gmExpectation": expectation,
-                                               "pv": board_before_move.variation_san(pv)
-                                           },
-                                           alternative_moves=alternative_moves)
-
-                last_analysis = analysis
-                last_expectation = expectation
-                node = node.variations[0]
-
-            # TODO Remove comments to use endgame table base probing
-            # gm_depth_to_mate = get_gm_depth_to_mate(grandmaster_side, board, score)
-            # analyzed_game.set_gm_depth_to_mate(gm_depth_to_mate)
-
-            # Add analyzed game result to total results list that will be saved as a json later
-            analyzed_games_results.append(analyzed_game.save_as_json())
-
-            # Save statistics if flag is set
-            if statistics:
-                plot_cp_scores(half_moves, cp_scores, normalized_player_name, grandmaster_side, game) 
-                plot_expectations(half_moves, expectations, normalized_player_name, grandmaster_side, game)
-
-        await engine.quit()
-        
-        input_file_name = click.format_filename(games).replace('\\', '/').split('/')[-1]
-        merge_file_name = input_file_name.split('.')[0]
-        save_merged_analyzed_games_results(normalized_player_name, merge_file_name, analyzed_games_results)
+
+        if estimate:
+            await run_estimate(engine_pool, endgame_tablebase, opening_reader)
+            await engine_pool.quit()
+            if endgame_tablebase is not None:
+                endgame_tablebase.close()
+            return
+
+        output_writer = OutputWriter()
+
+        # Player lookups are network bound and run in threads of their own
+        annotation_executor = concurrent.futures.ThreadPoolExecutor(ANNOTATION_THREADS) if annotate_games else None
+
+        # The cost model learns the cost of the searches from the games analyzed so far
+        cost_model = CostModel(engine_pool) if deadline is not None else None
+
+        run_report = RunReport()
+
+        # A directory stands for all pgn files it contains, each of them gets its own merged analysis output file
+        games_files = get_pgn_files(games)
+        if deadline is not None:
+            selected_games = [len(filter_pgn_index(load_pgn_index(games_file), grandmaster, set(years), event))
+                              for games_file in games_files]
+            # The games a triage threshold drops are only known once a file is screened, so files are weighted by
+            # all of their selected games then
+            if triage_top is not None:
+                selected_games = [min(file_selected_games, triage_top) for file_selected_games in selected_games]
+
+        for file_number, games_file in enumerate(games_files):
+            # Every file gets the share of the time left that its selected games have of the remaining games
+            file_deadline = None
+            if deadline is not None:
+                now = datetime.now()
+                remaining_games = sum(selected_games[file_number:])
+                file_deadline = now + (deadline - now) * selected_games[file_number] / remaining_games \
+                    if remaining_games > 0 else deadline
+
+            run_report.add(await analyze_games_file(
+                engine_pool, output_writer, opening_reader, endgame_tablebase, grandmaster, games_file, statistics,
+                pv_plies, workers, set(years), event, annotation_executor, file_deadline, cost_model, triage_top,
+                triage_threshold))
+
+        await engine_pool.quit()
+        await output_writer.close()
+        if annotation_executor is not None:
+            annotation_executor.shutdown()
+
+        run_report.print(engine_pool, endgame_tablebase)
+        if endgame_tablebase is not None:
+            endgame_tablebase.close()
 
     asyncio.set_event_loop_policy(chess.engine.EventLoopPolicy())
     asyncio.run(run_analysis())
 
 
+@click.command()
+@click.argument('manifest', type=click.Path(exists=True))
+@click.option('--statistics', is_flag=True)
+@click.option('--tablebase', is_flag=True, help='Score positions covered by the Gaviota tablebases without engine')
+@click.option('--pv-plies', type=int, help='Maximum number of half moves of each principal variation in the output')
+@click.option('--engines', default=1, help='Number of engines shared by all jobs of the batch')
+@click.option('--search-timeout', default=SEARCH_TIMEOUT,
+              help='Seconds after which a search counts as hung and is retried on a restarted engine')
+@click.option('--workers', default=1, help='Number of processes the selected games are parsed with')
+@click.option('--lean-uci', is_flag=True,
+              help='Drive the engines with a minimal UCI driver that only decodes the final search output')
+@click.option('--annotate', 'annotate_games', is_flag=True,
+              help='Look up full player names and elo ratings during the analysis and save annotated bundles')
+@click.option('--engine-service', type=click.Path(exists=True),
+              help='Socket of an engine service to send the searches to instead of starting engines')
+def batch(manifest, statistics, tablebase, pv_plies, engines, search_timeout, workers, lean_uci, annotate_games,
+          engine_service):
+    import chess.engine
+    from modules.core.batch.batch import read_batch_manifest, schedule_batch_jobs
+    from modules.core.endgame.endgame import open_endgame_tablebase
+    from modules.core.engine import engine
+    from modules.core.engine.engine import EnginePool, AnalysisCache
+    from modules.core.opening.opening import OpeningECOReader
+    from modules.core.writer.writer import OutputWriter
+
+    if annotate_games:
+        from modules.core.player.player import ANNOTATION_THREADS
+
+    # The searches of the run are queued behind the interactive searches of the service
+    if engine_service:
+        engine.ENGINE_SERVICE_PATH = engine_service
+
+    try:
+        jobs = schedule_batch_jobs(read_batch_manifest(manifest))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    async def run_batch():
+        # Engines, analysis cache, tablebase handle and opening reader are shared by all jobs of the batch
+        engine_pool = EnginePool(engines, cache=AnalysisCache(), search_timeout=search_timeout,
+                                 lean_uci=lean_uci)
+        await engine_pool.initialize()
+
+        endgame_tablebase = open_endgame_tablebase() if tablebase else None
+
+        opening_reader = OpeningECOReader()
+        opening_reader.initialize()
+
+        output_writer = OutputWriter()
+
+        # Player lookups are network bound and run in threads of their own
+        annotation_executor = concurrent.futures.ThreadPoolExecutor(ANNOTATION_THREADS) if annotate_games else None
+
+        run_report = RunReport()
+
+        for job_number, job in enumerate(jobs, start=1):
+            print()
+            print("Batch job", job_number, "of", str(len(jobs)) + ":", job.grandmaster, "(" + str(len(job.games)),
+                  "pgn files, priority", str(job.priority) + (", deadline " + job.deadline.isoformat()
+                                                              if job.deadline is not None else "") + ")")
+
+            # The merged output of every pgn file is saved as soon as its games are analyzed
+            for games in job.games:
+                run_report.add(await analyze_games_file(
+                    engine_pool, output_writer, opening_reader, endgame_tablebase, job.grandmaster, games,
+                    statistics, pv_plies, workers, job.years, job.event, annotation_executor))
+
+            if job.is_overdue():
+                print("Batch job of", job.grandmaster, "finished after its deadline", job.deadline.isoformat())
+
+        await engine_pool.quit()
+        await output_writer.close()
+        if annotation_executor is not None:
+            annotation_executor.shutdown()
+
+        run_report.print(engine_pool, endgame_tablebase)
+        if endgame_tablebase is not None:
+            endgame_tablebase.close()
+
+    asyncio.set_event_loop_policy(chess.engine.EventLoopPolicy())
+    asyncio.run(run_batch())
+
+
 @click.command()
 @click.argument('analysis', type=click.Path(exists=True))
 @click.option('--output', '-o')
-def annotate(analysis, output):
+@click.option('--shard-by', type=click.Choice(SHARD_BY_OPTIONS),
+              help='Split the bundle into shards per grandmaster, opening ECO or by game count only')
+@click.option('--shard-size', default=DEFAULT_MAX_SHARD_BYTES, help='Maximum size of a shard in bytes')
+@click.option('--shard-games', type=int, help='Maximum number of games in a shard')
+def annotate(analysis, output, shard_by, shard_size, shard_games):
+    from modules.core.bundle.bundle import save_sharded_bundle
+    from modules.core.player.player import annotate_analyzed_game
+
     print('Parsing input file..')
 
     # Read analysis output file created by 'analyze' command
@@ -205,14 +509,7 @@ def annotate(analysis, output):
         print('Annotating input file with full player names and elo ratings..')
 
         for analyzed_game in analyzed_games_list:
-            white_player_full_name = get_full_player_name(analyzed_game['whitePlayer'])
-            black_player_full_name = get_full_player_name(analyzed_game['blackPlayer'])
-            white_player_rating, black_player_rating = get_player_elo_ratings_for_game(analyzed_game)
-
-            analyzed_game['whitePlayer'] = white_player_full_name
-            analyzed_game['blackPlayer'] = black_player_full_name
-            analyzed_game['whitePlayerRating'] = white_player_rating
-            analyzed_game['blackPlayerRating'] = black_player_rating
+            annotate_analyzed_game(analyzed_game)
 
     print('Saving annotated output file..')
 
@@ -223,6 +520,12 @@ def annotate(analysis, output):
         output_dir.mkdir(parents=True, exist_ok=True)
         output_file_path = output_dir / os.path.basename(analysis_output_file.name)
 
+    # Write annotated bundle as shards with a manifest instead of a single file
+    if shard_by is not None:
+        bundle_dir, _ = os.path.splitext(output_file_path)
+        save_sharded_bundle(analyzed_games_list, bundle_dir, shard_by, shard_size, shard_games)
+        return
+
     # Write annotated file
     with open(output_file_path, 'w') as annotated_output_file:
         json.dump(analyzed_games_list, annotated_output_file)
@@ -238,17 +541,268 @@ def annotate(analysis, output):
         gzipped_file.writelines(file)
 
 
+@click.command()
+@click.argument('bundle', type=click.Path(exists=True))
+@click.argument('analysis', type=click.Path(exists=True))
+@click.option('--annotate', 'annotate_games', is_flag=True,
+              help='Annotate the new games with full player names and elo ratings before merging')
+def merge(bundle, analysis, annotate_games):
+    from modules.core.bundle.bundle import merge_into_bundle
+
+    print('Parsing input file..')
+
+    # Read analysis output file created by 'analyze' command
+    with open(analysis, "r") as analysis_output_file:
+        analyzed_games_list = json.load(analysis_output_file)
+
+    if annotate_games:
+        from modules.core.player.player import annotate_analyzed_game
+
+        print('Annotating input file with full player names and elo ratings..')
+
+        for analyzed_game in analyzed_games_list:
+            annotate_analyzed_game(analyzed_game)
+
+    # Add new games, replace changed games and drop duplicates of games already in the bundle
+    print('Merging into', bundle + '..')
+    merge_report = merge_into_bundle(bundle, analyzed_games_list)
+    merge_report.print()
+
+
+@click.command()
+@click.argument('analyses', nargs=-1, type=click.Path(exists=True))
+@click.option('--output', '-o', default='output/plies.pkl',
+              help='Ply table file, saved as pickle unless it ends with .parquet or .feather (needs pyarrow)')
+def export(analyses, output):
+    from modules.core.analytics.analytics import get_analysis_files, read_analyzed_games, get_ply_table, \
+        save_ply_table
+
+    # Without arguments, all analysis output files of previous runs are exported
+    analysis_files = get_analysis_files(analyses or ['output'])
+    print('Reading', len(analysis_files), 'analysis files..')
+    analyzed_games = read_analyzed_games(analysis_files)
+
+    plies = get_ply_table(analyzed_games)
+
+    try:
+        save_ply_table(plies, output)
+    except ImportError as e:
+        raise click.ClickException(str(e))
+
+    print('Saved', len(plies), 'plies of', len(analyzed_games), 'games as', output)
+
+
+@click.command()
+@click.argument('table', default='output/plies.pkl', type=click.Path(exists=True))
+@click.option('--group-by', multiple=True, default=['grandmaster', 'phase'],
+              type=click.Choice(['grandmaster', 'eco', 'phase', 'side', 'move_type', 'year']),
+              help='Columns the plies are grouped by (repeatable)')
+@click.option('--grandmaster', 'grandmasters', multiple=True, help='Only count games of this grandmaster (repeatable)')
+@click.option('--all-moves', is_flag=True, help='Count the moves of the opponents as well')
+def stats(table, group_by, grandmasters, all_moves):
+    import pandas as pd
+    from modules.core.analytics.analytics import read_ply_table, filter_ply_table, get_move_type_distribution, \
+        get_accuracy
+
+    try:
+        plies = read_ply_table(table)
+    except ImportError as e:
+        raise click.ClickException(str(e))
+
+    plies = filter_ply_table(plies, grandmasters, all_moves)
+    group_by = list(group_by)
+
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200):
+        print('Accuracy by', ', '.join(group_by) + ':')
+        print(get_accuracy(plies, group_by))
+        print()
+        print('Move types by', ', '.join(group_by) + ':')
+        print(get_move_type_distribution(plies, group_by))
+
+
 @click.command()
 @click.option('--debug', is_flag=True)
-def api(debug):
+@click.option('--asyncio', 'use_asyncio', is_flag=True, help='Serve requests on a single event loop using an engine pool')
+@click.option('--engines', default=2, help='Number of engines in the engine pool of the asyncio mode')
+@click.option('--threads', default=4, help='Number of worker threads of the waitress server')
+@click.option('--prefetch/--no-prefetch', default=True,
+              help='Analyse the likely next positions of clients with idle engines in the asyncio mode')
+@click.option('--bundle', 'bundles', multiple=True, type=click.Path(exists=True),
+              help='Analyzed games bundle (or directory of bundles) used to answer requests without engine')
+@click.option('--games', 'game_bundles', multiple=True, type=click.Path(exists=True),
+              help='Annotated bundle (or directory of bundles) served by the games routes (default: output/annotated)')
+@click.option('--engine-service', type=click.Path(exists=True),
+              help='Socket of an engine service to send the searches to instead of starting engines')
+@click.option('--analysis-cache-size', type=int,
+              help='Maximum number of engine analyses kept in memory (default: 100000)')
+@click.option('--host', default='0.0.0.0', help='Address to listen on')
+@click.option('--port', default=5000, help='Port to listen on')
+def api(debug, use_asyncio, engines, threads, prefetch, bundles, game_bundles, engine_service, analysis_cache_size,
+        host, port):
+    from modules.api import api_analysis
+    from modules.api.api_analysis import bundle_index
+    from modules.api.game_index import game_index
+    from modules.core.engine import engine
+
+    # The searches of requests jump ahead of the batch searches of the service
+    if engine_service:
+        engine.ENGINE_SERVICE_PATH = engine_service
+
+    if analysis_cache_size is not None:
+        api_analysis.MAX_CACHED_ANALYSES = analysis_cache_size
+
+    for bundle in bundles:
+        bundle_index.load(bundle)
+
+    # The games routes serve the annotated bundles by id and through their lookup indexes
+    if not game_bundles and os.path.isdir('output/annotated'):
+        game_bundles = ['output/annotated']
+    for game_bundle in game_bundles:
+        game_index.load(game_bundle)
+
+    if use_asyncio:
+        import chess.engine
+        from aiohttp import web
+        from modules.api.async_api_routes import create_async_api_app
+
+        print('Starting asyncio API..')
+
+        # Handler cancellation stops the engine searches of requests whose client disconnected
+        asyncio.set_event_loop_policy(chess.engine.EventLoopPolicy())
+        web.run_app(create_async_api_app(engines, prefetch), host=host, port=port, handler_cancellation=True)
+        return
+
+    from flask import Flask
+    from waitress import serve
+    from modules.api.api_routes import api_routes
+
     print('Starting Flask API..')
     
     app = Flask(__name__)
     app.register_blueprint(api_routes)
     
     if debug:
-        app.run(debug=debug, threaded=True)
+        app.run(host=host, port=port, debug=debug, threaded=True)
     else:
         # Use waitress for production server
-        print('API running on port 5000')
-        serve(app, host='0.0.0.0', port=5000)
+        print('API running on port', port)
+        serve(app, host=host, port=port, threads=threads)
+
+
+@click.command(name='engine-service')
+@click.option('--socket', 'socket_path', default=DEFAULT_ENGINE_SERVICE_SOCKET,
+              help='Path of the unix socket to listen on')
+@click.option('--engines', default=2, help='Number of engines of the service')
+@click.option('--search-timeout', default=SEARCH_TIMEOUT,
+              help='Seconds after which a search counts as hung and is retried on a restarted engine')
+@click.option('--interactive-limit', type=int,
+              help='Maximum number of interactive searches running at the same time (default: all engines)')
+@click.option('--batch-limit', type=int,
+              help='Maximum number of batch searches running at the same time (default: all engines)')
+@click.option('--cache-size', default=SERVICE_CACHE_SIZE,
+              help='Maximum number of analyses kept in memory, the least recently used ones are evicted first')
+def engine_service(socket_path, engines, search_timeout, interactive_limit, batch_limit, cache_size):
+    import chess.engine
+    from modules.core.engine import engine
+    from modules.core.engine.engine import EnginePool, AnalysisCache
+    from modules.core.engine.engine_service import run_engine_service
+    from modules.core.engine.service_client import PRIORITY_INTERACTIVE, PRIORITY_BATCH
+
+    # The service starts the engines itself, even if its environment points to a service
+    engine.ENGINE_SERVICE_PATH = None
+
+    class_limits = {
+        PRIORITY_INTERACTIVE: interactive_limit or engines,
+        PRIORITY_BATCH: batch_limit or engines,
+    }
+    # Preempted searches are stopped by cancelling them, which the lean UCI driver handles at any point of a search
+    engine_pool = EnginePool(engines, cache=AnalysisCache(cache_size), search_timeout=search_timeout, lean_uci=True)
+
+    asyncio.set_event_loop_policy(chess.engine.EventLoopPolicy())
+    try:
+        asyncio.run(run_engine_service(engine_pool, class_limits, socket_path))
+    except KeyboardInterrupt:
+        pass
+
+
+@click.command(name='uci-benchmark')
+@click.argument('games', type=click.Path(exists=True))
+@click.option('--positions', default=200, help='Number of positions of the games to search')
+@click.option('--depth', default=18, help='Search depth')
+@click.option('--multipv', default=3, help='Number of principal variations')
+@click.option('--scripted-engine', is_flag=True, help='Search with the scripted stand-in engine')
+def uci_benchmark(games, positions, depth, multipv, scripted_engine):
+    import chess.engine
+    from modules.core.engine import engine
+    from modules.core.engine.benchmark import read_benchmark_boards, run_uci_benchmark
+
+    if scripted_engine:
+        engine.ENGINE_PATH = engine.SCRIPTED_ENGINE
+
+    boards = read_benchmark_boards(games, positions)
+    print('Searching', len(boards), 'positions with python-chess and the lean UCI driver..', file=sys.stderr)
+
+    asyncio.set_event_loop_policy(chess.engine.EventLoopPolicy())
+    report = asyncio.run(run_uci_benchmark(boards, depth, multipv))
+    print(json.dumps(report, indent=2))
+
+
+@click.command(name='load-test')
+@click.argument('bundles', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--url', default='http://127.0.0.1:5000', help='Base url of the API under test')
+@click.option('--requests', 'request_count', default=200, help='Number of requests to send')
+@click.option('--concurrency', default=8, help='Number of requests in flight at the same time')
+@click.option('--repeat-share', default=0.3, help='Share of requests repeating a position requested before')
+@click.option('--seed', default=0, help='Seed of the request mix')
+@click.option('--start-api', is_flag=True, help='Start a local API server for the duration of the load test')
+@click.option('--api-args', default='', help='Arguments of the started API server, e.g. "--asyncio --engines 4"')
+@click.option('--scripted-engine', is_flag=True, help='Let the started API server use the scripted stand-in engine')
+@click.option('--output', '-o', help='Write the JSON report to this file instead of stdout')
+def load_test(bundles, url, request_count, concurrency, repeat_share, seed, start_api, api_args, scripted_engine,
+              output):
+    from modules.api.load_test import LOCAL_HOSTS, read_analyse_requests, get_request_mix, run_load_test, \
+        start_api as start_api_process
+
+    # Replay the evaluated moves of analyzed games bundles as request mix
+    analyse_requests = read_analyse_requests(bundles)
+    if not analyse_requests:
+        raise click.ClickException('The bundles contain no evaluated moves to send requests for')
+
+    request_mix = get_request_mix(analyse_requests, request_count, repeat_share, seed)
+
+    api_process = None
+    if start_api:
+        env = dict(os.environ)
+        if scripted_engine:
+            env['ENGINE_PATH'] = 'scripted'
+
+        # The started API listens on the port of the url, which has to point to this machine
+        parsed_url = urllib.parse.urlparse(url)
+        if parsed_url.hostname not in LOCAL_HOSTS:
+            raise click.ClickException('--start-api needs a url of this machine (e.g. http://127.0.0.1:5000), not '
+                                       + url)
+
+        main_path = str(pathlib.Path(__file__).parent.absolute() / '..' / '..' / 'main.py')
+        print('Starting API..', file=sys.stderr)
+        try:
+            api_process = start_api_process(main_path, shlex.split(api_args), env, parsed_url.hostname,
+                                            parsed_url.port or 80)
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+
+    try:
+        print('Sending', len(request_mix), 'requests with concurrency', concurrency, 'to', url + '..', file=sys.stderr)
+        report = run_load_test(url, request_mix, concurrency)
+    finally:
+        if api_process is not None:
+            api_process.terminate()
+            api_process.wait()
+
+    if output is None:
+        print(json.dumps(report, indent=2))
+        return
+
+    with open(output, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+
+    print('Saved load test report as', output, file=sys.stderr)
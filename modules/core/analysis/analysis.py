@@ -0,0 +1,391 @@
+import asyncio
+import concurrent.futures
+
+import chess
+import chess.engine
+import chess.pgn
+
+from modules.core.endgame.endgame import is_in_endgame, get_gm_depth_to_mate
+from modules.core.engine.engine import analyse_board, EngineSearchError, STOCKFISH_DEPTH
+from modules.core.evaluation.evaluation import evaluate_move, apply_last_opponent_move_was_blunder, MoveType
+from modules.core.info.info import print_game_info, Progress
+from modules.core.notation.notation import get_san, get_variation_san
+from modules.core.opening.opening import OpeningECOReader
+from modules.core.output.output import AnalyzedGame, GamePhase
+from modules.core.pgn.pgn import is_game_valid, preprocess_game
+from modules.core.pgn_index.pgn_index import open_pgn_file, is_compressed_pgn_file
+from modules.core.score.score import get_signed_cp_score, get_current_score_for_grandmaster, get_expectation, \
+    get_cp_score_string, get_principle_variation
+from modules.core.sides.sides import get_grandmaster_side
+
+# Number of principal variations searched for every position of a game
+GAME_POSITION_MULTIPV = 3
+
+# Number of chunks of games every parsing worker gets, so that workers finishing early take over more chunks
+GAME_READER_CHUNKS_PER_WORKER = 4
+
+
+class GameToAnalyze:
+    def __init__(self, game, opening):
+        self.game = game
+        self.opening = opening
+
+    # Number of half moves of the game and of those played after the opening, whose moves are classified
+    def count_plies(self):
+        plies = self.game.end().ply()
+        return plies, max(0, plies - get_opening_ply_length(self.opening))
+
+
+# Search depth and number of principal variations of the searches of the game positions, and the maximum number of
+# legal moves searched while looking for a bad alternative move (None: all legal moves)
+class SearchSettings:
+    def __init__(self, depth=STOCKFISH_DEPTH, multipv=GAME_POSITION_MULTIPV, scan_budget=None):
+        self.depth = depth
+        self.multipv = multipv
+        self.scan_budget = scan_budget
+
+    def get_limit(self):
+        return chess.engine.Limit(depth=self.depth)
+
+    def to_json(self):
+        return {"depth": self.depth, "multipv": self.multipv, "scanBudget": self.scan_budget}
+
+
+FULL_SEARCH_SETTINGS = SearchSettings()
+
+
+def get_opening_ply_length(opening):
+    return len(opening["moves"].split(" "))
+
+
+# Check that the game is valid for our purpose and identify its opening. Returns None for games to skip.
+def read_game_to_analyze(grandmaster, game, opening_reader):
+    if not is_game_valid(grandmaster, game):
+        print("Game " + (str(game.headers) if game is not None else 'None') + " is invalid\n")
+        return None
+
+    # Game preprocessing
+    preprocess_game(game)
+    print_game_info(game, grandmaster)
+
+    # Detect common opening played
+    opening = opening_reader.identify_opening(str(game))
+    if opening is None:
+        print("Game opening could not be identified!\n")
+        return None
+
+    return GameToAnalyze(game, opening)
+
+
+# Read all games of the pgn file that are valid for our purpose and whose opening can be identified
+def read_games(grandmaster, pgn, opening_reader):
+    games_to_analyze = []
+
+    # Parse chess games from PGN file and process them to create game situations
+    while True:
+        game = chess.pgn.read_game(pgn)
+        if game is None:
+            break
+
+        game_to_analyze = read_game_to_analyze(grandmaster, game, opening_reader)
+        if game_to_analyze is not None:
+            games_to_analyze.append(game_to_analyze)
+
+    return games_to_analyze
+
+
+# Read the games of the index entries (see pgn_index) of the pgn file, which are in the order of the file
+def read_games_at_offsets(grandmaster, pgn_path, index_entries, opening_reader):
+    if is_compressed_pgn_file(pgn_path):
+        return read_games_forward(grandmaster, pgn_path, index_entries, opening_reader)
+
+    games_to_analyze = []
+
+    with open_pgn_file(pgn_path) as pgn:
+        for game_entry in index_entries:
+            pgn.seek(game_entry["offset"])
+            game_to_analyze = read_game_to_analyze(grandmaster, chess.pgn.read_game(pgn), opening_reader)
+            if game_to_analyze is not None:
+                games_to_analyze.append(game_to_analyze)
+
+    return games_to_analyze
+
+
+# Compressed files can not seek back without decompressing them from the start again, so their games are read in one
+# forward pass that skips the games in between without parsing their moves
+def read_games_forward(grandmaster, pgn_path, index_entries, opening_reader):
+    games_to_analyze = []
+
+    with open_pgn_file(pgn_path) as pgn:
+        number = 0
+        for game_entry in index_entries:
+            while number < game_entry["number"]:
+                chess.pgn.skip_game(pgn)
+                number += 1
+
+            game_to_analyze = read_game_to_analyze(grandmaster, chess.pgn.read_game(pgn), opening_reader)
+            number += 1
+            if game_to_analyze is not None:
+                games_to_analyze.append(game_to_analyze)
+
+    return games_to_analyze
+
+
+# Every parsing worker process loads its own opening reader once
+worker_opening_reader = None
+
+
+def initialize_game_reader_worker():
+    global worker_opening_reader
+    worker_opening_reader = OpeningECOReader()
+    worker_opening_reader.initialize()
+
+
+def read_games_at_offsets_worker(grandmaster, pgn_path, index_entries):
+    return read_games_at_offsets(grandmaster, pgn_path, index_entries, worker_opening_reader)
+
+
+# Read the indexed games of the pgn file. With several workers, every worker process seeks to its own share of the
+# games and parses them in parallel. Workers of compressed files skip through the file up to their share, so these
+# files are split into one share per worker. The games are returned in the order of the pgn file.
+def read_indexed_games(grandmaster, pgn_path, index_entries, opening_reader, workers=1):
+    if workers <= 1 or len(index_entries) < 2:
+        return read_games_at_offsets(grandmaster, pgn_path, index_entries, opening_reader)
+
+    chunks_per_worker = 1 if is_compressed_pgn_file(pgn_path) else GAME_READER_CHUNKS_PER_WORKER
+    chunk_count = min(len(index_entries), workers * chunks_per_worker)
+    chunk_size = -(-len(index_entries) // chunk_count)
+    chunks = [index_entries[i:i + chunk_size] for i in range(0, len(index_entries), chunk_size)]
+
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=initialize_game_reader_worker) as executor:
+        chunk_results = executor.map(read_games_at_offsets_worker, [grandmaster] * len(chunks),
+                                     [pgn_path] * len(chunks), chunks)
+        return [game_to_analyze for chunk_result in chunk_results for game_to_analyze in chunk_result]
+
+
+# Copy of the board that only keeps the moves since the last capture or pawn move. Positions before them can not occur
+# again, so repetitions (e.g. in the position sent to the engine), SAN and variations stay the same, while the plies and
+# planned positions of long games do not each hold a copy of the whole move stack.
+def copy_board(board):
+    return board.copy(stack=board.halfmove_clock)
+
+
+# Expand the games into the set of unique positions (normalized EPD) reached after each move
+def plan_positions(games_to_analyze):
+    planned_positions = {}
+    position_count = 0
+
+    for game_to_analyze in games_to_analyze:
+        board = game_to_analyze.game.board()
+
+        for move in game_to_analyze.game.mainline_moves():
+            board.push(move)
+            position_count += 1
+
+            epd = board.epd()
+            if epd not in planned_positions:
+                planned_positions[epd] = copy_board(board)
+
+    return planned_positions, position_count
+
+
+# Search every planned position once, spread over all engines of the pool. The results end up in the analysis
+# cache of the pool from which the classification of the single games reads them. Returns the number of searches
+# requested from the pool, which runs no other searches during the planning pass.
+async def schedule_positions(engine_pool, planned_positions, tablebase=None):
+    progress = Progress(len(planned_positions))
+    search_requests = engine_pool.search_requests
+
+    async def analyse_planned_position(board):
+        try:
+            await analyse_board(engine_pool, board, multipv=GAME_POSITION_MULTIPV, tablebase=tablebase)
+        except EngineSearchError:
+            # The position is searched again while classifying its game, which is quarantined if it fails again
+            pass
+
+        progress.advance()
+        if progress.done % 100 == 0:
+            print("Analysed", progress.done, "of", len(planned_positions), "planned positions,", progress.get_eta())
+
+    await asyncio.gather(*[analyse_planned_position(board) for board in planned_positions.values()])
+    return engine_pool.search_requests - search_requests
+
+
+class GameStatistics:
+    def __init__(self):
+        self.half_moves = [0]
+        self.cp_scores = [0]
+        self.expectations = [0.5]
+
+    def add(self, half_move, cp_score, expectation):
+        self.half_moves += [half_move]
+        self.cp_scores += [cp_score]
+        self.expectations += [expectation]
+
+
+class AnalyzedPly:
+    def __init__(self, half_move, move, board):
+        self.half_move = half_move
+        self.move = move
+        self.turn = board.turn
+        # Board before the move was played, owned by this ply so that plies can be evaluated concurrently
+        self.board = board
+        self.analysis = None
+        self.score = None
+        self.expectation = None
+        self.move_type = None
+        self.alternative_moves = None
+
+
+async def analyse_ply(engine, analyzed_ply, grandmaster_side, tablebase=None, settings=FULL_SEARCH_SETTINGS):
+    board = analyzed_ply.board
+    board.push(analyzed_ply.move)
+    try:
+        analyzed_ply.analysis = await analyse_board(engine, board, multipv=settings.multipv,
+                                                    limit=settings.get_limit(), tablebase=tablebase)
+    finally:
+        board.pop()
+
+    analyzed_ply.score = get_signed_cp_score(analyzed_ply.analysis)
+    gm_pov_score = get_current_score_for_grandmaster(analyzed_ply.score, grandmaster_side)
+    analyzed_ply.expectation = get_expectation(gm_pov_score, analyzed_ply.half_move + 1)
+
+
+async def evaluate_ply(engine, analyzed_ply, last_analyzed_ply, grandmaster_side, tablebase=None, pv_plies=None,
+                       san_cache=None, settings=FULL_SEARCH_SETTINGS):
+    # The move type does not depend on the classification of the previous move except for game changers, which
+    # are resolved in the sequential classification pass
+    analyzed_ply.move_type, analyzed_ply.alternative_moves = \
+        await evaluate_move(engine, grandmaster_side, False, last_analyzed_ply.analysis,
+                            analyzed_ply.half_move, analyzed_ply.move, last_analyzed_ply.expectation,
+                            analyzed_ply.expectation, analyzed_ply.board,
+                            tablebase=tablebase, san_cache=san_cache, max_pv_plies=pv_plies,
+                            scan_limit=settings.get_limit(), scan_budget=settings.scan_budget)
+
+
+# Analyse and classify every move of the game. The engine searches of all plies (and their alternative move scans)
+# are independent of each other and run concurrently on the engines of the pool, followed by a fast sequential
+# classification pass. Games analyzed with reduced search settings (see analyze --deadline) are marked as such.
+async def analyze_game(engine, normalized_player_name, grandmaster, game_to_analyze, tablebase=None, pv_plies=None,
+                       settings=FULL_SEARCH_SETTINGS):
+    game = game_to_analyze.game
+    opening = game_to_analyze.opening
+
+    grandmaster_side = get_grandmaster_side(grandmaster, game)
+    game_pgn = str(game)
+    opening_ply_length = get_opening_ply_length(opening)
+
+    # Initialize analyzed game
+    analyzed_game = AnalyzedGame(normalized_player_name, game_pgn, game, grandmaster_side)
+    analyzed_game.set_opening(opening)
+    if settings is not FULL_SEARCH_SETTINGS:
+        analyzed_game.set_search_settings(settings.to_json())
+
+    # Initialize plies of the game
+    board = game.board()
+    analyzed_plies = []
+    for move in game.mainline_moves():
+        analyzed_plies.append(AnalyzedPly(board.ply(), move, copy_board(board)))
+        board.push(move)
+
+    # SAN of moves played from the position before each move, shared by the move and its pv
+    san_caches = [{} for _ in analyzed_plies]
+
+    # Analysis phase: Analyse boards after all played moves
+    await asyncio.gather(*[analyse_ply(engine, analyzed_ply, grandmaster_side, tablebase, settings)
+                           for analyzed_ply in analyzed_plies])
+
+    # Evaluate all moves played after the opening
+    initial_ply = AnalyzedPly(-1, None, game.board())
+    initial_ply.expectation = 0.5
+    await asyncio.gather(*[evaluate_ply(engine, analyzed_ply, analyzed_plies[i - 1] if i > 0 else initial_ply,
+                                        grandmaster_side, tablebase, pv_plies, san_caches[i], settings)
+                           for i, analyzed_ply in enumerate(analyzed_plies)
+                           if analyzed_ply.half_move >= opening_ply_length])
+
+    # Intiialize Game Phase data
+    is_opening = True
+    is_midgame = False
+    is_endgame = False
+
+    # Intiialize Analysis data
+    score = None
+    last_opponent_move_was_blunder = False
+
+    # Initialize Statistics data
+    statistics = GameStatistics()
+
+    # Classification phase: Add moves played by both players in order
+    for i, analyzed_ply in enumerate(analyzed_plies):
+        # Move data
+        half_move = analyzed_ply.half_move
+        turn = analyzed_ply.turn
+        move = analyzed_ply.move
+        board = analyzed_ply.board
+        san_cache = san_caches[i]
+        move_san = get_san(board, move, san_cache)
+
+        # Update game phase
+        if not is_midgame and half_move == opening_ply_length:
+            is_opening = False
+            is_midgame = True
+            print()
+            print("Begin of midgame!")
+
+        # Analysis of board after played move
+        analysis = analyzed_ply.analysis
+        score = analyzed_ply.score
+        white_pov_score = get_current_score_for_grandmaster(score, chess.WHITE)
+        gm_pov_score = get_current_score_for_grandmaster(score, grandmaster_side)
+        expectation = analyzed_ply.expectation
+        pv = [move] + get_principle_variation(analysis)
+
+        # Update game phase
+        board.push(move)
+        if not is_endgame and is_in_endgame(board, score, expectation):
+            is_midgame = False
+            is_endgame = True
+            print()
+            print("Begin of endgame!")
+        board.pop()
+
+        # Update statistics data
+        statistics.add(half_move, gm_pov_score.score(), expectation)
+
+        pv_san = get_variation_san(board, pv, san_cache, pv_plies)
+
+        if is_opening:
+            # Add opening move played to analyzed game
+            analyzed_game.add_opening_move(ply=half_move, turn=turn, evaluated_move={
+                                               "move": {"uci": move.uci(), "san": move_san},
+                                               "moveType": MoveType.BOOK.value,
+                                               "signedCPScore": get_cp_score_string(white_pov_score),
+                                               "gmExpectation": expectation,
+                                               "pv": pv_san
+                                           })
+        else:
+            # Resolve the move types that depend on the classification of the previous move
+            move_type = apply_last_opponent_move_was_blunder(analyzed_ply.move_type, analyzed_ply.alternative_moves,
+                                                             last_opponent_move_was_blunder)
+
+            last_opponent_move_was_blunder = move_type == MoveType.BLUNDER
+            game_phase = GamePhase.ENDGAME if is_endgame else GamePhase.MIDGAME
+
+            # Add evaluated midgame/ endgame move to analyzed game
+            analyzed_game.add_move(ply=half_move, game_phase=game_phase, turn=turn, move_type=move_type.value,
+                                   evaluated_move={
+                                       "move": {"uci": move.uci(), "san": move_san},
+                                       "moveType": move_type.value,
+                                       "signedCPScore": get_cp_score_string(white_pov_score),
+                                       "gmExpectation": expectation,
+                                       "pv": pv_san
+                                   },
+                                   alternative_moves=analyzed_ply.alternative_moves)
+
+    # Determine depth to mate using endgame tablebase probing
+    if tablebase is not None:
+        board = game.end().board()
+        gm_depth_to_mate = get_gm_depth_to_mate(grandmaster_side, board, score, tablebase)
+        analyzed_game.set_gm_depth_to_mate(gm_depth_to_mate)
+
+    return analyzed_game, statistics
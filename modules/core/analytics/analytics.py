@@ -0,0 +1,159 @@
+import os
+
+import pandas as pd
+
+from modules.core.bundle.bundle import MANIFEST_FILE_NAME, get_grandmaster_name, read_bundle_file
+
+# Columns of the ply table that have few distinct values and are stored as categories
+CATEGORY_COLUMNS = ["grandmaster", "eco", "phase", "side", "move_type"]
+GROUP_BY_COLUMNS = ["grandmaster", "eco", "phase", "side", "move_type", "year"]
+
+# Share of the plies of a group that are of the move types counted as errors
+ERROR_MOVE_TYPES = ["blunder", "mistake", "inaccuracy"]
+
+
+# Get all analysis output files (merged files, per game files, bundles and their shards) below the given paths
+def get_analysis_files(paths):
+    analysis_files = []
+
+    for path in paths:
+        if not os.path.isdir(path):
+            analysis_files.append(path)
+            continue
+
+        for directory, directory_names, file_names in os.walk(path):
+            directory_names.sort()
+            analysis_files += [os.path.join(directory, file_name) for file_name in sorted(file_names)
+                               if file_name.endswith(".json") and file_name != MANIFEST_FILE_NAME]
+
+    return analysis_files
+
+
+# Read the analyzed games of all files. The same game is usually contained in several files (e.g. its per game file
+# and the merged file), games are told apart by their content derived id.
+def read_analyzed_games(analysis_files):
+    analyzed_games = {}
+
+    for analysis_file in analysis_files:
+        try:
+            content = read_bundle_file(analysis_file)
+        except (OSError, ValueError) as e:
+            print("Skipped", analysis_file + ":", e)
+            continue
+
+        for analyzed_game in content if isinstance(content, list) else [content]:
+            if isinstance(analyzed_game, dict) and "gameAnalysis" in analyzed_game:
+                analyzed_games.setdefault(analyzed_game["id"], analyzed_game)
+
+    return list(analyzed_games.values())
+
+
+def get_year(date):
+    year = date.split(".")[0]
+    return int(year) if year.isdigit() else None
+
+
+# Split a signed cp score string ("+35", "-120" or "M-3") into centipawns and moves to mate
+def parse_cp_score(signed_cp_score):
+    if signed_cp_score.startswith("M"):
+        return None, int(signed_cp_score[1:])
+    return int(signed_cp_score), None
+
+
+# Flatten the analyzed games into a table with one row per ply. Scores are from white's point of view, expectations
+# from the grandmaster's. The expectation loss is how much expectation the played move gave away compared to the best
+# evaluated move.
+def get_ply_table(analyzed_games):
+    columns = {name: [] for name in ["game_id", "grandmaster", "eco", "year", "ply", "phase", "side",
+                                     "grandmaster_move", "move_type", "cp_score", "mate", "gm_expectation",
+                                     "expectation_loss"]}
+
+    for analyzed_game in analyzed_games:
+        game_analysis = analyzed_game["gameAnalysis"]
+        grandmaster = get_grandmaster_name(analyzed_game)
+        grandmaster_side = game_analysis["grandmasterSide"]
+        eco = game_analysis["opening"]["eco"] if game_analysis["opening"] is not None else None
+        year = get_year(analyzed_game["gameInfo"]["date"])
+
+        for analyzed_move in game_analysis["analyzedMoves"]:
+            actual_move = analyzed_move["actualMove"]
+            cp_score, mate = parse_cp_score(actual_move["signedCPScore"])
+            best_expectation = max([actual_move["gmExpectation"]] + [alternative_move["gmExpectation"]
+                                                                      for alternative_move in
+                                                                      analyzed_move["alternativeMoves"]])
+            is_grandmaster_move = analyzed_move["turn"] == grandmaster_side
+
+            columns["game_id"].append(analyzed_game["id"])
+            columns["grandmaster"].append(grandmaster)
+            columns["eco"].append(eco)
+            columns["year"].append(year)
+            columns["ply"].append(analyzed_move["ply"])
+            columns["phase"].append(analyzed_move["gamePhase"])
+            columns["side"].append(analyzed_move["turn"])
+            columns["grandmaster_move"].append(is_grandmaster_move)
+            columns["move_type"].append(actual_move["moveType"])
+            columns["cp_score"].append(cp_score)
+            columns["mate"].append(mate)
+            columns["gm_expectation"].append(actual_move["gmExpectation"])
+            # The alternatives are the moves the grandmaster could have played, so the loss only exists for them
+            columns["expectation_loss"].append(best_expectation - actual_move["gmExpectation"]
+                                               if is_grandmaster_move else None)
+
+    plies = pd.DataFrame(columns)
+    for column in CATEGORY_COLUMNS:
+        plies[column] = plies[column].astype("category")
+
+    return plies.astype({"year": "Int16", "ply": "int16", "cp_score": "Float32", "mate": "Int16",
+                         "gm_expectation": "float32", "expectation_loss": "Float32"})
+
+
+# The table is saved as pickle (pandas' own binary format that needs no further dependencies) unless the file name asks
+# for Parquet or Feather, which need pyarrow
+def save_ply_table(plies, path):
+    if path.endswith(".parquet"):
+        plies.to_parquet(path)
+    elif path.endswith(".feather"):
+        plies.to_feather(path)
+    else:
+        plies.to_pickle(path)
+
+
+def read_ply_table(path):
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    if path.endswith(".feather"):
+        return pd.read_feather(path)
+    return pd.read_pickle(path)
+
+
+def filter_ply_table(plies, grandmasters=None, all_moves=False):
+    if grandmasters:
+        plies = plies[plies["grandmaster"].isin(grandmasters)]
+    if not all_moves:
+        plies = plies[plies["grandmaster_move"]]
+    return plies
+
+
+# Share of every move type within the groups. Grouping by move type itself leaves the share over all plies of the
+# other groups.
+def get_move_type_distribution(plies, group_by):
+    group_by = [column for column in group_by if column != "move_type"]
+    if not group_by:
+        move_type_counts = plies["move_type"].value_counts().to_frame("plies").T
+    else:
+        move_type_counts = plies.groupby(group_by + ["move_type"], observed=True).size() \
+            .unstack("move_type", fill_value=0)
+    return move_type_counts.div(move_type_counts.sum(axis=1), axis=0).round(3)
+
+
+# Accuracy of the moves within the groups
+def get_accuracy(plies, group_by):
+    plies = plies.assign(is_error=plies["move_type"].isin(ERROR_MOVE_TYPES))
+    accuracy = plies.groupby(group_by, observed=True).agg(
+        games=("game_id", "nunique"),
+        plies=("ply", "size"),
+        mean_gm_expectation=("gm_expectation", "mean"),
+        mean_expectation_loss=("expectation_loss", "mean"),
+        error_share=("is_error", "mean"),
+    )
+    return accuracy.round(4)
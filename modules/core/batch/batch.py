@@ -0,0 +1,78 @@
+import json
+import os
+from datetime import datetime
+
+from modules.core.pgn_index.pgn_index import get_pgn_files
+
+DEFAULT_BATCH_JOB_PRIORITY = 0
+
+
+class BatchJob:
+    def __init__(self, index, grandmaster, games, priority=DEFAULT_BATCH_JOB_PRIORITY, deadline=None, years=None,
+                 event=None):
+        self.index = index
+        self.grandmaster = grandmaster
+        self.games = games
+        self.priority = priority
+        self.deadline = deadline
+        self.years = years
+        self.event = event
+
+    # Jobs with the earliest deadline run first, jobs without deadline after all others. Jobs with the same
+    # deadline run by descending priority and finally in manifest order.
+    def get_schedule_key(self):
+        return (self.deadline is None, self.deadline or datetime.max, -self.priority, self.index)
+
+    def is_overdue(self, now=None):
+        return self.deadline is not None and (now or datetime.now()) > self.deadline
+
+
+# Deadlines are compared with the naive local time of datetime.now(), so deadlines with a UTC offset
+# (2021-07-12T06:00:00+02:00) are converted to local time
+def read_job_deadline(index, deadline):
+    try:
+        deadline = datetime.fromisoformat(deadline)
+    except (TypeError, ValueError):
+        raise ValueError('Batch job ' + str(index) + ' needs an ISO date and time as deadline')
+
+    if deadline.tzinfo is not None:
+        deadline = deadline.astimezone().replace(tzinfo=None)
+    return deadline
+
+
+# Read a batch manifest of the form
+# {"jobs": [{"grandmaster": "Carlsen,Magnus", "games": ["games/a.pgn", "games/"], "priority": 1,
+#            "deadline": "2021-07-12T06:00:00", "years": [2019, 2020], "event": "Olympiad"}, ...]}
+# PGN paths are relative to the manifest, directories stand for all pgn files they contain. Years and event
+# optionally restrict the games of the job like the filter options of the analyze command.
+def read_batch_manifest(manifest_path):
+    with open(manifest_path, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    jobs = []
+
+    for index, job in enumerate(manifest.get('jobs', [])):
+        if 'grandmaster' not in job or not job.get('games'):
+            raise ValueError('Batch job ' + str(index) + ' needs a grandmaster and at least one pgn file')
+
+        games = []
+        for games_path in job['games']:
+            games_path = os.path.join(manifest_dir, games_path)
+            if os.path.exists(games_path):
+                games += get_pgn_files(games_path)
+            else:
+                raise ValueError('Batch job ' + str(index) + ' references missing pgn file ' + games_path)
+
+        if not all(isinstance(year, int) for year in job.get('years', [])):
+            raise ValueError('Batch job ' + str(index) + ' needs whole numbers as years')
+
+        deadline = read_job_deadline(index, job['deadline']) if job.get('deadline') else None
+        jobs.append(BatchJob(index, job['grandmaster'], games, job.get('priority', DEFAULT_BATCH_JOB_PRIORITY),
+                             deadline, set(job.get('years', [])), job.get('event')))
+
+    return jobs
+
+
+def schedule_batch_jobs(jobs):
+    return sorted(jobs, key=BatchJob.get_schedule_key)
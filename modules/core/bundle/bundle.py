@@ -0,0 +1,343 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+
+from modules.core.output.output import get_analysis_content_hash
+from modules.core.writer.writer import write_file_atomically
+
+MANIFEST_FILE_NAME = 'manifest.json'
+
+SHARD_BY_GRANDMASTER = 'gm'
+SHARD_BY_ECO = 'eco'
+SHARD_BY_COUNT = 'count'
+SHARD_BY_OPTIONS = [SHARD_BY_GRANDMASTER, SHARD_BY_ECO, SHARD_BY_COUNT]
+
+# Default maximum size of the (uncompressed) json of a single shard in bytes
+DEFAULT_MAX_SHARD_BYTES = 4 * 1024 * 1024
+
+# Keys set by the player annotation (see player.py): full player names and elo ratings
+PLAYER_ANNOTATION_KEYS = ['whitePlayer', 'blackPlayer', 'whitePlayerRating', 'blackPlayerRating']
+
+
+def get_grandmaster_name(analyzed_game):
+    if analyzed_game['gameAnalysis']['grandmasterSide'] == 'white':
+        return analyzed_game['whitePlayer']
+    return analyzed_game['blackPlayer']
+
+
+def get_shard_group(analyzed_game, shard_by):
+    if shard_by == SHARD_BY_GRANDMASTER:
+        return get_grandmaster_name(analyzed_game)
+    if shard_by == SHARD_BY_ECO:
+        opening = analyzed_game['gameAnalysis']['opening']
+        return opening['eco'] if opening is not None else 'unknown'
+    return 'games'
+
+
+def get_safe_file_name(name):
+    return re.sub('[^A-Za-z0-9]+', '_', name).strip('_')
+
+
+# Different groups can have the same safe file name (e.g. "So, W" and "So W", or names without ASCII letters), so the
+# file names of their shards are told apart by a short hash of the group
+def get_shard_file_name(bundle_name, group, index):
+    group_hash = hashlib.sha1(group.encode('utf-8')).hexdigest()[:8]
+    return bundle_name + '_' + (get_safe_file_name(group) or 'group') + '_' + group_hash + '_' + str(index) + '.json'
+
+
+def get_manifest_game_entry(analyzed_game):
+    opening = analyzed_game['gameAnalysis']['opening']
+    return {
+        "id": analyzed_game['id'],
+        "whitePlayer": analyzed_game['whitePlayer'],
+        "blackPlayer": analyzed_game['blackPlayer'],
+        "grandmaster": get_grandmaster_name(analyzed_game),
+        "date": analyzed_game['gameInfo']['date'],
+        "opening": {"eco": opening['eco'], "name": opening['name']} if opening is not None else None,
+        "contentHash": get_analysis_content_hash(analyzed_game),
+    }
+
+
+# Split the games of a group into shards whose json is at most max_shard_bytes large (a single game larger
+# than that gets a shard of its own) and which contain at most max_games games
+def split_into_shards(encoded_games, max_shard_bytes, max_games=None):
+    shards = []
+    shard = []
+    shard_bytes = 2  # enclosing brackets of the json list
+
+    for analyzed_game, encoded_game in encoded_games:
+        game_bytes = len(encoded_game) + (2 if shard else 0)  # separator between games
+        is_full = (max_games is not None and len(shard) >= max_games) or shard_bytes + game_bytes > max_shard_bytes
+
+        if shard and is_full:
+            shards.append(shard)
+            shard = []
+            shard_bytes = 2
+            game_bytes = len(encoded_game)
+
+        shard.append((analyzed_game, encoded_game))
+        shard_bytes += game_bytes
+
+    if shard:
+        shards.append(shard)
+
+    return shards
+
+
+# Shards are rewritten in place when games are merged into a bundle, so they are written atomically like the output
+# files (see writer.py)
+def write_shard(shard_file_path, encoded_games):
+    write_file_atomically(shard_file_path, lambda shard_file: shard_file.write('[' + ', '.join(encoded_games) + ']'))
+
+    # Write gzipped shard that can be downloaded by the app on its own
+    gzipped_shard_file_path = os.path.splitext(shard_file_path)[0] + '_compressed'
+
+    def write_gzipped_shard(outfile):
+        with open(shard_file_path, 'rb') as file, \
+                gzip.GzipFile(os.path.basename(gzipped_shard_file_path), 'wb', fileobj=outfile) as gzipped_file:
+            gzipped_file.writelines(file)
+
+    write_file_atomically(gzipped_shard_file_path, write_gzipped_shard, 'wb')
+
+    return gzipped_shard_file_path
+
+
+def get_manifest_shard_entry(shard_file_path, gzipped_shard_file_path, group, analyzed_games):
+    return {
+        "file": os.path.basename(gzipped_shard_file_path),
+        "jsonFile": os.path.basename(shard_file_path),
+        "group": group,
+        "bytes": os.path.getsize(shard_file_path),
+        "compressedBytes": os.path.getsize(gzipped_shard_file_path),
+        "games": [get_manifest_game_entry(analyzed_game) for analyzed_game in analyzed_games],
+    }
+
+
+def write_manifest(bundle_dir, manifest):
+    write_file_atomically(os.path.join(bundle_dir, MANIFEST_FILE_NAME),
+                          lambda manifest_file: json.dump(manifest, manifest_file))
+
+
+def read_manifest(bundle_dir):
+    with open(os.path.join(bundle_dir, MANIFEST_FILE_NAME), 'r') as manifest_file:
+        return json.load(manifest_file)
+
+
+# Remove the shard files of an earlier bundle in the same directory that the new manifest does not list
+def remove_stale_shards(bundle_dir, old_manifest, manifest):
+    shard_files = {shard[name] for shard in manifest['shards'] for name in ('file', 'jsonFile')}
+    for shard in old_manifest['shards']:
+        for name in ('file', 'jsonFile'):
+            shard_file_path = os.path.join(bundle_dir, shard[name])
+            if shard[name] not in shard_files and os.path.isfile(shard_file_path):
+                os.remove(shard_file_path)
+
+
+def is_sharded_bundle(path):
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, MANIFEST_FILE_NAME))
+
+
+# Save the analyzed games as a directory of size capped shards (each as json and gzipped json) together with
+# a manifest listing the shards, their sizes and the games they contain, so that the app can fetch only the
+# shards it needs
+def save_sharded_bundle(analyzed_games, bundle_dir, shard_by=SHARD_BY_COUNT, max_shard_bytes=DEFAULT_MAX_SHARD_BYTES,
+                        max_games=None):
+    old_manifest = read_manifest(bundle_dir) if is_sharded_bundle(bundle_dir) else None
+    os.makedirs(bundle_dir, exist_ok=True)
+    bundle_name = os.path.basename(os.path.normpath(bundle_dir))
+
+    groups = {}
+    for analyzed_game in analyzed_games:
+        group = get_shard_group(analyzed_game, shard_by)
+        groups.setdefault(group, []).append((analyzed_game, json.dumps(analyzed_game)))
+
+    manifest = {"bundle": bundle_name, "shardBy": shard_by, "maxShardBytes": max_shard_bytes,
+                "maxShardGames": max_games, "shards": []}
+
+    for group in sorted(groups):
+        for i, shard in enumerate(split_into_shards(groups[group], max_shard_bytes, max_games)):
+            shard_file_path = os.path.join(bundle_dir, get_shard_file_name(bundle_name, group, i))
+            gzipped_shard_file_path = write_shard(shard_file_path, [encoded_game for _, encoded_game in shard])
+
+            manifest["shards"].append(get_manifest_shard_entry(shard_file_path, gzipped_shard_file_path, group,
+                                                               [analyzed_game for analyzed_game, _ in shard]))
+
+    write_manifest(bundle_dir, manifest)
+    if old_manifest is not None:
+        remove_stale_shards(bundle_dir, old_manifest, manifest)
+
+    print('Saved', len(manifest["shards"]), 'shards and manifest in', bundle_dir)
+    return manifest
+
+
+def read_bundle_file(bundle_file_path):
+    with open(bundle_file_path, 'r') as bundle_file:
+        return json.load(bundle_file)
+
+
+class MergeReport:
+    def __init__(self):
+        self.added = 0
+        self.replaced = 0
+        self.duplicates = 0
+        self.rewritten_shards = set()
+
+    def print(self):
+        print('Merged games: added', self.added, '| replaced', self.replaced, '| duplicates dropped', self.duplicates,
+              '| shards written', len(self.rewritten_shards))
+
+
+# Decide for each new game whether it is added, replaces an existing game with the same id but a changed analysis
+# or is a duplicate. Returns the games to add and the games to replace keyed by their id.
+def classify_new_games(new_games, existing_content_hashes, report):
+    games_to_add = []
+    games_to_replace = {}
+
+    for analyzed_game in new_games:
+        existing_content_hash = existing_content_hashes.get(analyzed_game['id'])
+
+        if existing_content_hash is None:
+            existing_content_hashes[analyzed_game['id']] = get_analysis_content_hash(analyzed_game)
+            games_to_add.append(analyzed_game)
+            report.added += 1
+        elif existing_content_hash == get_analysis_content_hash(analyzed_game):
+            report.duplicates += 1
+        else:
+            existing_content_hashes[analyzed_game['id']] = get_analysis_content_hash(analyzed_game)
+            games_to_replace[analyzed_game['id']] = analyzed_game
+            report.replaced += 1
+
+    return games_to_add, games_to_replace
+
+
+def is_annotated(analyzed_game):
+    return 'whitePlayerRating' in analyzed_game
+
+
+# Replaced games keep the date they were first added to the bundle. A replacement without player annotation (e.g. a
+# new analysis merged without --annotate) keeps the annotation of the replaced game, which also keeps the game in the
+# shard group of its grandmaster.
+def replace_games(analyzed_games, games_to_replace):
+    for i, analyzed_game in enumerate(analyzed_games):
+        replacement = games_to_replace.get(analyzed_game['id'])
+        if replacement is not None:
+            replacement['addedDate'] = analyzed_game['addedDate']
+            if is_annotated(analyzed_game) and not is_annotated(replacement):
+                for key in PLAYER_ANNOTATION_KEYS:
+                    replacement[key] = analyzed_game[key]
+            analyzed_games[i] = replacement
+
+
+def merge_into_bundle_file(bundle_file_path, new_games):
+    report = MergeReport()
+
+    analyzed_games = read_bundle_file(bundle_file_path)
+    existing_content_hashes = {analyzed_game['id']: get_analysis_content_hash(analyzed_game)
+                               for analyzed_game in analyzed_games}
+
+    games_to_add, games_to_replace = classify_new_games(new_games, existing_content_hashes, report)
+    if not games_to_add and not games_to_replace:
+        return report
+
+    replace_games(analyzed_games, games_to_replace)
+    analyzed_games += games_to_add
+
+    write_shard(bundle_file_path, [json.dumps(analyzed_game) for analyzed_game in analyzed_games])
+    report.rewritten_shards.add(os.path.basename(bundle_file_path))
+
+    return report
+
+
+# Merge new games into a sharded bundle in place. Only the shards containing replaced games and the last shard of a
+# group that new games are appended to are read and rewritten, all other shards stay untouched.
+def merge_into_sharded_bundle(bundle_dir, new_games):
+    report = MergeReport()
+
+    manifest = read_manifest(bundle_dir)
+    shard_by = manifest['shardBy']
+    max_shard_bytes = manifest.get('maxShardBytes') or DEFAULT_MAX_SHARD_BYTES
+    max_games = manifest.get('maxShardGames')
+
+    # Manifests written before the content hashes were added to them get the hashes of their games from the shards
+    is_backfilled = False
+    for shard in manifest['shards']:
+        if any('contentHash' not in game_entry for game_entry in shard['games']):
+            content_hashes = {analyzed_game['id']: get_analysis_content_hash(analyzed_game)
+                              for analyzed_game in read_bundle_file(os.path.join(bundle_dir, shard['jsonFile']))}
+            for game_entry in shard['games']:
+                game_entry['contentHash'] = content_hashes[game_entry['id']]
+            is_backfilled = True
+
+    existing_content_hashes = {}
+    shard_by_game_id = {}
+    for shard in manifest['shards']:
+        for game_entry in shard['games']:
+            existing_content_hashes[game_entry['id']] = game_entry['contentHash']
+            shard_by_game_id[game_entry['id']] = shard
+
+    games_to_add, games_to_replace = classify_new_games(new_games, existing_content_hashes, report)
+
+    # Load the shards that are going to be rewritten. The json size of the last shard of a group is counted along as
+    # new games are appended to it, so that the shard is encoded only once.
+    shard_games = {}
+    shard_bytes = {}
+
+    def load_shard(shard):
+        if shard['jsonFile'] not in shard_games:
+            shard_games[shard['jsonFile']] = read_bundle_file(os.path.join(bundle_dir, shard['jsonFile']))
+        return shard_games[shard['jsonFile']]
+
+    for game_id in games_to_replace:
+        replace_games(load_shard(shard_by_game_id[game_id]), games_to_replace)
+
+    # Append new games to the last shard of their group as long as it does not exceed the shard limits
+    for analyzed_game in games_to_add:
+        group = get_shard_group(analyzed_game, shard_by)
+        group_shards = [shard for shard in manifest['shards'] if shard['group'] == group]
+        encoded_game = json.dumps(analyzed_game)
+
+        last_shard = group_shards[-1] if group_shards else None
+        if last_shard is not None:
+            last_shard_games = load_shard(last_shard)
+            if last_shard['jsonFile'] not in shard_bytes:
+                shard_bytes[last_shard['jsonFile']] = len(json.dumps(last_shard_games))
+            is_full = (max_games is not None and len(last_shard_games) >= max_games) \
+                or shard_bytes[last_shard['jsonFile']] + len(encoded_game) + 2 > max_shard_bytes
+
+            if not is_full:
+                last_shard_games.append(analyzed_game)
+                shard_bytes[last_shard['jsonFile']] += len(encoded_game) + 2  # separator between games
+                continue
+
+        shard_file_path = os.path.join(bundle_dir, get_shard_file_name(manifest['bundle'], group, len(group_shards)))
+        new_shard = {"file": os.path.basename(os.path.splitext(shard_file_path)[0] + '_compressed'),
+                     "jsonFile": os.path.basename(shard_file_path), "group": group, "games": []}
+        manifest['shards'].append(new_shard)
+        shard_games[new_shard['jsonFile']] = [analyzed_game]
+        shard_bytes[new_shard['jsonFile']] = len(encoded_game) + 2  # enclosing brackets of the json list
+
+    # Rewrite changed shards and update their manifest entries
+    for i, shard in enumerate(manifest['shards']):
+        if shard['jsonFile'] not in shard_games:
+            continue
+
+        shard_file_path = os.path.join(bundle_dir, shard['jsonFile'])
+        analyzed_games = shard_games[shard['jsonFile']]
+        gzipped_shard_file_path = write_shard(shard_file_path, [json.dumps(analyzed_game)
+                                                                for analyzed_game in analyzed_games])
+        manifest['shards'][i] = get_manifest_shard_entry(shard_file_path, gzipped_shard_file_path, shard['group'],
+                                                         analyzed_games)
+        report.rewritten_shards.add(shard['jsonFile'])
+
+    if report.rewritten_shards or is_backfilled:
+        write_manifest(bundle_dir, manifest)
+
+    return report
+
+
+def merge_into_bundle(bundle_path, new_games):
+    if is_sharded_bundle(bundle_path):
+        return merge_into_sharded_bundle(bundle_path, new_games)
+    return merge_into_bundle_file(bundle_path, new_games)
@@ -0,0 +1,163 @@
+from datetime import datetime, timedelta
+
+from modules.core.analysis.analysis import SearchSettings, FULL_SEARCH_SETTINGS, GAME_POSITION_MULTIPV
+from modules.core.engine.engine import STOCKFISH_DEPTH
+from modules.core.info.info import format_duration
+
+# Number of games of a pgn file analyzed by analyze --estimate to measure the cost of its searches
+ESTIMATE_SAMPLE_GAMES = 3
+
+# Factor by which the time of a search grows with every additional ply of search depth. Used to predict the cost of
+# searches at depths that were not measured yet.
+DEPTH_COST_FACTOR = 1.6
+
+# Share of the time left until the deadline the predicted searches may take, the rest is kept for mispredictions
+DEADLINE_TIME_SHARE = 0.9
+
+# Search settings a run with deadline falls back to, from the most to the least thorough one
+REDUCED_SEARCH_SETTINGS = [
+    SearchSettings(max(1, STOCKFISH_DEPTH - 2), GAME_POSITION_MULTIPV, 12),
+    SearchSettings(max(1, STOCKFISH_DEPTH - 4), GAME_POSITION_MULTIPV, 6),
+    SearchSettings(max(1, STOCKFISH_DEPTH - 6), 2, 0),
+]
+
+
+# Deadlines are given as ISO date and time (2021-07-13T06:00) or as time of day (06:00), which is the next time the
+# clock shows it. Deadlines with a UTC offset (2021-07-13T06:00+02:00) are converted to local time.
+def parse_deadline(deadline, now=None):
+    now = now or datetime.now()
+    try:
+        return to_local_time(datetime.fromisoformat(deadline))
+    except ValueError:
+        pass
+
+    time_of_day = datetime.strptime(deadline, "%H:%M")
+    parsed_deadline = now.replace(hour=time_of_day.hour, minute=time_of_day.minute, second=0, microsecond=0)
+    if parsed_deadline <= now:
+        parsed_deadline += timedelta(days=1)
+    return parsed_deadline
+
+
+# Deadlines are compared with the naive local time of datetime.now()
+def to_local_time(moment):
+    if moment.tzinfo is None:
+        return moment
+    return moment.astimezone().replace(tzinfo=None)
+
+
+# Games spread evenly over the games of a file
+def select_sample_games(games_to_analyze, sample_games):
+    if sample_games >= len(games_to_analyze):
+        return list(games_to_analyze)
+    return [games_to_analyze[i * len(games_to_analyze) // sample_games] for i in range(sample_games)]
+
+
+# Cost of the engine searches of an analyze run, measured by the engine pool. Every ply costs the search of the
+# position after its move (multipv searches), every ply after the opening additionally the searches of the legal move
+# scan for a bad alternative move (single line searches). Predictions are scaled by the ratio of the wall clock time
+# the observed games took to the time their searches took on the engines of the pool, which covers the time spent
+# outside of searches and engines that share CPU cores.
+class CostModel:
+    def __init__(self, engine_pool):
+        self.engine_pool = engine_pool
+        self.observed_statistics = {}
+        # Evaluated plies and the scan searches they took by scan budget
+        self.scan_rates = {}
+        self.observed_seconds = 0.0
+        self.observed_search_seconds = 0.0
+
+    # Take over the searches the engine pool ran for games with the given number of evaluated plies since the last
+    # observation, which took the given wall clock seconds
+    def observe(self, evaluated_plies, settings, seconds):
+        scan_searches = 0
+        search_seconds = 0.0
+        for key, (searches, total_seconds) in self.engine_pool.search_statistics.items():
+            observed_searches, observed_seconds = self.observed_statistics.get(key, (0, 0.0))
+            search_seconds += total_seconds - observed_seconds
+            if key[1] == 1:
+                scan_searches += searches - observed_searches
+        self.observed_statistics = dict(self.engine_pool.search_statistics)
+
+        plies, scans = self.scan_rates.get(settings.scan_budget, (0, 0))
+        self.scan_rates[settings.scan_budget] = (plies + evaluated_plies, scans + scan_searches)
+        self.observed_seconds += seconds
+        self.observed_search_seconds += search_seconds / self.engine_pool.size
+
+    def get_overhead_factor(self):
+        if self.observed_search_seconds <= 0:
+            return 1.0
+        return max(1.0, self.observed_seconds / self.observed_search_seconds)
+
+    def is_calibrated(self):
+        return bool(self.scan_rates) and any(multipv > 1 and depth is not None
+                                             for depth, multipv in self.engine_pool.search_statistics)
+
+    # Seconds of a search, taken from the measured searches of the same kind closest in depth
+    def get_search_seconds(self, depth, multipv):
+        measured = [(key, searches, seconds) for key, (searches, seconds) in self.engine_pool.search_statistics.items()
+                    if key[0] is not None and searches > 0]
+        same_kind = [measurement for measurement in measured if (measurement[0][1] == 1) == (multipv == 1)]
+        if not measured:
+            return None
+
+        (measured_depth, measured_multipv), searches, seconds = \
+            min(same_kind or measured, key=lambda measurement: (abs(measurement[0][0] - depth),
+                                                                abs(measurement[0][1] - multipv)))
+        return seconds / searches * DEPTH_COST_FACTOR ** (depth - measured_depth) * multipv / measured_multipv
+
+    def get_scans_per_ply(self, scan_budget):
+        if scan_budget in self.scan_rates:
+            plies, scans = self.scan_rates[scan_budget]
+        elif None in self.scan_rates:
+            plies, scans = self.scan_rates[None]
+        else:
+            plies, scans = max(self.scan_rates.values(), key=lambda rate: rate[1] / rate[0] if rate[0] else 0)
+
+        scans_per_ply = scans / plies if plies else 0
+        return scans_per_ply if scan_budget is None else min(scans_per_ply, scan_budget)
+
+    # Engine seconds of a ply before and after the opening
+    def get_ply_seconds(self, settings):
+        book_ply_seconds = self.get_search_seconds(settings.depth, settings.multipv)
+        scans_per_ply = self.get_scans_per_ply(settings.scan_budget)
+        scan_seconds = self.get_search_seconds(settings.depth, 1) * scans_per_ply if scans_per_ply > 0 else 0
+        return book_ply_seconds, book_ply_seconds + scan_seconds
+
+    # Wall clock seconds of analyzing the positions and evaluated plies with the engines of the pool
+    def predict_seconds(self, positions, evaluated_plies, settings):
+        book_ply_seconds, evaluated_ply_seconds = self.get_ply_seconds(settings)
+        scan_seconds = evaluated_ply_seconds - book_ply_seconds
+        return (positions * book_ply_seconds + evaluated_plies * scan_seconds) / self.engine_pool.size \
+            * self.get_overhead_factor()
+
+    def print_report(self, settings=FULL_SEARCH_SETTINGS):
+        book_ply_seconds, evaluated_ply_seconds = self.get_ply_seconds(settings)
+        print("Position search:", round(self.get_search_seconds(settings.depth, settings.multipv), 3),
+              "seconds (depth", str(settings.depth) + ", multipv", str(settings.multipv) + ")")
+        print("Legal move scan:", round(self.get_search_seconds(settings.depth, 1), 3), "seconds per search,",
+              round(self.get_scans_per_ply(settings.scan_budget), 2), "searches per evaluated ply")
+        print("Engine seconds per book ply:", round(book_ply_seconds, 3), "per evaluated ply:",
+              round(evaluated_ply_seconds, 3), "(wall clock overhead factor", str(round(self.get_overhead_factor(), 2))
+              + ")")
+
+
+# The most thorough search settings whose predicted runtime for the remaining positions and evaluated plies fits into
+# the time left. Until the first game has been measured, games are analyzed with full settings.
+def choose_search_settings(cost_model, positions, evaluated_plies, seconds_left):
+    if not cost_model.is_calibrated():
+        return FULL_SEARCH_SETTINGS
+
+    for settings in [FULL_SEARCH_SETTINGS] + REDUCED_SEARCH_SETTINGS:
+        if cost_model.predict_seconds(positions, evaluated_plies, settings) <= seconds_left * DEADLINE_TIME_SHARE:
+            return settings
+    return REDUCED_SEARCH_SETTINGS[-1]
+
+
+def get_settings_description(settings):
+    return "depth " + str(settings.depth) + ", multipv " + str(settings.multipv) + ", scan budget " \
+        + ("all legal moves" if settings.scan_budget is None else str(settings.scan_budget))
+
+
+def get_finish_description(seconds):
+    finish = datetime.now() + timedelta(seconds=seconds)
+    return format_duration(seconds) + " (finishing around " + finish.strftime("%Y-%m-%d %H:%M") + ")"
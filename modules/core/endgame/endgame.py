@@ -1,9 +1,16 @@
+import chess.engine
 import chess.gaviota
 
 from modules.core.score.score import QUEEN_MATERIAL_VALUE, ROOK_MATERIAL_VALUE, get_material_value
 
 GAVIOTA_FILE_PATH = "data/gaviota"
 
+# Gaviota tablebases cover positions with up to five pieces (including both kings) and without castling rights
+TABLEBASE_MAX_PIECES = 5
+
+# Number of half moves of the tablebase principal variation that is reported for a position
+TABLEBASE_PV_LENGTH = 10
+
 # The start of the endgame is not well defined. Therefore we use a common simple rule that says
 # that a game is in endgame if both players have a material value less than the value of a Queen
 # and a Rook combined or if the  game has a clear winning side.
@@ -11,6 +18,142 @@ GAVIOTA_FILE_PATH = "data/gaviota"
 ENDGAME_IF_MATERIAL_VALUE_IS_LESS_THAN = QUEEN_MATERIAL_VALUE + ROOK_MATERIAL_VALUE
 
 
+class EndgameTablebase:
+    def __init__(self, directory=GAVIOTA_FILE_PATH):
+        self.directory = directory
+        self.tablebase = None
+        self.dtm_cache = {}
+        self.ranked_moves_cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def initialize(self):
+        self.tablebase = chess.gaviota.open_tablebase(self.directory)
+
+    def close(self):
+        if self.tablebase is not None:
+            self.tablebase.close()
+            self.tablebase = None
+
+    def covers(self, board):
+        return not board.castling_rights and chess.popcount(board.occupied) <= TABLEBASE_MAX_PIECES
+
+    def get_dtm(self, board):
+        assert self.tablebase is not None, "tablebase should be initialized"
+
+        key = board.epd()
+        if key in self.dtm_cache:
+            self.hits += 1
+            return self.dtm_cache[key]
+
+        self.misses += 1
+        dtm = self.tablebase.get_dtm(board) if self.covers(board) else None
+        self.dtm_cache[key] = dtm
+        return dtm
+
+    # Get the exact score of the board relative to the side to move or None if the board is not covered
+    def get_relative_score(self, board):
+        if board.is_checkmate():
+            return chess.engine.Mate(0)
+
+        dtm = self.get_dtm(board)
+        if dtm is None:
+            return None
+
+        # Gaviota counts half moves to mate while UCI engines report mates in full moves
+        if dtm > 0:
+            return chess.engine.Mate((dtm + 1) // 2)
+        if dtm < 0:
+            return chess.engine.Mate(dtm // 2)
+        return chess.engine.Cp(0)
+
+    # Rank all legal moves of the board from the perspective of the side to move (best move first)
+    def get_ranked_moves(self, board):
+        key = board.epd()
+        if key in self.ranked_moves_cache:
+            return self.ranked_moves_cache[key]
+
+        ranked_moves = []
+        for move in board.legal_moves:
+            board.push(move)
+            score_after_move = self.get_relative_score(board)
+            board.pop()
+
+            if score_after_move is None:
+                ranked_moves = None
+                break
+
+            ranked_moves.append((get_score_of_move(score_after_move), move))
+
+        if ranked_moves is not None:
+            ranked_moves.sort(key=lambda ranked_move: ranked_move[0], reverse=True)
+
+        self.ranked_moves_cache[key] = ranked_moves
+        return ranked_moves
+
+    def get_principle_variation(self, board, length=TABLEBASE_PV_LENGTH):
+        pv = []
+        for _ in range(length):
+            if board.is_game_over():
+                break
+
+            ranked_moves = self.get_ranked_moves(board)
+            if not ranked_moves:
+                break
+
+            move = ranked_moves[0][1]
+            board.push(move)
+            pv.append(move)
+
+        for _ in pv:
+            board.pop()
+
+        return pv
+
+    # Create an analysis in the same shape as the one returned by the UCI engine or None if the board is not
+    # covered by the tablebase
+    def analyse(self, board, multipv=3):
+        if self.tablebase is None or not self.covers(board):
+            return None
+
+        if board.is_game_over():
+            score = self.get_relative_score(board)
+            if score is None:
+                return None
+            return [{"score": chess.engine.PovScore(score, board.turn)}]
+
+        ranked_moves = self.get_ranked_moves(board)
+        if ranked_moves is None:
+            return None
+
+        analysis = []
+        for score, move in ranked_moves[:multipv]:
+            board.push(move)
+            pv = [move] + self.get_principle_variation(board, TABLEBASE_PV_LENGTH - 1)
+            board.pop()
+
+            analysis.append({"score": chess.engine.PovScore(score, board.turn), "pv": pv})
+
+        return analysis
+
+
+def open_endgame_tablebase(directory=GAVIOTA_FILE_PATH):
+    tablebase = EndgameTablebase(directory)
+    tablebase.initialize()
+    return tablebase
+
+
+# Convert the score relative to the side to move after a move into the score of the move for the side that played it
+def get_score_of_move(score_after_move):
+    mate = score_after_move.mate()
+
+    if mate is None:
+        return -score_after_move
+    if mate <= 0:
+        return chess.engine.Mate(-mate + 1)
+    return chess.engine.Mate(-mate)
+
+
 def is_in_endgame(board, score, expectation):
     if score.is_mate() or expectation == 1:
         return True
@@ -22,24 +165,23 @@ def is_in_endgame(board, score, expectation):
            and material_value_black <= ENDGAME_IF_MATERIAL_VALUE_IS_LESS_THAN
 
 
-def get_gm_depth_to_mate(gm_side, board, last_score):
+def get_gm_depth_to_mate(gm_side, board, last_score, tablebase):
     sign = 1 if gm_side == board.turn else -1
 
     print()
     print("Trying to determine depth to mate using Gaviota tablebases.")
 
     # Gaviota endgame tablebases can tell us that the player to move mates in a certain amount of half moves
-    with chess.gaviota.open_tablebase(GAVIOTA_FILE_PATH) as tablebase:
-        gm_depth_to_mate = tablebase.get_dtm(board)
+    gm_depth_to_mate = tablebase.get_dtm(board)
 
-        if gm_depth_to_mate is None:
-            print("Gaviota could not find a DTM for the last board in the game. Trying to get mate in with engine.")
+    if gm_depth_to_mate is None:
+        print("Gaviota could not find a DTM for the last board in the game. Trying to get mate in with engine.")
 
-            if last_score.is_mate():
-                gm_depth_to_mate = last_score.relative.moves
+        if last_score.is_mate():
+            gm_depth_to_mate = last_score.relative.moves
 
-        if gm_depth_to_mate is not None:
-            gm_depth_to_mate = sign * gm_depth_to_mate
-            print("Found Depth to Mate in Half Moves:", gm_depth_to_mate)
+    if gm_depth_to_mate is not None:
+        gm_depth_to_mate = sign * gm_depth_to_mate
+        print("Found Depth to Mate in Half Moves:", gm_depth_to_mate)
 
     return gm_depth_to_mate
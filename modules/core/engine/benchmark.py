@@ -0,0 +1,78 @@
+import time
+
+import chess
+import chess.engine
+import chess.pgn
+
+from modules.core.engine.engine import initialize_uci_engine
+
+
+# Get the positions of the mainlines of the games of a pgn file
+def read_benchmark_boards(pgn_path, max_positions):
+    boards = []
+
+    with open(pgn_path, "r") as pgn:
+        while len(boards) < max_positions:
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                break
+
+            board = game.board()
+            for move in game.mainline_moves():
+                board.push(move)
+                boards.append(board.copy())
+
+    return boards[:max_positions]
+
+
+# Search all boards one after the other with a single engine. Returns the analyses, the wall clock seconds and the
+# CPU seconds of this process, which is the time python spends driving the engine and decoding its output.
+async def run_driver_benchmark(boards, limit, multipv, lean_uci):
+    engine = await initialize_uci_engine(lean_uci=lean_uci)
+    analyses = []
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    for board in boards:
+        analyses.append(await engine.analyse(board, limit=limit, multipv=multipv))
+    cpu_seconds = time.process_time() - cpu_start
+    seconds = time.perf_counter() - start
+
+    await engine.quit()
+    return analyses, seconds, cpu_seconds
+
+
+# Positions whose analyses differ in the score or principal variation of any line
+def count_analysis_differences(analyses, other_analyses):
+    differences = 0
+    for analysis, other_analysis in zip(analyses, other_analyses):
+        if [(info.get("score"), info.get("pv")) for info in analysis] \
+                != [(info.get("score"), info.get("pv")) for info in other_analysis]:
+            differences += 1
+    return differences
+
+
+def get_driver_report(seconds, cpu_seconds, search_count):
+    return {
+        "seconds": round(seconds, 3),
+        "cpuSeconds": round(cpu_seconds, 3),
+        "cpuMsPerSearch": round(cpu_seconds / search_count * 1000, 3) if search_count else None,
+    }
+
+
+# Compare python-chess' analyse with the lean UCI driver on the same positions
+async def run_uci_benchmark(boards, depth, multipv):
+    limit = chess.engine.Limit(depth=depth)
+
+    python_chess_analyses, python_chess_seconds, python_chess_cpu_seconds = \
+        await run_driver_benchmark(boards, limit, multipv, False)
+    lean_analyses, lean_seconds, lean_cpu_seconds = await run_driver_benchmark(boards, limit, multipv, True)
+
+    return {
+        "searches": len(boards),
+        "depth": depth,
+        "multipv": multipv,
+        "pythonChess": get_driver_report(python_chess_seconds, python_chess_cpu_seconds, len(boards)),
+        "leanUci": get_driver_report(lean_seconds, lean_cpu_seconds, len(boards)),
+        "differences": count_analysis_differences(python_chess_analyses, lean_analyses),
+    }
@@ -1,27 +1,327 @@
+import asyncio
+import collections
+import contextlib
+import os
+import sys
+import time
+
 import chess.engine
 
+from modules.core.engine.lean_engine import LeanUciEngine
+from modules.core.engine.service_client import PRIORITY_BATCH, PRIORITY_INTERACTIVE, ServiceEngine, \
+    ServiceEngineSync
+
 # Engine Options
-ENGINE_PATH = "/usr/games/stockfish"
+# The ENGINE_PATH environment variable overrides the configured engine, "scripted" selects the deterministic stand-in
+# engine of scripted_engine.py (e.g. for load tests without Stockfish)
+ENGINE_PATH = os.environ.get("ENGINE_PATH", "/usr/games/stockfish")
+SCRIPTED_ENGINE = "scripted"
+
+# Socket of a running engine service (see engine_service.py). If set, searches are sent to the service, which owns
+# the engine processes and their hash memory, instead of to engines started by this process.
+ENGINE_SERVICE_PATH = os.environ.get("ENGINE_SERVICE")
+DEFAULT_ENGINE_SERVICE_SOCKET = "/tmp/guess-the-move-engines.sock"
 
 THREADS = 4
 HASH_MEMORY = 2048
 STOCKFISH_DEPTH = 18
 
+# Engine supervision: seconds after which a search counts as hung, and how often a search is retried on a restarted
+# engine after the engine crashed or hung
+SEARCH_TIMEOUT = 300
+SEARCH_RETRIES = 2
+ENGINE_QUIT_TIMEOUT = 5
+
+# Restarting an engine is attempted a few times, waiting longer after every failed start (e.g. while the engine
+# service is restarted). An engine that can not be started is dropped from the pool.
+ENGINE_START_TIMEOUT = 30
+ENGINE_START_RETRIES = 3
+ENGINE_START_BACKOFF = 2
+
+# Default maximum number of analyses the cache of the long-running engine service keeps
+SERVICE_CACHE_SIZE = 200000
+
+
+# Raised if a search failed on every retry, so that the caller can give up on the game instead of the whole run
+class EngineSearchError(chess.engine.EngineError):
+    pass
+
+
+def is_engine_service_used():
+    return bool(ENGINE_SERVICE_PATH)
+
+
+def get_engine_command():
+    if ENGINE_PATH == SCRIPTED_ENGINE:
+        return [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripted_engine.py")]
+    return ENGINE_PATH
+
+
+# The lean driver and the engine service only support analyse (see lean_engine.py and service_client.py), so they
+# can not be used for iterative analyses
+async def initialize_uci_engine(use_nnue = False, lean_uci=False, priority=PRIORITY_BATCH):
+    if ENGINE_SERVICE_PATH:
+        return await ServiceEngine.connect(ENGINE_SERVICE_PATH, priority)
 
-async def initialize_uci_engine(use_nnue = False):
-    _, engine = await chess.engine.popen_uci(ENGINE_PATH)
+    if lean_uci:
+        engine = await LeanUciEngine.popen(get_engine_command())
+    else:
+        _, engine = await chess.engine.popen_uci(get_engine_command())
     await engine.configure({"Threads": THREADS, "Hash": HASH_MEMORY, "USE NNUE": use_nnue})
     return engine
 
 
-def initialize_uci_engine_sync():
-    return chess.engine.SimpleEngine.popen_uci(ENGINE_PATH)
+def initialize_uci_engine_sync(priority=PRIORITY_INTERACTIVE):
+    if ENGINE_SERVICE_PATH:
+        return ServiceEngineSync(ENGINE_SERVICE_PATH, priority)
+    return chess.engine.SimpleEngine.popen_uci(get_engine_command())
 
 
-async def analyse_board(engine, board, multipv=3, limit=chess.engine.Limit(depth=STOCKFISH_DEPTH)):
+async def analyse_board(engine, board, multipv=3, limit=chess.engine.Limit(depth=STOCKFISH_DEPTH), tablebase=None):
+    # Positions covered by the endgame tablebase are scored exactly without an engine search
+    if tablebase is not None:
+        analysis = tablebase.analyse(board, multipv)
+        if analysis is not None:
+            return analysis
+
     result = await engine.analyse(board, limit=limit, multipv=multipv)
     return result
 
 
-def analyse_board_sync(engine, board, multipv=3, limit=chess.engine.Limit(depth=STOCKFISH_DEPTH)):
+def analyse_board_sync(engine, board, multipv=3, limit=chess.engine.Limit(depth=STOCKFISH_DEPTH), tablebase=None):
+    if tablebase is not None:
+        analysis = tablebase.analyse(board, multipv)
+        if analysis is not None:
+            return analysis
+
     return engine.analyse(board, limit=limit, multipv=multipv)
+
+
+# Cache of engine analyses keyed by the normalized position (EPD) and the search depth. An analysis with more
+# principal variations also answers requests for fewer ones (e.g. the multipv 1 searches of the legal move scan).
+# With a maximum size, the least recently used analyses are evicted. Analyze runs keep all analyses, as the
+# classification of the games reads the analyses of the planning pass.
+class AnalysisCache:
+    def __init__(self, max_size=None):
+        self.analyses = collections.OrderedDict()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.analyses)
+
+    @staticmethod
+    def get_key(board, limit):
+        # Only depth limited searches are reproducible and can be cached
+        if limit is None or limit.depth is None or limit.time is not None or limit.nodes is not None:
+            return None
+        return board.epd(), limit.depth
+
+    def get(self, board, limit, multipv):
+        key = self.get_key(board, limit)
+        cached = self.analyses.get(key) if key is not None else None
+
+        # Fewer lines than requested are fine if the position has no more legal moves
+        if cached is None or (cached[0] < multipv and len(cached[1]) == cached[0]):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.analyses.move_to_end(key)
+        return cached[1][:multipv]
+
+    def put(self, board, limit, multipv, analysis):
+        key = self.get_key(board, limit)
+        if key is None:
+            return
+
+        cached = self.analyses.get(key)
+        if cached is not None and cached[0] >= multipv:
+            return
+
+        # Only keep what the analysis pipeline uses of each principal variation
+        self.analyses[key] = (multipv, [{name: info[name] for name in ("score", "pv") if name in info}
+                                        for info in analysis])
+        self.analyses.move_to_end(key)
+
+        if self.max_size is not None:
+            while len(self.analyses) > self.max_size:
+                self.analyses.popitem(last=False)
+
+
+# Pool of async UCI engines that can be shared by concurrent analyses. The pool provides the same analyse
+# interface as a single engine, so it can be passed to analyse_board wherever an engine is expected.
+# If a cache is given, the pool answers repeated positions from it and runs concurrent searches of the same
+# position only once.
+#
+# The pool supervises its engines: a search that fails because its engine died or that does not finish within the
+# search timeout is retried on a restarted engine. Engines that can not be restarted are dropped from the pool, and
+# once no engine is left every search fails with an EngineSearchError.
+#
+# With an engine service, the engines of the pool are connections to the service and the size of the pool is the
+# number of searches the pool submits at the same time with its priority class.
+class EnginePool:
+    def __init__(self, size=1, use_nnue=False, cache=None, search_timeout=SEARCH_TIMEOUT,
+                 search_retries=SEARCH_RETRIES, lean_uci=False, priority=PRIORITY_BATCH):
+        self.size = size
+        self.priority = priority
+        self.use_nnue = use_nnue
+        self.lean_uci = lean_uci
+        self.cache = cache
+        self.search_timeout = search_timeout
+        self.search_retries = search_retries
+        self.engines = []
+        self.idle_engines = None
+        self.pending_analyses = {}
+        self.restarts = 0
+        self.lost_engines = 0
+        # Searches requested from the pool (positions scored by the tablebase never reach it), how many of them were
+        # answered by the cache or joined a running search of the same position, and the searches the engines ran
+        self.search_requests = 0
+        self.cache_hits = 0
+        self.joined_searches = 0
+        self.engine_searches = 0
+        # Number of engine searches and their total seconds by search depth and number of principal variations
+        self.search_statistics = {}
+
+    async def initialize(self):
+        self.idle_engines = asyncio.Queue()
+
+        for _ in range(self.size):
+            engine = await initialize_uci_engine(self.use_nnue, self.lean_uci, self.priority)
+            self.engines.append(engine)
+            self.idle_engines.put_nowait(engine)
+
+    # Once every engine is lost, the idle queue holds None, which wakes up all searches waiting for an engine
+    async def get_idle_engine(self):
+        engine = await self.idle_engines.get()
+        if engine is None:
+            self.idle_engines.put_nowait(None)
+            raise EngineSearchError("No engine of the pool is left")
+        return engine
+
+    # Borrow an idle engine for the duration of the context, e.g. for an iterative engine.analysis()
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        engine = await self.get_idle_engine()
+        try:
+            yield engine
+        finally:
+            # Never hand out an engine whose process has terminated
+            if engine.returncode.done():
+                await self.replace_engine(engine)
+            else:
+                self.idle_engines.put_nowait(engine)
+
+    # Replace a crashed or hung engine by a new, identically configured one. The old engine is stopped first.
+    # Raises an EngineSearchError if no new engine could be started.
+    async def restart_engine(self, engine):
+        try:
+            await asyncio.wait_for(engine.quit(), timeout=ENGINE_QUIT_TIMEOUT)
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError, asyncio.TimeoutError, OSError):
+            # Hung engines do not react to quit
+            engine.transport.kill()
+
+        for attempt in range(ENGINE_START_RETRIES):
+            try:
+                new_engine = await asyncio.wait_for(
+                    initialize_uci_engine(self.use_nnue, self.lean_uci, self.priority), timeout=ENGINE_START_TIMEOUT)
+            except (chess.engine.EngineError, chess.engine.EngineTerminatedError, asyncio.TimeoutError,
+                    OSError) as e:
+                print("Engine start failed (attempt", str(attempt + 1) + "):", type(e).__name__, e)
+                if attempt + 1 < ENGINE_START_RETRIES:
+                    await asyncio.sleep(ENGINE_START_BACKOFF * 2 ** attempt)
+                continue
+
+            self.engines[self.engines.index(engine)] = new_engine
+            self.restarts += 1
+            print("Restarted engine", self.engines.index(new_engine) + 1, "of", self.size)
+            return new_engine
+
+        self.engines.remove(engine)
+        self.lost_engines += 1
+        print("Dropped engine after", ENGINE_START_RETRIES, "failed starts,", len(self.engines), "of", self.size,
+              "engines left")
+        if not self.engines:
+            self.idle_engines.put_nowait(None)
+        raise EngineSearchError("Engine could not be restarted")
+
+    # Restart the engine and hand the new engine to the idle queue. The restart is shielded, so that a cancelled
+    # search does not lose the engine while it is restarted.
+    async def replace_engine(self, engine):
+        async def restart_and_release():
+            self.idle_engines.put_nowait(await self.restart_engine(engine))
+
+        await asyncio.shield(asyncio.ensure_future(restart_and_release()))
+
+    async def analyse(self, board, limit=None, multipv=None):
+        self.search_requests += 1
+        if self.cache is None:
+            self.engine_searches += 1
+            return await self.analyse_uncached(board, limit, multipv)
+
+        multipv = multipv or 1
+        analysis = self.cache.get(board, limit, multipv)
+        if analysis is not None:
+            self.cache_hits += 1
+            return analysis
+
+        key = (self.cache.get_key(board, limit), multipv)
+        pending_analysis = self.pending_analyses.get(key)
+        if pending_analysis is not None:
+            self.joined_searches += 1
+            return await asyncio.shield(pending_analysis)
+
+        self.engine_searches += 1
+        pending_analysis = asyncio.ensure_future(self.analyse_uncached(board.copy(), limit, multipv))
+        if key[0] is not None:
+            self.pending_analyses[key] = pending_analysis
+
+        try:
+            analysis = await asyncio.shield(pending_analysis)
+        finally:
+            self.pending_analyses.pop(key, None)
+
+        self.cache.put(board, limit, multipv, analysis)
+        return analysis
+
+    # Searches sent to the engine service wait in its queues, the service supervises its engines itself
+    def get_search_timeout(self):
+        return None if is_engine_service_used() else self.search_timeout
+
+    async def analyse_uncached(self, board, limit=None, multipv=None):
+        for attempt in range(self.search_retries + 1):
+            # If the analysis is cancelled, python-chess stops the running search before the engine gets the next one
+            engine = await self.get_idle_engine()
+            try:
+                start = time.perf_counter()
+                analysis = await asyncio.wait_for(engine.analyse(board, limit=limit, multipv=multipv),
+                                                  timeout=self.get_search_timeout())
+            except (chess.engine.EngineError, chess.engine.EngineTerminatedError, asyncio.TimeoutError) as e:
+                print("Engine search of", board.fen(), "failed (attempt", str(attempt + 1) + "):",
+                      type(e).__name__, e)
+                # Only a live engine goes back to the idle queue
+                await self.replace_engine(engine)
+                continue
+            except BaseException:
+                self.idle_engines.put_nowait(engine)
+                raise
+
+            self.idle_engines.put_nowait(engine)
+            self.record_search(limit, multipv, time.perf_counter() - start)
+            return analysis
+
+        raise EngineSearchError("Engine search of " + board.fen() + " failed " + str(self.search_retries + 1)
+                                + " times")
+
+    def record_search(self, limit, multipv, seconds):
+        key = (limit.depth if limit is not None else None, multipv or 1)
+        searches, total_seconds = self.search_statistics.get(key, (0, 0.0))
+        self.search_statistics[key] = (searches + 1, total_seconds + seconds)
+
+    async def quit(self):
+        for engine in self.engines:
+            await engine.quit()
+
+        self.engines = []
@@ -0,0 +1,178 @@
+import asyncio
+import collections
+import json
+import os
+
+from modules.core.engine.service_client import PRIORITY_BATCH, PRIORITY_CLASSES, PRIORITY_INTERACTIVE, \
+    decode_board, decode_limit, encode_analysis
+
+
+# Search a client submitted to the engine service. The response is written to the connection of the client.
+class SearchJob:
+    def __init__(self, client_jobs, writer, request_id, board, limit, multipv, priority):
+        self.client_jobs = client_jobs
+        self.writer = writer
+        self.request_id = request_id
+        self.board = board
+        self.limit = limit
+        self.multipv = multipv
+        self.priority = priority
+        self.task = None
+        self.is_cancelled = False
+        self.is_preempted = False
+
+    def respond(self, response):
+        self.client_jobs.pop(self.request_id, None)
+        if self.is_cancelled or self.writer.is_closing():
+            return
+
+        response["id"] = self.request_id
+        self.writer.write((json.dumps(response) + "\n").encode("utf-8"))
+
+
+# Local engine service that owns the engine processes and their hash memory, so that several analyze runs and the
+# API share the engines of the machine instead of oversubscribing its cores. Searches are queued per priority class:
+# a free engine always starts the next interactive search before the next batch search, and an interactive search
+# that finds no free engine preempts a running batch search, which is requeued at the front of its class. The class
+# limits cap the number of searches of a class running at the same time.
+class EngineService:
+    def __init__(self, engine_pool, class_limits):
+        self.engine_pool = engine_pool
+        self.class_limits = class_limits
+        self.queues = {priority: collections.deque() for priority in PRIORITY_CLASSES}
+        self.running = {priority: [] for priority in PRIORITY_CLASSES}
+        self.searches = {priority: 0 for priority in PRIORITY_CLASSES}
+        self.preemptions = 0
+
+    def get_free_engines(self):
+        return self.engine_pool.size - sum(len(running) for running in self.running.values())
+
+    def submit(self, job):
+        cache = self.engine_pool.cache
+        analysis = cache.get(job.board, job.limit, job.multipv) if cache is not None else None
+        if analysis is not None:
+            job.respond({"analysis": encode_analysis(analysis)})
+            return
+
+        self.queues[job.priority].append(job)
+        if job.priority == PRIORITY_INTERACTIVE and self.get_free_engines() == 0 \
+                and len(self.running[PRIORITY_INTERACTIVE]) < self.class_limits[PRIORITY_INTERACTIVE]:
+            self.preempt_batch_search()
+        self.dispatch()
+
+    # Stop the most recently started batch search, it is searched again once an engine is free
+    def preempt_batch_search(self):
+        running_batch_jobs = [job for job in self.running[PRIORITY_BATCH] if not job.is_preempted]
+        if not running_batch_jobs:
+            return
+
+        # A search that already finished is answered instead
+        job = running_batch_jobs[-1]
+        if job.task.cancel():
+            job.is_preempted = True
+            self.preemptions += 1
+
+    # Start queued searches on free engines, higher priority classes first
+    def dispatch(self):
+        while self.get_free_engines() > 0:
+            for priority in PRIORITY_CLASSES:
+                if self.queues[priority] and len(self.running[priority]) < self.class_limits[priority]:
+                    self.start(self.queues[priority].popleft())
+                    break
+            else:
+                return
+
+    def start(self, job):
+        self.running[job.priority].append(job)
+        self.searches[job.priority] += 1
+        job.task = asyncio.ensure_future(self.engine_pool.analyse_uncached(job.board, job.limit, job.multipv))
+        job.task.add_done_callback(lambda task: self.finish(job, task))
+
+    def finish(self, job, task):
+        self.running[job.priority].remove(job)
+
+        if job.is_preempted and not job.is_cancelled:
+            job.is_preempted = False
+            job.task = None
+            self.queues[job.priority].appendleft(job)
+        elif not task.cancelled():
+            if task.exception() is not None:
+                job.respond({"error": str(task.exception())})
+            else:
+                analysis = task.result()
+                if self.engine_pool.cache is not None:
+                    self.engine_pool.cache.put(job.board, job.limit, job.multipv, analysis)
+                job.respond({"analysis": encode_analysis(analysis)})
+
+        self.dispatch()
+
+    # Searches of clients that cancelled them or disconnected are dropped from the queue or stopped
+    def cancel(self, job):
+        job.is_cancelled = True
+        if job.task is not None:
+            job.task.cancel()
+        elif job in self.queues[job.priority]:
+            self.queues[job.priority].remove(job)
+
+    async def handle_client(self, reader, writer):
+        client_jobs = {}
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                request = json.loads(line)
+                if request.get("cancel"):
+                    job = client_jobs.pop(request["id"], None)
+                    if job is not None:
+                        self.cancel(job)
+                    continue
+
+                try:
+                    job = SearchJob(client_jobs, writer, request["id"], decode_board(request["board"]),
+                                    decode_limit(request["limit"]), request["multipv"], request["priority"])
+                    if job.priority not in self.queues:
+                        raise ValueError("unknown priority class " + str(job.priority))
+                except (KeyError, TypeError, ValueError) as e:
+                    writer.write((json.dumps({"id": request.get("id"), "error": str(e)}) + "\n").encode("utf-8"))
+                    continue
+
+                client_jobs[job.request_id] = job
+                self.submit(job)
+        except (ConnectionError, json.JSONDecodeError) as e:
+            print("Engine service client failed:", type(e).__name__, e)
+        finally:
+            for job in list(client_jobs.values()):
+                self.cancel(job)
+            writer.close()
+
+    def get_report(self):
+        return {
+            "searches": dict(self.searches),
+            "queued": {priority: len(queue) for priority, queue in self.queues.items()},
+            "preemptions": self.preemptions,
+            "engineRestarts": self.engine_pool.restarts,
+        }
+
+
+async def run_engine_service(engine_pool, class_limits, socket_path):
+    await engine_pool.initialize()
+    engine_service = EngineService(engine_pool, class_limits)
+
+    # A socket file left behind by a service that did not shut down cleanly
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    server = await asyncio.start_unix_server(engine_service.handle_client, socket_path)
+    print("Engine service with", engine_pool.size, "engines listening on", socket_path)
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        print("Engine service report:", json.dumps(engine_service.get_report()))
+        await engine_pool.quit()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
@@ -0,0 +1,179 @@
+import asyncio
+
+import chess
+import chess.engine
+
+# Single value fields of info lines that are skipped when decoding the final lines of a search
+SKIPPED_INFO_FIELDS = {"seldepth", "time", "nodes", "nps", "hashfull", "tbhits", "cpuload", "currmove",
+                       "currmovenumber", "sbhits"}
+
+
+# Decode the fields of an info line the analysis pipeline uses: depth, multipv, score and pv. Moves of the pv are
+# checked against the board like python-chess does, a pv is cut off at its first illegal move.
+def parse_info_line(line, board):
+    info = {}
+    tokens = line.split()
+    i = 1
+
+    while i < len(tokens):
+        token = tokens[i]
+        if token == "depth" or token == "multipv":
+            info[token] = int(tokens[i + 1])
+            i += 2
+        elif token == "score":
+            kind, value = tokens[i + 1], int(tokens[i + 2])
+            score = chess.engine.Cp(value) if kind == "cp" else chess.engine.Mate(value)
+            info["score"] = chess.engine.PovScore(score, board.turn)
+            i += 3
+        elif token == "pv":
+            pv_board = board.copy(stack=False)
+            info["pv"] = []
+            for uci in tokens[i + 1:]:
+                try:
+                    info["pv"].append(pv_board.push_uci(uci))
+                except ValueError:
+                    break
+            break
+        elif token == "string":
+            break
+        elif token in SKIPPED_INFO_FIELDS:
+            i += 2
+        else:
+            # Flags like lowerbound and upperbound
+            i += 1
+
+    return info
+
+
+def get_position_command(board):
+    fen = board.root().fen(en_passant="fen")
+    command = "position startpos" if fen == chess.STARTING_FEN else "position fen " + fen
+    if board.move_stack:
+        command += " moves " + " ".join(move.uci() for move in board.move_stack)
+    return command
+
+
+def get_go_command(limit):
+    command = "go"
+    if limit.depth is not None:
+        command += " depth " + str(max(1, int(limit.depth)))
+    if limit.nodes is not None:
+        command += " nodes " + str(max(1, int(limit.nodes)))
+    if limit.mate is not None:
+        command += " mate " + str(max(1, int(limit.mate)))
+    if limit.time is not None:
+        command += " movetime " + str(max(1, round(limit.time * 1000)))
+    return command
+
+
+# Minimal UCI driver for the analyse calls of the analysis pipeline. python-chess decodes every info line of a search
+# into a dict, although only the score and pv of the last line of every principal variation are used. This driver
+# only remembers the raw last line per principal variation and decodes those once the engine sent its best move.
+# The result has the same shape as the result of python-chess' analyse (a list of dicts with depth, multipv, score and
+# pv), but iterative analyses and other engine commands are not supported.
+class LeanUciEngine:
+    def __init__(self, process):
+        self.process = process
+        # Same interface python-chess' protocol offers for supervising the engine process (see EnginePool)
+        self.transport = process
+        self.returncode = asyncio.ensure_future(process.wait())
+        # Names of the options the engine declared by their lower case name, which configure matches like UCI
+        # (and python-chess) does regardless of case
+        self.options = {}
+        self.multipv = None
+        self.is_new_game = True
+        self.is_searching = False
+
+    @staticmethod
+    async def popen(command):
+        command = [command] if isinstance(command, str) else command
+        process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.PIPE,
+                                                       stdout=asyncio.subprocess.PIPE)
+        engine = LeanUciEngine(process)
+
+        engine.send("uci")
+        while True:
+            line = await engine.read_line()
+            if line.startswith("option name "):
+                name = line[len("option name "):line.index(" type ")]
+                engine.options[name.lower()] = name
+            elif line == "uciok":
+                break
+
+        return engine
+
+    def send(self, line):
+        try:
+            self.process.stdin.write((line + "\n").encode("utf-8"))
+        except (BrokenPipeError, ConnectionResetError):
+            raise chess.engine.EngineTerminatedError("engine process died unexpectedly")
+
+    async def read_line(self):
+        line = await self.process.stdout.readline()
+        if not line:
+            raise chess.engine.EngineTerminatedError("engine process died unexpectedly")
+        return line.decode("utf-8").rstrip()
+
+    async def wait_until_ready(self):
+        self.send("isready")
+        while await self.read_line() != "readyok":
+            pass
+
+    async def configure(self, options):
+        for name, value in options.items():
+            if name.lower() not in self.options:
+                raise chess.engine.EngineError("engine does not support option " + name)
+            if isinstance(value, bool):
+                value = "true" if value else "false"
+            self.send("setoption name " + self.options[name.lower()] + " value " + str(value))
+
+        await self.wait_until_ready()
+
+    # A search that was cancelled (e.g. by a timeout) is stopped before the next one starts
+    async def stop_search(self):
+        self.send("stop")
+        while not (await self.read_line()).startswith("bestmove"):
+            pass
+        self.is_searching = False
+
+    async def analyse(self, board, limit=None, multipv=None):
+        if self.is_searching:
+            await self.stop_search()
+
+        multipv = multipv or 1
+        if multipv != self.multipv:
+            self.send("setoption name MultiPV value " + str(multipv))
+            self.multipv = multipv
+
+        if self.is_new_game:
+            self.send("ucinewgame")
+            self.is_new_game = False
+            await self.wait_until_ready()
+
+        self.send(get_position_command(board))
+        self.send(get_go_command(limit or chess.engine.Limit()))
+        self.is_searching = True
+
+        # Keep only the last line with a score of every principal variation without decoding it
+        last_lines = {}
+        while True:
+            line = await self.read_line()
+            if line.startswith("bestmove"):
+                break
+            if not line.startswith("info") or " score " not in line:
+                continue
+
+            multipv_start = line.find(" multipv ")
+            if multipv_start < 0:
+                last_lines[1] = line
+            else:
+                multipv_end = line.find(" ", multipv_start + 9)
+                last_lines[int(line[multipv_start + 9:multipv_end if multipv_end >= 0 else len(line)])] = line
+
+        self.is_searching = False
+        return [parse_info_line(last_lines[i], board) for i in sorted(last_lines)]
+
+    async def quit(self):
+        if not self.returncode.done():
+            self.send("quit")
+        await self.returncode
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# Deterministic stand-in for a UCI engine. Moves are scored by a hash of the position and the move, so the same
+# position always gets the same analysis. It speaks just enough UCI for python-chess and is used to run the API or
+# load tests without Stockfish. SCRIPTED_ENGINE_DEPTH_DELAY sets the seconds every search depth takes.
+import os
+import sys
+import time
+import zlib
+
+import chess
+
+DEFAULT_DEPTH = 18
+PV_LENGTH = 6
+DEPTH_DELAY = float(os.environ.get("SCRIPTED_ENGINE_DEPTH_DELAY", "0"))
+
+
+def send(line):
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+
+def get_move_score(board, move):
+    return zlib.crc32((board.epd() + move.uci()).encode("utf-8")) % 200 - 100
+
+
+def get_principle_variation(board, move):
+    board = board.copy(stack=False)
+    pv = [move]
+    board.push(move)
+
+    while len(pv) < PV_LENGTH and not board.is_game_over():
+        move = max(board.legal_moves, key=lambda legal_move: get_move_score(board, legal_move))
+        pv.append(move)
+        board.push(move)
+
+    return " ".join(move.uci() for move in pv)
+
+
+def search(board, depth, multipv, movetime=None):
+    moves = list(board.legal_moves)
+    if not moves:
+        send("info depth 0 score mate 0" if board.is_check() else "info depth 0 score cp 0")
+        send("bestmove (none)")
+        return
+
+    ranked_moves = sorted(moves, key=lambda move: -get_move_score(board, move))[:multipv]
+    start = time.monotonic()
+
+    for current_depth in range(1, depth + 1):
+        time.sleep(DEPTH_DELAY)
+
+        # Like a real engine, stop after the last depth that can be completed within the move time
+        is_last_depth = current_depth == depth \
+            or (movetime is not None and time.monotonic() - start + DEPTH_DELAY > movetime)
+
+        for i, move in enumerate(ranked_moves):
+            pv = get_principle_variation(board, move) if is_last_depth else move.uci()
+            send("info depth %d seldepth %d multipv %d score cp %d nodes %d nps 1000000 pv %s"
+                 % (current_depth, current_depth, i + 1, get_move_score(board, move), current_depth * 1000, pv))
+
+        if is_last_depth:
+            break
+
+    send("bestmove " + ranked_moves[0].uci())
+
+
+def parse_position(tokens):
+    if tokens[1] == "startpos":
+        board = chess.Board()
+        moves_index = 2
+    else:
+        moves_index = tokens.index("moves") if "moves" in tokens else len(tokens)
+        board = chess.Board(" ".join(tokens[2:moves_index]))
+
+    for move in tokens[moves_index + 1:]:
+        board.push_uci(move)
+
+    return board
+
+
+def main():
+    board = chess.Board()
+    multipv = 1
+
+    for line in sys.stdin:
+        tokens = line.split()
+        if not tokens:
+            continue
+
+        command = tokens[0]
+        if command == "uci":
+            send("id name Scripted")
+            send("option name MultiPV type spin default 1 min 1 max 500")
+            send("option name Threads type spin default 1 min 1 max 512")
+            send("option name Hash type spin default 16 min 1 max 33554432")
+            # Declared like Stockfish does, the repo configures it as "USE NNUE"
+            send("option name Use NNUE type check default true")
+            send("uciok")
+        elif command == "isready":
+            send("readyok")
+        elif command == "setoption" and "MultiPV" in tokens:
+            multipv = int(tokens[-1])
+        elif command == "position":
+            board = parse_position(tokens)
+        elif command == "go":
+            depth = int(tokens[tokens.index("depth") + 1]) if "depth" in tokens else DEFAULT_DEPTH
+            movetime = int(tokens[tokens.index("movetime") + 1]) / 1000 if "movetime" in tokens else None
+            search(board, depth, multipv, movetime)
+        elif command == "quit":
+            break
+
+
+if __name__ == "__main__":
+    main()
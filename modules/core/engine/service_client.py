@@ -0,0 +1,148 @@
+import asyncio
+import itertools
+import json
+import socket
+
+import chess
+import chess.engine
+
+# Priority classes of the engine service: interactive searches (API requests) are always started before batch
+# searches (analyze runs, background deepening) and may preempt them
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+PRIORITY_CLASSES = [PRIORITY_INTERACTIVE, PRIORITY_BATCH]
+
+# The engine service speaks newline delimited json: every request is answered by a response with the same id
+request_ids = itertools.count(1)
+
+
+def encode_board(board):
+    return {"fen": board.root().fen(), "moves": [move.uci() for move in board.move_stack]}
+
+
+def decode_board(encoded_board):
+    board = chess.Board(encoded_board["fen"])
+    for uci in encoded_board["moves"]:
+        board.push_uci(uci)
+    return board
+
+
+def encode_limit(limit):
+    limit = limit or chess.engine.Limit()
+    return {"depth": limit.depth, "time": limit.time, "nodes": limit.nodes}
+
+
+def decode_limit(encoded_limit):
+    return chess.engine.Limit(depth=encoded_limit["depth"], time=encoded_limit["time"], nodes=encoded_limit["nodes"])
+
+
+def encode_search_request(board, limit, multipv, priority):
+    return {"id": next(request_ids), "board": encode_board(board), "limit": encode_limit(limit), "multipv": multipv,
+            "priority": priority}
+
+
+# Scores are sent from the point of view of the side to move, like the engine reports them
+def encode_analysis(analysis):
+    encoded_analysis = []
+    for info in analysis:
+        encoded_info = {name: info[name] for name in ("depth", "multipv") if name in info}
+        if "score" in info:
+            score = info["score"].relative
+            encoded_info["score"] = {"mate": score.mate()} if score.is_mate() else {"cp": score.score()}
+        if "pv" in info:
+            encoded_info["pv"] = [move.uci() for move in info["pv"]]
+        encoded_analysis.append(encoded_info)
+    return encoded_analysis
+
+
+def decode_analysis(encoded_analysis, board):
+    analysis = []
+    for encoded_info in encoded_analysis:
+        info = {name: encoded_info[name] for name in ("depth", "multipv") if name in encoded_info}
+        if "score" in encoded_info:
+            score = encoded_info["score"]
+            info["score"] = chess.engine.PovScore(chess.engine.Mate(score["mate"]) if "mate" in score
+                                                  else chess.engine.Cp(score["cp"]), board.turn)
+        if "pv" in encoded_info:
+            pv_board = board.copy(stack=False)
+            info["pv"] = [pv_board.push_uci(uci) for uci in encoded_info["pv"]]
+        analysis.append(info)
+    return analysis
+
+
+def get_search_result(response, board):
+    if "error" in response:
+        raise chess.engine.EngineError("engine service: " + response["error"])
+    return decode_analysis(response["analysis"], board)
+
+
+# Connection to the engine service that is used like an engine by the EnginePool (see initialize_uci_engine). The
+# service owns the engine processes and their configuration, one connection runs one search at a time.
+class ServiceEngine:
+    def __init__(self, reader, writer, priority):
+        self.reader = reader
+        self.writer = writer
+        self.priority = priority
+        # Same interface python-chess' protocol offers for supervising the engine process (see EnginePool)
+        self.transport = writer.transport
+        self.returncode = asyncio.get_running_loop().create_future()
+
+    @staticmethod
+    async def connect(socket_path, priority):
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+        return ServiceEngine(reader, writer, priority)
+
+    # Engine options are configured by the engine service
+    async def configure(self, options):
+        pass
+
+    def close(self, error=None):
+        if not self.returncode.done():
+            self.returncode.set_result(error)
+        self.writer.close()
+
+    async def analyse(self, board, limit=None, multipv=None):
+        request = encode_search_request(board, limit, multipv or 1, self.priority)
+        self.writer.write((json.dumps(request) + "\n").encode("utf-8"))
+
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    self.close()
+                    raise chess.engine.EngineTerminatedError("engine service closed the connection")
+
+                # Responses to searches cancelled before are skipped
+                response = json.loads(line)
+                if response["id"] == request["id"]:
+                    return get_search_result(response, board)
+        except asyncio.CancelledError:
+            if not self.returncode.done():
+                self.writer.write((json.dumps({"id": request["id"], "cancel": True}) + "\n").encode("utf-8"))
+            raise
+
+    async def quit(self):
+        self.close()
+
+
+# Blocking connection to the engine service for the threads of the Flask API (see initialize_uci_engine_sync)
+class ServiceEngineSync:
+    def __init__(self, socket_path, priority):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(socket_path)
+        self.file = self.socket.makefile("rwb")
+        self.priority = priority
+
+    def analyse(self, board, limit=None, multipv=None):
+        request = encode_search_request(board, limit, multipv or 1, self.priority)
+        self.file.write((json.dumps(request) + "\n").encode("utf-8"))
+        self.file.flush()
+
+        line = self.file.readline()
+        if not line:
+            raise chess.engine.EngineTerminatedError("engine service closed the connection")
+        return get_search_result(json.loads(line), board)
+
+    def quit(self):
+        self.file.close()
+        self.socket.close()
@@ -1,9 +1,11 @@
 from enum import Enum
 
 import chess
+import chess.engine
 
 from modules.core.score.score import get_pov_score, get_expectation, get_principle_variation, get_cp_score_string
-from modules.core.engine.engine import analyse_board
+from modules.core.engine.engine import analyse_board, STOCKFISH_DEPTH
+from modules.core.notation.notation import get_san, get_variation_san
 
 ONLY_GOOD_MOVE_EPS = 0.10
 
@@ -33,66 +35,79 @@ class MoveType(Enum):
     GAME_CHANGER = "gameChanger"
 
 
+# The board is the position before the move was played. It is only modified temporarily (push/ pop) and
+# left unchanged once the evaluation is done. The legal moves scanned for a bad alternative move are searched with
+# the scan limit, at most scan budget of them (None: all legal moves).
 async def evaluate_move(engine, grandmaster_side, last_opponent_move_was_blunder, last_analysis,
-                        half_move, move, last_expectation, new_expectation, board_before_move, board_after_move,
-                        always_find_bad_selection_move=ALWAYS_FIND_BAD_SELECTION_MOVE_DEFAULT):
+                        half_move, move, last_expectation, new_expectation, board,
+                        always_find_bad_selection_move=ALWAYS_FIND_BAD_SELECTION_MOVE_DEFAULT, tablebase=None,
+                        san_cache=None, max_pv_plies=None, scan_limit=chess.engine.Limit(depth=STOCKFISH_DEPTH),
+                        scan_budget=None):
     best_next_moves, best_next_moves_cp_scores, best_next_moves_expectations, best_next_moves_pv \
-        = find_best_next_moves(last_analysis, board_before_move.turn, half_move)
+        = find_best_next_moves(last_analysis, board.turn, half_move)
 
-    gm_turn = board_before_move.turn == grandmaster_side
+    gm_turn = board.turn == grandmaster_side
 
     move_type = evaluate_move_type(
         move, best_next_moves, best_next_moves_expectations, 
         last_expectation if gm_turn else (1 - last_expectation),  # get gm or opponents expectation
         new_expectation if gm_turn else (1 - new_expectation),  # get gm or opponents expectation,
-        board_before_move, board_after_move, last_opponent_move_was_blunder
+        board, last_opponent_move_was_blunder
     )
 
     alternative_moves = await retrieve_alternative_moves(
         engine,
         best_next_moves, best_next_moves_cp_scores, best_next_moves_expectations, best_next_moves_pv, 
-        move, move_type, board_before_move, 
+        move, move_type, board, 
         gm_turn,
         last_opponent_move_was_blunder,
         last_expectation if gm_turn else (1 - last_expectation),  # get gm or opponents old expectation
-        always_find_bad_selection_move
+        always_find_bad_selection_move,
+        tablebase,
+        san_cache,
+        max_pv_plies,
+        scan_limit,
+        scan_budget
     )
     
     return move_type, alternative_moves
 
 
 def evaluate_move_sync(grandmaster_side, last_opponent_move_was_blunder, last_analysis,
-                        half_move, move, last_expectation, new_expectation, board_before_move, board_after_move):
+                        half_move, move, last_expectation, new_expectation, board, san_cache=None, max_pv_plies=None):
     best_next_moves, best_next_moves_cp_scores, best_next_moves_expectations, best_next_moves_pv \
-        = find_best_next_moves(last_analysis, board_before_move.turn, half_move)
+        = find_best_next_moves(last_analysis, board.turn, half_move)
 
-    gm_turn = board_before_move.turn == grandmaster_side
+    gm_turn = board.turn == grandmaster_side
 
     move_type = evaluate_move_type(
         move, best_next_moves, best_next_moves_expectations, 
         last_expectation if gm_turn else (1 - last_expectation),  # get gm or opponents expectation
         new_expectation if gm_turn else (1 - new_expectation),  # get gm or opponents expectation,
-        board_before_move, board_after_move, last_opponent_move_was_blunder
+        board, last_opponent_move_was_blunder
     )
     
-    alternative_moves, _, _ = retrieve_alternative_moves_sync(
+    _, alternative_moves, _ = retrieve_alternative_moves_sync(
         best_next_moves, best_next_moves_cp_scores, best_next_moves_expectations, best_next_moves_pv, 
-        move, board_before_move, 
+        move, board, 
         gm_turn,
         last_opponent_move_was_blunder,
         last_expectation if gm_turn else (1 - last_expectation),  # get gm or opponents old expectation
+        san_cache,
+        max_pv_plies
     )
     
     return move_type, alternative_moves
 
 
 async def retrieve_alternative_moves(engine, best_next_moves, best_next_moves_cp_scores, best_next_moves_expectations,
-                               best_next_moves_pv, actual_move, actual_move_type, board_before_move,
+                               best_next_moves_pv, actual_move, actual_move_type, board,
                                gm_turn, last_opponent_move_was_blunder, last_expectation,
-                               always_find_bad_selection_move):
+                               always_find_bad_selection_move, tablebase=None, san_cache=None, max_pv_plies=None,
+                               scan_limit=chess.engine.Limit(depth=STOCKFISH_DEPTH), scan_budget=None):
     alternative_moves, analyzed_alternative_moves, found_bad_alternative_move = retrieve_alternative_moves_sync(best_next_moves, best_next_moves_cp_scores, best_next_moves_expectations,
-                               best_next_moves_pv, actual_move, board_before_move,
-                               gm_turn, last_opponent_move_was_blunder, last_expectation)
+                               best_next_moves_pv, actual_move, board,
+                               gm_turn, last_opponent_move_was_blunder, last_expectation, san_cache, max_pv_plies)
     
     actual_move_is_bad = actual_move_type == MoveType.MISTAKE or actual_move_type == MoveType.INACCURACY or actual_move_type == MoveType.BLUNDER
     bad_move_found = found_bad_alternative_move or actual_move_is_bad
@@ -102,56 +117,69 @@ async def retrieve_alternative_moves(engine, best_next_moves, best_next_moves_cp
     # This ensures that, if possible, we never only have good moves to guess from
     if always_find_bad_selection_move and not bad_move_found and len(analyzed_alternative_moves) == 2:
         best_bad_move_turn_expectation = 0.0
+        best_bad_move = None
+        scanned_moves = 0
 
-        for legal_move in board_before_move.legal_moves:
+        for legal_move in list(board.legal_moves):
             if actual_move == legal_move or legal_move in alternative_moves:
                 continue
+
+            # Reduced search settings only scan the first legal moves
+            if scan_budget is not None and scanned_moves >= scan_budget:
+                break
+            scanned_moves += 1
             
-            board_after_legal_move = board_before_move.copy()
-            board_after_legal_move.push(legal_move)
-            
-            legal_move_analysis = await analyse_board(engine, board_after_legal_move, multipv=1)
+            board.push(legal_move)
+            try:
+                legal_move_analysis = await analyse_board(engine, board, multipv=1, limit=scan_limit,
+                                                          tablebase=tablebase)
+            finally:
+                board.pop()
 
-            legal_move_signed_cp_score = get_pov_score(chess.WHITE, legal_move_analysis)
-            legal_move_turn_score = get_pov_score(board_before_move.turn, legal_move_analysis)
-            legal_move_turn_expectation = get_expectation(legal_move_turn_score, board_before_move.ply())
-            legal_move_pv = [legal_move] + get_principle_variation(legal_move_analysis)
+            legal_move_turn_score = get_pov_score(board.turn, legal_move_analysis)
+            legal_move_turn_expectation = get_expectation(legal_move_turn_score, board.ply())
 
             legal_move_type = evaluate_move_type(
                 legal_move, best_next_moves, best_next_moves_expectations, 
                 last_expectation, legal_move_turn_expectation,
-                board_before_move, board_after_legal_move, 
-                last_opponent_move_was_blunder
+                board, last_opponent_move_was_blunder
             )
             
             is_bad_move = legal_move_type == MoveType.MISTAKE or legal_move_type == MoveType.INACCURACY or legal_move_type == MoveType.BLUNDER
+
+            # Update alternative move if bad move with higher expectation was found
+            if is_bad_move and legal_move_turn_expectation > best_bad_move_turn_expectation:
+                best_bad_move = (legal_move, legal_move_type, legal_move_turn_expectation, legal_move_analysis)
+                best_bad_move_turn_expectation = legal_move_turn_expectation
             
-            analyzed_legal_move = {
+            # Any inaccuracy or mistake is good enough for our bad move -> early stop
+            if legal_move_type == MoveType.INACCURACY or legal_move_type == MoveType.MISTAKE:
+                break
+
+        # Only the selected bad move is converted to its output representation
+        if best_bad_move is not None:
+            legal_move, legal_move_type, legal_move_turn_expectation, legal_move_analysis = best_bad_move
+            legal_move_signed_cp_score = get_pov_score(chess.WHITE, legal_move_analysis)
+            legal_move_pv = [legal_move] + get_principle_variation(legal_move_analysis)
+
+            analyzed_alternative_moves[1] = {
                 "move": {
                     "uci": legal_move.uci(),
-                    "san": board_before_move.san(legal_move),
+                    "san": get_san(board, legal_move, san_cache),
                 },
                 "moveType": legal_move_type.value,
                 "signedCPScore": get_cp_score_string(legal_move_signed_cp_score),
                 "gmExpectation": legal_move_turn_expectation if gm_turn else (1 - legal_move_turn_expectation),
-                "pv": board_before_move.variation_san(legal_move_pv)
+                "pv": get_variation_san(board, legal_move_pv, san_cache, max_pv_plies)
             }
-            
-            # Update alternative move if bad move with higher expectation was found
-            if is_bad_move and legal_move_turn_expectation > best_bad_move_turn_expectation:
-                analyzed_alternative_moves[1] = analyzed_legal_move
-                best_bad_move_turn_expectation = legal_move_turn_expectation
-            
-            # Any inaccuracy or mistake is good enough for our bad move -> early stop
-            if legal_move_type == MoveType.INACCURACY or legal_move_type == MoveType.MISTAKE:
-                break
     
     return analyzed_alternative_moves
 
 
 def retrieve_alternative_moves_sync(best_next_moves, best_next_moves_cp_scores, best_next_moves_expectations,
-                               best_next_moves_pv, actual_move, board_before_move,
-                               gm_turn, last_opponent_move_was_blunder, last_expectation):
+                               best_next_moves_pv, actual_move, board,
+                               gm_turn, last_opponent_move_was_blunder, last_expectation,
+                               san_cache=None, max_pv_plies=None):
     alternative_moves = []
     analyzed_alternative_moves = []
     found_bad_alternative_move = False
@@ -167,15 +195,11 @@ def retrieve_alternative_moves_sync(best_next_moves, best_next_moves_cp_scores,
         alt_move = best_next_moves[i]
         if alt_move == actual_move:
             continue
-    
-        board_after_move = board_before_move.copy()
-        board_after_move.push(alt_move)
 
         alt_move_type = evaluate_move_type(
             alt_move, best_next_moves, best_next_moves_expectations, 
             last_expectation, best_next_moves_expectations[i],
-            board_before_move, board_after_move, 
-            last_opponent_move_was_blunder
+            board, last_opponent_move_was_blunder
         )
         
         if alt_move_type == MoveType.BLUNDER or alt_move_type == MoveType.MISTAKE or alt_move_type == MoveType.INACCURACY:
@@ -187,21 +211,22 @@ def retrieve_alternative_moves_sync(best_next_moves, best_next_moves_cp_scores,
             {
                 "move": {
                     "uci": alt_move.uci(),
-                    "san": board_before_move.san(alt_move),
+                    "san": get_san(board, alt_move, san_cache),
                 },
                 "moveType": alt_move_type.value,
                 "signedCPScore": get_cp_score_string(best_next_moves_cp_scores[i]),
                 "gmExpectation": best_next_moves_expectations[i] if gm_turn else (1 - best_next_moves_expectations[i]),
-                "pv": board_before_move.variation_san(best_next_moves_pv[i])
+                "pv": get_variation_san(board, best_next_moves_pv[i], san_cache, max_pv_plies)
             })
     
     return alternative_moves, analyzed_alternative_moves, found_bad_alternative_move
 
 
+# The board is the position before the move was played
 def evaluate_move_type(move, best_next_moves, best_next_moves_expectations, last_expectation, new_expectation,
-                       board_before_move, board_after_move, last_opponent_move_was_blunder):
+                       board, last_opponent_move_was_blunder):
     if played_critical_move(best_next_moves, best_next_moves_expectations, move,
-                            new_expectation, board_before_move, board_after_move):
+                            new_expectation, board):
         return MoveType.CRITICAL
     elif played_brilliant_move(best_next_moves, move, best_next_moves_expectations[0], new_expectation):
         return MoveType.BRILLIANT
@@ -224,9 +249,22 @@ def evaluate_move_type(move, best_next_moves, best_next_moves_expectations, last
         return MoveType.OKAY
 
 
-def played_trivial_move(board_before_move, board_after_move, actual_move):
+# Turn the best moves of a move evaluated without knowing the classification of the previous move into game changers
+# if the last opponent move was a blunder (see evaluate_move_type)
+def apply_last_opponent_move_was_blunder(move_type, alternative_moves, last_opponent_move_was_blunder):
+    if not last_opponent_move_was_blunder:
+        return move_type
+
+    for alternative_move in alternative_moves:
+        if alternative_move["moveType"] == MoveType.BEST.value:
+            alternative_move["moveType"] = MoveType.GAME_CHANGER.value
+
+    return MoveType.GAME_CHANGER if move_type == MoveType.BEST else move_type
+
+
+def played_trivial_move(board, actual_move):
     # If grandmaster is in check before playing the move
-    if board_before_move.is_check():
+    if board.is_check():
         return True
 
     # If the gradmaster move is a promotion (i.e. to Queen)
@@ -234,10 +272,11 @@ def played_trivial_move(board_before_move, board_after_move, actual_move):
         return True
 
     # If the game is over after the grandmaster move (e.g. if the move is a Mate-In-1)
-    if board_after_move.is_game_over():
-        return True
+    board.push(actual_move)
+    is_game_over = board.is_game_over()
+    board.pop()
 
-    return False
+    return is_game_over
 
 
 def played_inaccuracy_move(last_expectation, new_expectation):
@@ -292,10 +331,7 @@ def played_brilliant_move(best_next_moves, actual_move, best_next_move_expectati
 
 
 def played_critical_move(best_next_moves, best_next_moves_expectations,
-                         actual_move, actual_move_expectation, board_before_move, board_after_move):
-    if played_trivial_move(board_before_move, board_after_move, actual_move):
-        return False
-
+                         actual_move, actual_move_expectation, board):
     if not played_best_move(best_next_moves, best_next_moves_expectations, actual_move, actual_move_expectation):
         return False
 
@@ -308,7 +344,11 @@ def played_critical_move(best_next_moves, best_next_moves_expectations,
     if best_move_expectation <= second_best_expectation:
         return False
 
-    return has_only_one_good_move(best_next_moves, best_next_moves_expectations)
+    if not has_only_one_good_move(best_next_moves, best_next_moves_expectations):
+        return False
+
+    # Checked last as it is the only check that has to look at the board
+    return not played_trivial_move(board, actual_move)
 
 
 def has_only_one_good_move(best_next_moves, best_next_moves_expectations):
@@ -1,3 +1,6 @@
+import time
+from datetime import datetime, timedelta
+
 import chess
 from modules.core.sides.sides import get_grandmaster_side
 
@@ -44,3 +47,37 @@ def print_full_move_info(full_move,
     print("Last grandmaster winning chance", last_expectation)
     print("New grandmaster winning chance", expectation)
     print("Difference", expectation - last_expectation)
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return str(seconds // 3600) + "h " + str(seconds % 3600 // 60).zfill(2) + "m"
+    if seconds >= 60:
+        return str(seconds // 60) + "m " + str(seconds % 60).zfill(2) + "s"
+    return str(seconds) + "s"
+
+
+# Progress of a run over a known amount of work (e.g. positions or plies), whose remaining time is extrapolated from
+# the time the work done so far took
+class Progress:
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.start = time.monotonic()
+
+    def advance(self, amount=1):
+        self.done += amount
+
+    def get_remaining_seconds(self):
+        if self.done == 0:
+            return None
+        return (time.monotonic() - self.start) / self.done * max(0, self.total - self.done)
+
+    def get_eta(self):
+        remaining_seconds = self.get_remaining_seconds()
+        if remaining_seconds is None:
+            return "ETA unknown"
+
+        finish = datetime.now() + timedelta(seconds=remaining_seconds)
+        return "ETA " + format_duration(remaining_seconds) + " (" + finish.strftime("%H:%M:%S") + ")"
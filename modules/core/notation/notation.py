@@ -0,0 +1,42 @@
+import chess
+
+
+# Get the SAN of a move played on the given board. The san cache maps moves to their SAN and is only valid
+# for a single position, so computing the same SAN twice (e.g. for the move and the first move of its pv) is avoided
+def get_san(board, move, san_cache=None):
+    if san_cache is None:
+        return board.san(move)
+
+    san = san_cache.get(move)
+    if san is None:
+        san = board.san(move)
+        san_cache[move] = san
+
+    return san
+
+
+# Same output as board.variation_san(variation) but pushes and pops the moves on the given board instead of
+# copying it. If max_plies is set, only the first max_plies moves of the variation are formatted.
+def get_variation_san(board, variation, san_cache=None, max_plies=None):
+    if max_plies is not None:
+        variation = variation[:max_plies]
+
+    san = []
+
+    try:
+        for move in variation:
+            move_san = get_san(board, move, san_cache) if not san else board.san(move)
+
+            if board.turn == chess.WHITE:
+                san.append(str(board.fullmove_number) + ". " + move_san)
+            elif not san:
+                san.append(str(board.fullmove_number) + "..." + move_san)
+            else:
+                san.append(move_san)
+
+            board.push(move)
+    finally:
+        for _ in range(len(san)):
+            board.pop()
+
+    return " ".join(san)
@@ -1,48 +1,121 @@
+import gzip
+import hashlib
 import json
+import os
+import sys
 import uuid
+from enum import Enum
 from pathlib import Path
 from datetime import datetime
 
 import chess
 
+from modules.core.evaluation.evaluation import MoveType
+from modules.core.writer.writer import write_file_atomically
+
+# Namespace of the game ids derived from the game content
+GAME_ID_NAMESPACE = uuid.UUID('5c16f2fe-a3d8-5d70-83cb-928087204252')
+GAME_ID_HEADERS = ["Event", "Site", "Date", "Round", "White", "Black", "Result"]
+
+
+# Derive a stable id from the game content, so that analyzing the same game again results in the same id
+def get_game_id(game, gm_side):
+    game_key = [game.headers.get(header, "?") for header in GAME_ID_HEADERS]
+    game_key.append("black" if gm_side == chess.BLACK else "white")
+    game_key.append(" ".join(move.uci() for move in game.mainline_moves()))
+
+    return str(uuid.uuid5(GAME_ID_NAMESPACE, "|".join(game_key)))
+
+
+# Hash of the analysis of a game (ignoring its id, added date and annotations) used to detect changed analyses
+def get_analysis_content_hash(analysis_results):
+    content = json.dumps({"pgn": analysis_results["pgn"], "gameAnalysis": analysis_results["gameAnalysis"]},
+                         sort_keys=True)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class GamePhase(Enum):
+    OPENING = "opening"
+    MIDGAME = "midgame"
+    ENDGAME = "endgame"
+
+
+# Compact representation of an evaluated move. Move types are kept as enum members and the short strings are
+# interned, so that the many plies of long runs share them instead of holding copies in nested dicts.
+class EvaluatedMove:
+    __slots__ = ("uci", "san", "move_type", "signed_cp_score", "gm_expectation", "pv")
+
+    def __init__(self, uci, san, move_type, signed_cp_score, gm_expectation, pv):
+        self.uci = sys.intern(uci)
+        self.san = sys.intern(san)
+        self.move_type = move_type
+        self.signed_cp_score = sys.intern(signed_cp_score)
+        self.gm_expectation = gm_expectation
+        self.pv = pv
+
+    @staticmethod
+    def from_json(evaluated_move):
+        return EvaluatedMove(evaluated_move["move"]["uci"], evaluated_move["move"]["san"],
+                             MoveType(evaluated_move["moveType"]), evaluated_move["signedCPScore"],
+                             evaluated_move["gmExpectation"], evaluated_move["pv"])
+
+    def to_json(self):
+        return {
+            "move": {"uci": self.uci, "san": self.san},
+            "moveType": self.move_type.value,
+            "signedCPScore": self.signed_cp_score,
+            "gmExpectation": self.gm_expectation,
+            "pv": self.pv
+        }
+
+
+class AnalyzedMove:
+    __slots__ = ("ply", "game_phase", "turn", "actual_move", "alternative_moves")
+
+    def __init__(self, ply, game_phase, turn, actual_move, alternative_moves):
+        self.ply = ply
+        self.game_phase = game_phase
+        self.turn = turn
+        self.actual_move = actual_move
+        self.alternative_moves = alternative_moves
+
+    def to_json(self):
+        return {
+            "ply": self.ply,
+            "gamePhase": self.game_phase.value,
+            "turn": "white" if self.turn == chess.WHITE else "black",
+            "actualMove": self.actual_move.to_json(),
+            "alternativeMoves": [alternative_move.to_json() for alternative_move in self.alternative_moves]
+        }
+
+
 class AnalyzedGame:
     def __init__(self, player_name, pgn, game, gm_side):
-        self.id = str(uuid.uuid4())
+        self.id = get_game_id(game, gm_side)
+        self.added_date = None
         self.player_name = player_name
         self.pgn = pgn
-        self.game = game
-        self.white_player = self.game.headers["White"]
-        self.black_player = self.game.headers["Black"]
+        self.white_player = game.headers["White"]
+        self.black_player = game.headers["Black"]
         self.game_info = {
-                    "event": self.game.headers["Event"],
-                    "site": self.game.headers["Site"],
-                    "date": self.game.headers["Date"],
-                    "round": self.game.headers["Round"],
+                    "event": game.headers["Event"],
+                    "site": game.headers["Site"],
+                    "date": game.headers["Date"],
+                    "round": game.headers["Round"],
                 }
         self.gm_side = gm_side
         self.gm_depth_to_mate = None
         self.opening = None
+        self.search_settings = None
         self.moves = []
 
     def add_opening_move(self, ply, turn, evaluated_move):
-        self.moves.append({
-            "ply": ply,
-            "gamePhase": "opening",
-            "turn": "white" if turn == chess.WHITE else "black",
-            "actualMove": evaluated_move,
-            "alternativeMoves": []
-        })
-        # print(self.moves[len(self.moves) - 1])
+        self.moves.append(AnalyzedMove(ply, GamePhase.OPENING, turn, EvaluatedMove.from_json(evaluated_move), ()))
 
     def add_move(self, ply, game_phase, turn, move_type, evaluated_move, alternative_moves):
-        self.moves.append({
-            "ply": ply,
-            "gamePhase": game_phase,
-            "turn": "white" if turn == chess.WHITE else "black",
-            "actualMove": evaluated_move,
-            "alternativeMoves": alternative_moves
-        })
-        # print(self.moves[len(self.moves) - 1])
+        self.moves.append(AnalyzedMove(ply, GamePhase(game_phase), turn, EvaluatedMove.from_json(evaluated_move),
+                                       tuple(EvaluatedMove.from_json(alternative_move)
+                                             for alternative_move in alternative_moves)))
 
     def set_opening(self, opening):
         self.opening = {
@@ -55,6 +128,10 @@ class AnalyzedGame:
     def set_gm_depth_to_mate(self, gm_depth_to_mate):
         self.gm_depth_to_mate = gm_depth_to_mate
 
+    # Only games analyzed with reduced search settings carry them in their output
+    def set_search_settings(self, search_settings):
+        self.search_settings = search_settings
+
     def save_as_json(self):
         output_dir = "output/" + self.player_name + "/splitted"
         Path(output_dir).mkdir(parents=True, exist_ok=True)
@@ -66,41 +143,100 @@ class AnalyzedGame:
                         + ".json"
 
         now = datetime.now()
-        datetime_formatted = now.strftime("%d/%m/%Y %H:%M:%S")
+        self.added_date = now.strftime("%d/%m/%Y %H:%M:%S")
+
+        write_file_atomically(full_filename, lambda outfile: json.dump(self.to_json(), outfile))
+
+        print()
+        print("Saved analysis output file at", full_filename)
+
+    # Convert the analyzed game to the output schema. The dicts only exist while the game is written.
+    def to_json(self):
+        game_analysis = {
+            "grandmasterSide": "black" if self.gm_side == chess.BLACK else "white",
+            "grandmasterDepthToMateInHalfMoves": self.gm_depth_to_mate,
+            "opening": self.opening,
+            "analyzedMoves": [analyzed_move.to_json() for analyzed_move in self.moves]
+        }
+        if self.search_settings is not None:
+            game_analysis["searchSettings"] = self.search_settings
 
-        analysis_results = {
+        return {
             "id": self.id,
-            "addedDate": datetime_formatted,
+            "addedDate": self.added_date,
             "pgn": self.pgn,
             "whitePlayer": self.white_player,
             "blackPlayer": self.black_player,
             "gameInfo": self.game_info,
-            "gameAnalysis": {
-                "grandmasterSide": "black" if self.gm_side == chess.BLACK else "white",
-                "grandmasterDepthToMateInHalfMoves": self.gm_depth_to_mate,
-                "opening": self.opening,
-                "analyzedMoves": self.moves
-            },
+            "gameAnalysis": game_analysis,
         }
 
-        with open(full_filename, "w") as outfile:
-            json.dump(analysis_results, outfile)
-
-        print()
-        print("Saved analysis output file at", full_filename)
-        
-        return analysis_results
-
 
-def save_merged_analyzed_games_results(gm_name, merged_file_name, analyzed_games_results):
+# The analyzed games are converted one by one while writing, written the same way json.dump writes a list
+def save_merged_analyzed_games_results(gm_name, merged_file_name, analyzed_games):
     output_dir = "output/" + gm_name
     Path(output_dir).mkdir(parents=True, exist_ok=True)
     full_filename = output_dir + "/" \
                     + merged_file_name \
                     + ".json"
 
-    with open(full_filename, "w") as outfile:
-        json.dump(analyzed_games_results, outfile)
+    def write_analyzed_games(outfile):
+        outfile.write("[")
+        for i, analyzed_game in enumerate(analyzed_games):
+            if i > 0:
+                outfile.write(", ")
+            json.dump(analyzed_game.to_json(), outfile)
+        outfile.write("]")
+
+    write_file_atomically(full_filename, write_analyzed_games)
 
     print()
     print("Saved merged analysis output file at", full_filename)
+
+
+# Write the analyzed games together with their player annotations (see player.py) as annotated bundle, the same way the
+# annotate command does: as json file and as gzipped file that can be used as analyzed games bundle by the app
+def save_annotated_analyzed_games_results(merged_file_name, analyzed_games, player_annotations):
+    output_dir = "output/annotated"
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    full_filename = output_dir + "/" + merged_file_name + ".json"
+    gzipped_filename = output_dir + "/" + merged_file_name + "_compressed"
+
+    def write_annotated_games(outfile):
+        outfile.write("[")
+        for i, (analyzed_game, player_annotation) in enumerate(zip(analyzed_games, player_annotations)):
+            if i > 0:
+                outfile.write(", ")
+            annotated_game = analyzed_game.to_json()
+            annotated_game.update(player_annotation)
+            json.dump(annotated_game, outfile)
+        outfile.write("]")
+
+    def write_gzipped_annotated_games(outfile):
+        with open(full_filename, "rb") as file, \
+                gzip.GzipFile(os.path.basename(gzipped_filename), "wb", fileobj=outfile) as gzipped_file:
+            gzipped_file.writelines(file)
+
+    write_file_atomically(full_filename, write_annotated_games)
+    write_file_atomically(gzipped_filename, write_gzipped_annotated_games, "wb")
+
+    print()
+    print("Saved annotated analysis output file at", full_filename)
+
+
+# Games whose analysis failed repeatedly are written to a pgn file, so that they can be analyzed again later
+def save_quarantined_games(gm_name, merged_file_name, games):
+    output_dir = "output/" + gm_name + "/quarantine"
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    full_filename = output_dir + "/" \
+                    + merged_file_name \
+                    + ".pgn"
+
+    def write_games(outfile):
+        for game in games:
+            outfile.write(str(game) + "\n\n")
+
+    write_file_atomically(full_filename, write_games)
+
+    print()
+    print("Saved", len(games), "quarantined games at", full_filename)
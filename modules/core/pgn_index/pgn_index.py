@@ -0,0 +1,118 @@
+import bz2
+import gzip
+import json
+import lzma
+import os
+
+import chess.pgn
+
+from modules.core.sides.sides import did_grandmaster_win
+
+INDEX_VERSION = 2
+INDEX_FILE_SUFFIX = ".index.json"
+INDEXED_HEADERS = ["Event", "Site", "Date", "Round", "White", "Black", "Result"]
+
+PGN_FILE_EXTENSIONS = (".pgn", ".pgn.gz", ".pgn.bz2", ".pgn.xz")
+COMPRESSED_FILE_OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+
+# Open a (possibly gzip, bz2 or xz compressed) pgn file in text mode. Offsets of compressed files refer to the
+# decompressed text, seeking to them decompresses the file from its start, so compressed files are only read forward
+# (see read_games_at_offsets).
+def open_pgn_file(pgn_path):
+    _, extension = os.path.splitext(pgn_path)
+    opener = COMPRESSED_FILE_OPENERS.get(extension.lower())
+    if opener is not None:
+        return opener(pgn_path, "rt")
+    return open(pgn_path, "r")
+
+
+def is_compressed_pgn_file(pgn_path):
+    _, extension = os.path.splitext(pgn_path)
+    return extension.lower() in COMPRESSED_FILE_OPENERS
+
+
+# Get the pgn files of a pgn file or a directory of pgn files
+def get_pgn_files(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, file_name) for file_name in os.listdir(path)
+                      if file_name.lower().endswith(PGN_FILE_EXTENSIONS))
+    return [path]
+
+
+def get_index_path(pgn_path):
+    return pgn_path + INDEX_FILE_SUFFIX
+
+
+# Scan the headers of all games and remember where each game starts and its number in the file without parsing its
+# moves
+def build_pgn_index(pgn_path):
+    games = []
+
+    with open_pgn_file(pgn_path) as pgn:
+        while True:
+            offset = pgn.tell()
+            headers = chess.pgn.read_headers(pgn)
+            if headers is None:
+                break
+
+            game_entry = {"offset": offset, "number": len(games)}
+            for header in INDEXED_HEADERS:
+                game_entry[header] = headers.get(header, "?")
+            games.append(game_entry)
+
+    return games
+
+
+def get_pgn_file_stamp(pgn_path):
+    stat = os.stat(pgn_path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+# Load the sidecar index of the pgn file, or build and save it if it is missing or outdated
+def load_pgn_index(pgn_path):
+    index_path = get_index_path(pgn_path)
+    file_stamp = get_pgn_file_stamp(pgn_path)
+
+    if os.path.exists(index_path):
+        with open(index_path, "r") as index_file:
+            index = json.load(index_file)
+
+        if index.get("version") == INDEX_VERSION and index.get("file") == file_stamp:
+            return index["games"]
+
+    print("Indexing", pgn_path + "..")
+    games = build_pgn_index(pgn_path)
+
+    try:
+        with open(index_path, "w") as index_file:
+            json.dump({"version": INDEX_VERSION, "file": file_stamp, "games": games}, index_file)
+    except OSError as e:
+        # Read-only input directories are indexed again on every run
+        print("Could not save pgn index", index_path + ":", e)
+
+    return games
+
+
+def get_year(game_entry):
+    year = game_entry["Date"].split(".")[0]
+    return int(year) if year.isdigit() else None
+
+
+# Select the games of the index the grandmaster won (see is_game_valid), optionally only those played in one of the
+# given years or at an event containing the given text
+def filter_pgn_index(games, grandmaster, years=None, event=None):
+    filtered_games = []
+
+    for game_entry in games:
+        if years and get_year(game_entry) not in years:
+            continue
+        if event and event.lower() not in game_entry["Event"].lower():
+            continue
+        headers = {header: game_entry[header] for header in INDEXED_HEADERS}
+        if not did_grandmaster_win(grandmaster, chess.pgn.Game(headers=headers)):
+            continue
+
+        filtered_games.append(game_entry)
+
+    return filtered_games
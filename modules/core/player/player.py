@@ -1,6 +1,7 @@
 from math import ceil
 import re
 
+import chess
 import mechanize
 from bs4 import BeautifulSoup
 
@@ -8,6 +9,9 @@ from bs4 import BeautifulSoup
 PLAYERS_LIST_URL = 'https://2700chess.com/all-fide-players'
 GAMES_LIST_URL = 'https://2700chess.com/games'
 
+# Number of games whose players are looked up at the same time while games are analyzed (see analyze --annotate)
+ANNOTATION_THREADS = 4
+
 # Store retrieved full player names in cache. Initially, this dict contains exception cases in which
 # the database would not be able to find the player due to different representations of the names
 player_name_cache = {
@@ -66,7 +70,39 @@ black_elo_pattern = re.compile('BlackElo "([0-9]+)"')
 white_elo_pattern = re.compile('WhiteElo "([0-9]+)"')
 
 
-def get_player_elo_ratings_for_game(analyzed_game):
+# Annotate an analyzed game with the full player names and elo ratings
+def annotate_analyzed_game(analyzed_game):
+    analyzed_game.update(get_player_annotation(analyzed_game))
+
+
+# Get the full player names and elo ratings of an analyzed game. The ply count defaults to the number of analyzed
+# moves.
+def get_player_annotation(analyzed_game, ply_count=None):
+    white_player_full_name = get_full_player_name(analyzed_game['whitePlayer'])
+    black_player_full_name = get_full_player_name(analyzed_game['blackPlayer'])
+    white_player_rating, black_player_rating = get_player_elo_ratings_for_game(analyzed_game, ply_count)
+
+    return {
+        'whitePlayer': white_player_full_name,
+        'blackPlayer': black_player_full_name,
+        'whitePlayerRating': white_player_rating,
+        'blackPlayerRating': black_player_rating,
+    }
+
+
+# Get the player annotation of a game that is still being analyzed from its pgn headers
+def get_game_player_annotation(game, grandmaster_side):
+    game_to_annotate = {
+        'whitePlayer': game.headers['White'],
+        'blackPlayer': game.headers['Black'],
+        'pgn': str(game),
+        'gameInfo': {'date': game.headers['Date']},
+        'gameAnalysis': {'grandmasterSide': 'black' if grandmaster_side == chess.BLACK else 'white'},
+    }
+    return get_player_annotation(game_to_annotate, game.end().ply())
+
+
+def get_player_elo_ratings_for_game(analyzed_game, ply_count=None):
     if contains_white_player_rating(analyzed_game) and contains_black_player_rating(analyzed_game):
         return analyzed_game['whitePlayerRating'], analyzed_game['blackPlayerRating']
 
@@ -86,7 +122,9 @@ def get_player_elo_ratings_for_game(analyzed_game):
     else:
         game_date_year = game_date.split('.')[0]
 
-    moves = str(ceil(len(analyzed_game['gameAnalysis']['analyzedMoves']) / 2))
+    if ply_count is None:
+        ply_count = len(analyzed_game['gameAnalysis']['analyzedMoves'])
+    moves = str(ceil(ply_count / 2))
 
     browser = mechanize.Browser()
 
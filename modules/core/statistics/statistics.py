@@ -1,7 +1,12 @@
 import os
 import chess.svg
+import matplotlib
 import matplotlib.pyplot as plt
 from modules.core.sides.sides import normalize_player_name, get_opponent_name
+from modules.core.writer.writer import write_file_atomically
+
+# Plots are only saved to files, possibly from the output writer thread, which needs a non-interactive backend
+matplotlib.use("Agg")
 
 
 def save_good_move(grandmaster,
@@ -66,7 +71,8 @@ def plot_cp_scores(half_moves, cp_scores, grandmaster, grandmaster_side, game):
         color = "red" if color == "green" else "green"
 
     plt.legend(loc="upper left")
-    plt.savefig(output_directory + "/cp_score_plot.png")
+    write_file_atomically(output_directory + "/cp_score_plot.png", lambda file: plt.savefig(file, format="png"),
+                          "wb")
     # plt.show()
 
     plt.clf()
@@ -98,7 +104,8 @@ def plot_expectations(half_moves, expectations, grandmaster, grandmaster_side, g
         color = "red" if color == "green" else "green"
 
     plt.legend(loc="upper left")
-    plt.savefig(output_directory + "/expectation_plot.png")
+    write_file_atomically(output_directory + "/expectation_plot.png", lambda file: plt.savefig(file, format="png"),
+                          "wb")
     # plt.show()
 
     plt.clf()
@@ -0,0 +1,145 @@
+import asyncio
+import time
+
+import chess
+import chess.engine
+
+from modules.core.analysis.analysis import get_opening_ply_length, plan_positions
+from modules.core.engine.engine import analyse_board, EngineSearchError, STOCKFISH_DEPTH
+from modules.core.evaluation.evaluation import find_best_next_moves, has_only_one_good_move, played_blunder_move
+from modules.core.info.info import Progress, format_duration
+from modules.core.score.score import get_pov_score, get_expectation
+from modules.core.sides.sides import get_grandmaster_side
+
+# Search depth of the screening pass. Two principal variations are enough to tell positions with only one good move.
+TRIAGE_DEPTH = min(8, STOCKFISH_DEPTH)
+TRIAGE_MULTIPV = 2
+
+# Puzzle value of the decision points of a game: positions where the grandmaster has only one good move (more if the
+# grandmaster found it), opponent blunders the grandmaster can punish, and the expectation swings of the whole game
+ONLY_MOVE_VALUE = 1.0
+FOUND_ONLY_MOVE_VALUE = 1.0
+BLUNDER_TO_PUNISH_VALUE = 1.5
+EXPECTATION_SWING_VALUE = 2.0
+
+
+# Decision points of a game found by the screening pass
+class PuzzleValue:
+    def __init__(self):
+        self.only_moves = 0
+        self.found_only_moves = 0
+        self.blunders_to_punish = 0
+        self.expectation_swing = 0.0
+
+    def get_value(self):
+        return self.only_moves * ONLY_MOVE_VALUE + self.found_only_moves * FOUND_ONLY_MOVE_VALUE \
+            + self.blunders_to_punish * BLUNDER_TO_PUNISH_VALUE + self.expectation_swing * EXPECTATION_SWING_VALUE
+
+
+# Score the moves played after the opening from the shallow analyses of the positions of the game (keyed by EPD).
+# Positions whose search failed are left out.
+def score_puzzle_value(grandmaster, game_to_analyze, analyses):
+    game = game_to_analyze.game
+    grandmaster_side = get_grandmaster_side(grandmaster, game)
+    opening_ply_length = get_opening_ply_length(game_to_analyze.opening)
+    puzzle_value = PuzzleValue()
+
+    board = game.board()
+    last_analysis = None
+    last_expectation = 0.5
+    for move in game.mainline_moves():
+        half_move = board.ply()
+        gm_turn = board.turn == grandmaster_side
+        board.push(move)
+        analysis = analyses.get(board.epd())
+        expectation = get_expectation(get_pov_score(grandmaster_side, analysis), half_move + 1) \
+            if analysis is not None else None
+
+        if half_move >= opening_ply_length and last_analysis is not None and expectation is not None:
+            if gm_turn:
+                best_next_moves, _, best_next_moves_expectations, _ = \
+                    find_best_next_moves(last_analysis, not board.turn, half_move)
+                if has_only_one_good_move(best_next_moves, best_next_moves_expectations):
+                    puzzle_value.only_moves += 1
+                    if move == best_next_moves[0]:
+                        puzzle_value.found_only_moves += 1
+            elif played_blunder_move(1 - last_expectation, 1 - expectation):
+                puzzle_value.blunders_to_punish += 1
+
+            puzzle_value.expectation_swing += abs(expectation - last_expectation)
+
+        last_analysis = analysis
+        if expectation is not None:
+            last_expectation = expectation
+
+    return puzzle_value
+
+
+# Search every unique position of the games once at the triage depth and score the puzzle value of every game
+async def screen_games(engine_pool, grandmaster, games_to_analyze, tablebase=None):
+    planned_positions, _ = plan_positions(games_to_analyze)
+    limit = chess.engine.Limit(depth=TRIAGE_DEPTH)
+    progress = Progress(len(planned_positions))
+    analyses = {}
+
+    async def screen_position(epd, board):
+        try:
+            analyses[epd] = await analyse_board(engine_pool, board, multipv=TRIAGE_MULTIPV, limit=limit,
+                                                tablebase=tablebase)
+        except EngineSearchError:
+            pass
+
+        progress.advance()
+        if progress.done % 100 == 0:
+            print("Screened", progress.done, "of", len(planned_positions), "positions,", progress.get_eta())
+
+    await asyncio.gather(*[screen_position(epd, board) for epd, board in planned_positions.items()])
+
+    return [score_puzzle_value(grandmaster, game_to_analyze, analyses) for game_to_analyze in games_to_analyze], \
+        len(planned_positions)
+
+
+# The games above the threshold, of these at most the top games with the highest puzzle values, in the order of the
+# pgn file
+def select_games(games_to_analyze, puzzle_values, top=None, threshold=None):
+    ranked = sorted(range(len(games_to_analyze)), key=lambda i: -puzzle_values[i].get_value())
+    if threshold is not None:
+        ranked = [i for i in ranked if puzzle_values[i].get_value() >= threshold]
+    if top is not None:
+        ranked = ranked[:top]
+    return sorted(ranked)
+
+
+def get_game_name(game):
+    headers = game.headers
+    return str(headers.get("White")) + " vs " + str(headers.get("Black")) + " (round " + str(headers.get("Round")) \
+        + ")"
+
+
+def print_triage_report(games_to_analyze, puzzle_values, selected, screened_positions, seconds):
+    print()
+    print("Triage at depth", TRIAGE_DEPTH, "screened", screened_positions, "unique positions of", len(games_to_analyze),
+          "games in", format_duration(seconds))
+    for i in sorted(range(len(games_to_analyze)), key=lambda i: -puzzle_values[i].get_value()):
+        puzzle_value = puzzle_values[i]
+        print(" ", "+" if i in selected else "-", round(puzzle_value.get_value(), 2),
+              get_game_name(games_to_analyze[i].game) + ":", puzzle_value.only_moves, "only moves (found",
+              str(puzzle_value.found_only_moves) + "),", puzzle_value.blunders_to_punish, "blunders to punish,",
+              "expectation swing", round(puzzle_value.expectation_swing, 2))
+    print("Selected", len(selected), "of", len(games_to_analyze), "games for the full analysis")
+
+
+# Two pass analysis: screen the games at shallow depth and keep only the games worth the full analysis. Returns the
+# selected games and the number of searches the screening requested from the pool and ran on its engines (the pool
+# runs no other searches during the screening).
+async def triage_games(engine_pool, grandmaster, games_to_analyze, top=None, threshold=None, tablebase=None):
+    start = time.monotonic()
+    search_requests = engine_pool.search_requests
+    engine_searches = engine_pool.engine_searches
+
+    puzzle_values, screened_positions = await screen_games(engine_pool, grandmaster, games_to_analyze, tablebase)
+    selected = select_games(games_to_analyze, puzzle_values, top, threshold)
+    print_triage_report(games_to_analyze, puzzle_values, set(selected), screened_positions, time.monotonic() - start)
+
+    return [games_to_analyze[i] for i in selected], engine_pool.search_requests - search_requests, \
+        engine_pool.engine_searches - engine_searches
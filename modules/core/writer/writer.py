@@ -0,0 +1,62 @@
+import asyncio
+import os
+import queue
+import threading
+
+# Maximum number of output files waiting to be written before the analysis waits for the writer
+OUTPUT_QUEUE_SIZE = 16
+TEMPORARY_FILE_SUFFIX = ".tmp"
+
+
+# Write a file under a temporary name and rename it when it is complete, so that readers never see a partially
+# written output file, not even when the program is killed while writing
+def write_file_atomically(path, write_content, mode="w"):
+    temporary_path = str(path) + TEMPORARY_FILE_SUFFIX
+
+    try:
+        with open(temporary_path, mode) as temporary_file:
+            write_content(temporary_file)
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+# Serializes and writes output files in a dedicated thread, so that the event loop keeps driving the engines while
+# large files are encoded and written. Tasks are written in the order they are submitted. If the disk falls behind,
+# submitting waits until the bounded queue has room again.
+class OutputWriter:
+    def __init__(self, queue_size=OUTPUT_QUEUE_SIZE):
+        self.tasks = queue.Queue(maxsize=queue_size)
+        self.errors = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+
+            try:
+                task()
+            except Exception as e:
+                print("Could not write output file:", e)
+                self.errors.append(e)
+
+    # Wait for room in the queue without blocking the event loop
+    async def submit(self, task):
+        try:
+            self.tasks.put_nowait(task)
+        except queue.Full:
+            await asyncio.get_running_loop().run_in_executor(None, self.tasks.put, task)
+
+    # Wait until all submitted files are written. The first failed write is raised, so that a run does not end as if
+    # all of its output had been saved.
+    async def close(self):
+        await self.submit(None)
+        await asyncio.get_running_loop().run_in_executor(None, self.thread.join)
+
+        if self.errors:
+            raise self.errors[0]
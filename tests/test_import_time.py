@@ -0,0 +1,39 @@
+import json
+import os
+import subprocess
+import sys
+
+# Importing the command line tool must not load the dependencies of single subcommands (see commands.py)
+HEAVY_MODULES = ["pandas", "matplotlib", "flask", "waitress", "mechanize", "bs4", "aiohttp", "chess.gaviota"]
+
+# Loose bound of the import time, which is around 0.1 seconds on a development machine
+MAX_IMPORT_SECONDS = 2.0
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SCRIPT = """
+import json
+import sys
+import time
+
+start = time.perf_counter()
+import main
+seconds = time.perf_counter() - start
+
+print(json.dumps({"seconds": seconds, "modules": [name for name in HEAVY_MODULES if name in sys.modules]}))
+"""
+
+
+def import_main():
+    script = "HEAVY_MODULES = " + json.dumps(HEAVY_MODULES) + "\n" + IMPORT_SCRIPT
+    output = subprocess.run([sys.executable, "-c", script], cwd=REPOSITORY_PATH, capture_output=True, text=True,
+                            check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def test_import_main_does_not_load_heavy_dependencies():
+    assert import_main()["modules"] == []
+
+
+def test_import_main_is_fast():
+    assert import_main()["seconds"] < MAX_IMPORT_SECONDS
@@ -0,0 +1,42 @@
+import asyncio
+import os
+import sys
+
+import chess
+import chess.engine
+import pytest
+
+from modules.core.engine.lean_engine import LeanUciEngine
+
+SCRIPTED_ENGINE_COMMAND = [sys.executable, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                        "modules", "core", "engine", "scripted_engine.py")]
+
+
+def run_with_engine(test):
+    async def run():
+        engine = await LeanUciEngine.popen(SCRIPTED_ENGINE_COMMAND)
+        try:
+            return await test(engine)
+        finally:
+            await engine.quit()
+
+    asyncio.set_event_loop_policy(chess.engine.EventLoopPolicy())
+    return asyncio.run(run())
+
+
+# The scripted engine declares "Use NNUE" like Stockfish, while the repo configures "USE NNUE"
+def test_configure_matches_option_names_regardless_of_case():
+    async def test(engine):
+        await engine.configure({"Threads": 1, "hash": 16, "USE NNUE": False})
+        return await engine.analyse(chess.Board(), chess.engine.Limit(depth=2), multipv=2)
+
+    analysis = run_with_engine(test)
+    assert len(analysis) == 2
+
+
+def test_configure_rejects_unknown_options():
+    async def test(engine):
+        await engine.configure({"Contempt": 10})
+
+    with pytest.raises(chess.engine.EngineError):
+        run_with_engine(test)